@@ -1,9 +1,12 @@
+import argparse
+import itertools
 import json
-import sys
 import numpy as np
 import os
+import tempfile
 
 import lxml.etree as ET
+from endowments import writeEndowments
 BASIC_TEMPLATE = """<Simulation start="0" duration="10000">
     
 </Simulation> """
@@ -19,148 +22,249 @@ PAYOFF_MIN = 100
 PAYOFF_MAX = 1000
 RISK_COEFF_MU = 5
 RISK_COEFF_SD = 0.7 
+VARIANCE_MIN = 0.05
+VARIANCE_MAX = 0.5
+NUM_FACTORS = 3
+FACTOR_SCALE = 0.5
 NUM_NOISY = 0
 PRINT_TRADE = True
+SEED = None
+VERBOSE = False
+SIMULATOR_DIR = "maxe/build/TheSimulator/TheSimulator/"
+AGENT_FP = "../../../../SimpleCaseAgent.py"
+POPULATION_FP = "../../../../SimpleCasePopulation.py"
+POPULATION_SIZE = 0
+ENDOWMENT_FORMAT = "packed"
+ENDOWMENT_FILE = "endowments.npy"
+ASSET_FORMAT = "json"
 
 
-def addExchangeXMLElements(simulation_root, num_assets, num_agents):
-    """ adds specified number of exchange elements to XML file, also their trade loggers """
-
-    global PRINT_TRADE
+def exchangeXMLElements(num_assets):
+    """ yields (tag, attributes) of the exchange elements, the price data agent, 
+        trade loggers and shock agent, in the order they appear in the XML file """
 
     for num in range(num_assets):
-        print(num)
-        ET.SubElement(simulation_root, "ExchangeAgent")
-        simulation_root[num_agents + num].set('name', "ASSET" + str(num))
-        simulation_root[num_agents + num].set('algorithm', 'PureProRata')
+        if VERBOSE:
+            print(num)
+        yield "ExchangeAgent", {'name' : "ASSET" + str(num), 'algorithm' : 'PureProRata'}
 
-    ET.SubElement(simulation_root, "PriceDataAgent")
-    simulation_root[num_agents + num_assets].set("name", "PDA")
-    simulation_root[num_agents + num_assets].set("num_assets", str(num_assets))
-    simulation_root[num_agents + num_assets].set("exchange", "ASSET0")
+    yield "PriceDataAgent", {"name" : "PDA", "num_assets" : str(num_assets), "exchange" : "ASSET0"}
 
     if PRINT_TRADE:
         for num in range(num_assets):
-            ET.SubElement(simulation_root, "TradeLogAgent")
-            simulation_root[num_agents + num_assets + num + 1].set('name', 'ASSET' + str(num) + "_LOGGER")
-            simulation_root[num_agents + num_assets + num + 1].set('exchange', 'ASSET' + str(num))
+            yield "TradeLogAgent", {'name' : 'ASSET' + str(num) + "_LOGGER", 'exchange' : 'ASSET' + str(num)}
 
-    ET.SubElement(simulation_root, "ShockAgent")
-    simulation_root[num_agents + num_assets + num_assets + 1].set('name', 'SA')
-    simulation_root[num_agents + num_assets + num_assets + 1].set('exchange', 'ASSET0')
+    yield "ShockAgent", {'name' : 'SA', 'exchange' : 'ASSET0'}
 
-def addAgentXMLElements(simulation_root, num_agents):
-    """ adds requisite number of agents to xml object """
+def agentXMLElements(num_agents, endowments):
+    """ yields (tag, attributes) of each agent element, filled in from the arrays 
+        returned by generateAgentEndowments """
 
     for num in range(num_agents):
 
-        ET.SubElement(simulation_root, "SimpleCaseAgent")
-        simulation_root[num].set('fp', "../../../../SimpleCaseAgent.py")
-        simulation_root[num].set('name', "AGENT" + str(num))
-        ## need to set arbitrary exchange here, their initialization code will be looking for an exchange anyway 
-        simulation_root[num].set('exchange', 'ASSET1')
-        simulation_root[num].set('refresh_rate', REFRESH_RATE)
-        simulation_root[num].set('asset_file', "")
-        simulation_root[num].set('rfr', RFR)
-        simulation_root[num].set('step_rate',STEP_RATE)
-        simulation_root[num].set('risk_coeff',"")
-
-def generateAgentEndowments(simulation_root, num_agents, num_assets, asset_prices, name):
-    """ generates endowments for agents, sets values, generates json files
+        attributes = {
+            'fp' : AGENT_FP,
+            'name' : "AGENT" + str(num),
+            ## need to set arbitrary exchange here, their initialization code will be looking for an exchange anyway 
+            'exchange' : 'ASSET1',
+            'refresh_rate' : REFRESH_RATE,
+            'asset_file' : endowments["asset_files"][endowments["asset_file_index"][num]],
+            'rfr' : RFR,
+            'step_rate' : STEP_RATE,
+            'risk_coeff' : str(endowments["risk_coeffs"][num]),
+            'capital' : str(endowments["capitals"][num]),
+        }
+
+        if ENDOWMENT_FORMAT == "packed":
+            attributes['endowment_file'] = "Agents/" + ENDOWMENT_FILE
+
+        yield "SimpleCaseAgent", attributes
+
+def populationXMLElements(num_agents, endowments):
+    """ yields (tag, attributes) of SimpleCasePopulation elements running the agents in groups of
+        up to POPULATION_SIZE, each group a run of consecutive agents sharing an asset file """
+
+    if ENDOWMENT_FORMAT != "packed":
+        raise ValueError("populations read the packed endowment store, ENDOWMENT_FORMAT must be packed")
+
+    file_index = np.asarray(endowments["asset_file_index"])
+
+    ## starts of runs of agents with the same asset file, split further into chunks of POPULATION_SIZE
+    starts = [0] + (np.flatnonzero(np.diff(file_index)) + 1).tolist()
+    ends = starts[1:] + [num_agents]
+
+    for start, end in zip(starts, ends):
+        for first in range(start, end, POPULATION_SIZE):
+
+            yield "SimpleCasePopulation", {
+                'fp' : POPULATION_FP,
+                'name' : "POPULATION" + str(first),
+                'exchange' : 'ASSET1',
+                'refresh_rate' : REFRESH_RATE,
+                'asset_file' : endowments["asset_files"][file_index[first]],
+                'rfr' : RFR,
+                'step_rate' : STEP_RATE,
+                'endowment_file' : "Agents/" + ENDOWMENT_FILE,
+                'first_agent' : str(first),
+                'num_agents' : str(min(POPULATION_SIZE, end - first)),
+            }
+
+def traderXMLElements(num_agents, endowments):
+    """ yields the trader elements, one agent each, or populations if POPULATION_SIZE is set """
+
+    if POPULATION_SIZE > 0:
+        return populationXMLElements(num_agents, endowments)
+
+    return agentXMLElements(num_agents, endowments)
+
+def writeSimulationXML(path, elements):
+    """ streams (tag, attributes) pairs into a simulation XML file without building the tree,
+        written to a temporary file next to path and moved into place once complete """
+
+    simulation_attributes = ET.fromstring(BASIC_TEMPLATE).attrib
+    directory = os.path.dirname(path) or "."
+
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".tmp", suffix=".xml", delete=False) as f:
+        try:
+            with ET.xmlfile(f, encoding="ASCII") as xf:
+                with xf.element("Simulation", simulation_attributes):
+                    for tag, attributes in elements:
+                        xf.write("\n    ")
+                        xf.write(ET.Element(tag, attributes))
+                    xf.write("\n")
+        except BaseException:
+            os.unlink(f.name)
+            raise
+
+    ## NamedTemporaryFile is private (0600), give the scenario the mode a plain open() would
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(f.name, 0o666 & ~umask)
+
+    os.replace(f.name, path)
+
+def generateAgentEndowments(num_agents, num_assets, asset_prices, name, rng=None, directory=None, asset_files=None):
+    """ generates endowments for agents, generates json files, returns the per agent
+        values the XML elements need (see agentXMLElements)
         needs to be run after assets have been generated, asset generator will come up with initial price values
+        all random draws are made in bulk from rng, a numpy Generator seeded with SEED if not given
+        files go to directory, "<name> Agents" by default, agents are pointed at asset_files
        """
 
-    ## generating list of risk coeffs
-    risk_coeffs = np.random.normal(RISK_COEFF_MU, RISK_COEFF_SD, num_agents).tolist()
+    if rng is None:
+        rng = np.random.default_rng(SEED)
 
-    noisy_agents = np.random.choice(range(num_agents), NUM_NOISY, replace=False).tolist()
-    print(noisy_agents)
+    ## generating risk coeffs, capital and share endowments for every agent at once,
+    ## stipulating that share count must be positive for now
+    risk_coeffs = rng.normal(RISK_COEFF_MU, RISK_COEFF_SD, num_agents)
+    capitals = rng.normal(CAPITAL_MU, CAPITAL_SD, num_agents)
+    shares = np.absolute(rng.normal(SHARE_MU, SHARE_SD, (num_agents, num_assets))).astype(int)
 
-    ## generating capital values, setting risk coeff, and json values for each agent
-    for num in range(num_agents):
-        capital = np.random.normal(CAPITAL_MU, CAPITAL_SD, 1)
-        simulation_root[num].set('capital', str(capital[0]))
-        simulation_root[num].set('risk_coeff', str(risk_coeffs[num]))
+    noisy_mask = np.zeros(num_agents, dtype=bool)
+    noisy_mask[rng.choice(num_agents, NUM_NOISY, replace=False)] = True
 
+    if VERBOSE:
+        print(np.flatnonzero(noisy_mask).tolist())
 
-        ## TODO: Need to make this dynamic, want a range of beliefs, this presumes only 2 asset dictionaries
-        if num in noisy_agents:
-            simulation_root[num].set("asset_file", name + "Asset Dictionaries/" + " Asset Dictionary " + "1" + ".json")
-        else: 
-            simulation_root[num].set("asset_file", name + "Asset Dictionaries/" + " Asset Dictionary " + "0" + ".json")
+    ## TODO: Need to make this dynamic, want a range of beliefs, this presumes only 2 asset dictionaries
+    if asset_files is None:
+        asset_files = [name + "Asset Dictionaries/" + " Asset Dictionary " + str(dict_num) + ".json" for dict_num in range(2)]
 
-        ## generate share endowments, stipulating that share count must be positive for now
-        shares = np.absolute(np.random.normal(SHARE_MU, SHARE_SD, num_assets)).tolist()
-        shares = [int(x) for x in shares]
-        watching = []
+    if directory is None:
+        directory = name + " Agents"
 
-        for asset_num in range(num_assets):
-            watching.append("ASSET" + str(asset_num))
+    watching = ["ASSET" + str(asset_num) for asset_num in range(num_assets)]
 
-        if num in noisy_agents:
-            agent_dict = {"watching" : watching, "prices" : asset_prices[0], "shares" : shares}
-        else:
-            agent_dict = {"watching" : watching, "prices" : asset_prices[0], "shares" : shares}
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+
+    ## packed store, one row per agent in a single file
+    if ENDOWMENT_FORMAT == "packed":
+        writeEndowments(directory + "/" + ENDOWMENT_FILE, capitals, asset_prices[0], shares,
+                        np.ones((num_agents, num_assets), dtype=bool), risk_coeffs)
 
-        print("AGENT ", num, agent_dict)
+    ## generating json values for each agent, skipped entirely for packed runs that print nothing
+    if ENDOWMENT_FORMAT == "json" or VERBOSE:
 
-        if not os.path.isdir(name + " Agents"):
-            os.mkdir(name + " Agents")
+        for num in range(num_agents):
 
+            agent_dict = {"watching" : watching, "prices" : asset_prices[0], "shares" : shares[num].tolist()}
 
-        ## generating json files for each agent
-        with open(name + " Agents/Agent" + str(num) + ".json", 'w') as f:
-            json.dump(agent_dict, f)
+            if VERBOSE:
+                print("AGENT ", num, agent_dict)
+
+            ## generating json files for each agent, only kept for small debugging runs
+            if ENDOWMENT_FORMAT == "json":
+                with open(directory + "/Agent" + str(num) + ".json", 'w') as f:
+                    json.dump(agent_dict, f)
+
+    return {"capitals" : capitals, "risk_coeffs" : risk_coeffs, "asset_files" : asset_files,
+            "asset_file_index" : noisy_mask.astype(int)}
 
     
-def generateAssetDictionary(name, num_assets, num_dicts):
-    """ generates a series of arbitrary assets """
+def generateCovariance(exp_prices, rng):
+    """ returns a covariance matrix for assets with the given expected prices, positive-definite
+        by construction: correlations come from a NUM_FACTORS factor model plus idiosyncratic
+        noise, each asset's variance is a random fraction of its expected price """
 
-    assets = []
+    num_assets = len(exp_prices)
 
-    for num in range(num_assets):
-        assets.append("ASSET" + str(num))
+    ## factor loadings plus strictly positive idiosyncratic variance, normalised to a correlation matrix
+    loadings = rng.normal(0, FACTOR_SCALE, (num_assets, NUM_FACTORS))
+    correlation = np.matmul(loadings, loadings.T)
+    correlation[np.diag_indices(num_assets)] += rng.uniform(0.5, 1.5, num_assets)
 
-    ## initializing variance list
-    variances = []
-    for i in range(num_assets):
-        variances.append([])
-        for j in range(num_assets):
-            variances[i].append(0)
+    inv_std = 1 / np.sqrt(np.diag(correlation))
+    correlation *= np.outer(inv_std, inv_std)
 
-    ## generating expected prices
-    exp_prices = (1.1 * np.random.randint(low=PAYOFF_MIN + num, high=PAYOFF_MAX + num, size=num_assets)).tolist()
+    ## same variance scale as before, fraction of the expected price
+    volatility = np.sqrt(rng.uniform(VARIANCE_MIN, VARIANCE_MAX, num_assets) * exp_prices)
 
-    ## double for loop to determine variance matrix
-    for i in range(num_assets):
-        for j in range(num_assets): 
-            if i == j:
+    return correlation * np.outer(volatility, volatility)
 
-                variances[i][j] = float(np.random.sample() * 0.5) * exp_prices[i]
-            elif variances[i][j] == 0:
-                cov_ij = float(np.random.sample() * 0.01) * exp_prices[i] * exp_prices[j]
-                variances[i][j] = cov_ij
-                variances[j][i] = cov_ij 
+def generateAssetDictionary(name, num_assets, num_dicts, rng=None, directory=None):
+    """ generates a series of arbitrary assets, written to directory, "<name> Asset Dictionaries" by default """
 
-    initial_prices_list = []
+    if rng is None:
+        rng = np.random.default_rng(SEED)
 
-    ## generating returns
-    exp_prices = (1.1 * np.random.randint(low=PAYOFF_MIN + num, high=PAYOFF_MAX + num, size=num_assets)).tolist()
+    assets = ["ASSET" + str(num) for num in range(num_assets)]
 
-    initial_prices = []
+    ## generating expected prices
+    exp_prices = 1.1 * rng.integers(low=PAYOFF_MIN, high=PAYOFF_MAX, size=num_assets)
+
+    variances = generateCovariance(exp_prices, rng)
+
+    ## stored so agents can reuse the factorisation instead of recomputing it at load time
+    cholesky = np.linalg.cholesky(variances)
+
+    ## generating initial prices, slightly under expected
+    initial_prices = (1 - rng.random(num_assets) * 0.01) * exp_prices
 
-    for asset_num in range(num_assets):
-        initial_prices.append(float((1 - (np.random.random() * 0.01)) * exp_prices[asset_num]))
+    initial_prices_list = [initial_prices.tolist()]
 
-    initial_prices_list.append(initial_prices)
+    if directory is None:
+        directory = name + " Asset Dictionaries"
 
-    if not os.path.isdir(name + " Asset Dictionaries"):
-            os.mkdir(name + " Asset Dictionaries")
+    if not os.path.isdir(directory):
+            os.mkdir(directory)
 
     for dict_num in range(num_dicts):        
 
-        with open(name + " Asset Dictionaries" + "/Asset Dictionary " + str(dict_num) + ".json", "w") as f:
-            asset_dict = {"assets" : assets, "exp_prices" : exp_prices, "variances" : variances}
+        dict_name = directory + "/Asset Dictionary " + str(dict_num)
+        asset_dict = {"assets" : assets, "exp_prices" : exp_prices.tolist()}
+
+        ## binary format: matrices in .npy files next to a small json header, memory-mapped by agents
+        if ASSET_FORMAT == "npy":
+            np.save(dict_name + ".variances.npy", variances)
+            np.save(dict_name + ".cholesky.npy", cholesky)
+            asset_dict["variances_file"] = os.path.basename(dict_name) + ".variances.npy"
+            asset_dict["cholesky_file"] = os.path.basename(dict_name) + ".cholesky.npy"
+        else:
+            asset_dict["variances"] = variances.tolist()
+            asset_dict["cholesky"] = cholesky.tolist()
+
+        with open(dict_name + ".json", "w") as f:
             json.dump(asset_dict, f)
 
     return initial_prices_list
@@ -170,30 +274,49 @@ def generateAssetDictionary(name, num_assets, num_dicts):
 def generateSimulation(name, num_agents, num_assets):
     """ generates simulation XML file! """
 
-    ##set up initial XML file object
+    os.chdir(name)
 
-    sim = ET.fromstring(BASIC_TEMPLATE)
+    ## one generator for the whole scenario, reproducible when SEED is set
+    rng = np.random.default_rng(SEED)
 
-    addAgentXMLElements(sim, num_agents)
+    initial_prices = generateAssetDictionary(name, num_assets, 2, rng)
 
-    addExchangeXMLElements(sim, num_assets, num_agents)
+    endowments = generateAgentEndowments(num_agents, num_assets, initial_prices, name, rng)
 
-    os.chdir(name)
+    os.chdir("../")
+
+    ## currently using default length of time 
 
-    initial_prices = generateAssetDictionary(name, num_assets, 2)
+    ## stream elements straight to the simulation folder to run it, never holding the whole tree
+    elements = itertools.chain(traderXMLElements(num_agents, endowments), exchangeXMLElements(num_assets))
 
-    generateAgentEndowments(sim, num_agents, num_assets, initial_prices, name)
+    writeSimulationXML(SIMULATOR_DIR + name + '.xml', elements)
 
-    ## currently using default length of time 
 
-    ## save file to simulation folder to run it  
 
-    simulation_tree = ET.ElementTree(sim)
+def generateScenario(directory, num_agents, num_assets):
+    """ generates a self-contained scenario in directory: scenario.xml next to Agents/, 
+        Asset Dictionaries/ and SimulationData/, runnable with directory as working directory.
+        AGENT_FP should be absolute, the agent script is not copied """
 
-    os.chdir("../")
+    rng = np.random.default_rng(SEED)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
 
-    simulation_tree.write("maxe/build/TheSimulator/TheSimulator/" + name + '.xml')
+    if not os.path.isdir(directory + "/SimulationData"):
+        os.mkdir(directory + "/SimulationData")
 
+    initial_prices = generateAssetDictionary("", num_assets, 2, rng, directory + "/Asset Dictionaries")
+
+    ## paths as seen by agents running inside directory
+    asset_files = ["Asset Dictionaries/Asset Dictionary " + str(dict_num) + ".json" for dict_num in range(2)]
+
+    endowments = generateAgentEndowments(num_agents, num_assets, initial_prices, "", rng, directory + "/Agents", asset_files)
+
+    elements = itertools.chain(traderXMLElements(num_agents, endowments), exchangeXMLElements(num_assets))
+
+    writeSimulationXML(directory + "/scenario.xml", elements)
 
 
 def parseAgentFile(filename):
@@ -207,17 +330,36 @@ def parseAgentFile(filename):
 
 def main():
 
-    global NUM_NOISY
+    global NUM_NOISY, SEED, VERBOSE, ENDOWMENT_FORMAT, ASSET_FORMAT, POPULATION_SIZE
+
+    parser = argparse.ArgumentParser(description="generates a SimpleCaseAgent simulation scenario")
+    parser.add_argument("name")
+    parser.add_argument("num_agents", type=int)
+    parser.add_argument("num_assets", type=int)
+    parser.add_argument("num_noisy", type=int, nargs="?", default=NUM_NOISY)
+    parser.add_argument("--seed", type=int, default=SEED, help="seed of the numpy Generator used for every draw")
+    parser.add_argument("--verbose", action="store_true", help="print every generated agent")
+    parser.add_argument("--endowment-format", choices=["packed", "json"], default=ENDOWMENT_FORMAT,
+                        help="one packed endowment file, or one json file per agent")
+    parser.add_argument("--asset-format", choices=["json", "npy"], default=ASSET_FORMAT,
+                        help="asset dictionaries as plain json, or a json header with memory-mapped .npy matrices")
+    parser.add_argument("--population-size", type=int, default=POPULATION_SIZE,
+                        help="run agents as SimpleCasePopulation groups of this size, 0 for one element per agent")
+    args = parser.parse_args()
+
+    NUM_NOISY = args.num_noisy
+    SEED = args.seed
+    VERBOSE = args.verbose
+    ENDOWMENT_FORMAT = args.endowment_format
+    ASSET_FORMAT = args.asset_format
+    POPULATION_SIZE = args.population_size
+
+    if not os.path.exists(args.name):
+            os.mkdir(args.name)
 
-    simulation_name = sys.argv[1]
-    number_agents = int(sys.argv[2])
-    number_assets = int(sys.argv[3])
-    if len(sys.argv) == 5:
-        NUM_NOISY = int(sys.argv[4])
+    generateSimulation(args.name, args.num_agents, args.num_assets)
 
-    if not os.path.exists(simulation_name):
-            os.mkdir(simulation_name)
 
-    generateSimulation(simulation_name, number_agents, number_assets)
+if __name__ == "__main__":
+    main()
 
-main()
@@ -1,9 +1,14 @@
 from thesimulator import *
 from portfolio import *
+from history import *
+from tradelog import *
+from endowments import readEndowment
+from agentparams import optionalParam
+from instrument import AgentProfile, defaultInstrumentation
+from profiler import profileAgent, profilingEnabled
 import numpy as np
 import time
 from random import randint
-from copy import copy
 
 
 class SimpleCaseAgent:
@@ -24,57 +29,262 @@ class SimpleCaseAgent:
         self.step_rate = float(params["step_rate"])
         self.agent_id = self.name()[5:]
 
-        with open("Agents/Agent" + self.agent_id + ".json") as f:
-            agent_data = json.load(f)
-            self.watching = agent_data["watching"]
-            self.prices = agent_data["prices"]
-            self.shares = agent_data["shares"]
+        ## instrument="1" (or MARKETSIM_INSTRUMENT=1) times the hot path, see instrument.py
+        self.profile = None
+        if int(optionalParam(params, "instrument", defaultInstrumentation())):
+            self.profile = AgentProfile(self, self.agent_id)
+
+        self.asset_file = str(params["asset_file"])
+
+        ## read only our own row of the packed endowment store if there is one, else our json file
+        endowment_file = str(optionalParam(params, "endowment_file", ""))
+        if endowment_file:
+            agent_data = readEndowment(endowment_file, self.agent_id, loadAssetData(self.asset_file).assets)
+        else:
+            with open("Agents/Agent" + self.agent_id + ".json") as f:
+                agent_data = json.load(f)
+
+        self.watching = agent_data["watching"]
+        self.prices = agent_data["prices"]
+        self.shares = agent_data["shares"]
 
         self.outstanding_orders = {}
-  
 
-        self.asset_file = str(params["asset_file"])
+        ## build lookups once, used on every message instead of list scans
+        asset_index = loadAssetData(self.asset_file).asset_index
+        self.asset_indices = [asset_index[asset] for asset in self.watching]
+        self.watching_slots = {exchange : slot for slot, exchange in enumerate(self.watching)}
+        self.exchange_ids = {exchange : int(exchange[5:]) for exchange in self.watching}
+
+        ## covariance is fixed for the run, factorise it once up front
+        self.model = getMeanVarianceModel(self.getWatchingIndices(), self.asset_file)
 
         self.risk_free_rate = float(params["rfr"])
         self.risk_coeff = float(params["risk_coeff"])
         self.wakeup_set = 0
 
-        self.share_data = []
-        self.return_data = []
-        self.variance_data = []
+        ## incremental mode only re-solves / re-evaluates once prices have moved past eval_tolerance
+        self.incremental = int(optionalParam(params, "incremental", 0))
+        self.eval_tolerance = float(optionalParam(params, "eval_tolerance", 0))
+        self.skipped_evaluations = 0
+        self.skipped_solves = 0
+        self.optimal_weights = None
+        self.optimal_risk = None
+        self.solved_excess = None
+        self.resetRunningState()
+
+        ## order_diffing leaves a resting order in place when re-evaluation would re-submit it unchanged
+        self.order_diffing = int(optionalParam(params, "order_diffing", 0))
+        self.kept_orders = 0
+
+        ## with coalesce set, trade events only update state and a single deferred EVALUATE message runs
+        ## the evaluation, at the end of the timestamp or at the next multiple of eval_quantum
+        self.coalesce = int(optionalParam(params, "coalesce", 0))
+        self.eval_quantum = int(optionalParam(params, "eval_quantum", 0))
+        self.evaluation_pending = 0
+        self.events_received = 0
+        self.evaluations = 0
+
+        ## trades by others only reach us once the last traded price of an asset has moved more than
+        ## price_threshold (relative) since the last one we acted on. subscription="filtered" has the
+        ## exchange apply the filter, "snapshots" takes batched prices from the PriceDataAgent
+        ## price_data_agent instead of trade events. both need an engine supporting them, e.g. localsim
+        self.subscription = str(optionalParam(params, "subscription", "trades"))
+        self.price_threshold = float(optionalParam(params, "price_threshold", 0))
+        self.price_data_agent = str(optionalParam(params, "price_data_agent", "PDA"))
+        self.notified_prices = list(self.prices)
+        self.filtered_events = 0
+
+        ## messages dispatched by type, and the number of timesteps we dispatched anything in
+        self.messages_sent = {}
+        self.message_timesteps = 0
+        self.last_message_ts = None
+
+        ## history is kept in typed, growable columns, written as .npz (or legacy json) at stop.
+        ## history_spill="agent" / "shared" streams it to disk in history_capacity sized chunks instead
+        history_spill = str(optionalParam(params, "history_spill", ""))
+        spill_path = None
+        if history_spill == "agent":
+            spill_path = "SimulationData/History" + self.agent_id + ".bin"
+        elif history_spill == "shared":
+            spill_path = "SimulationData/History.bin"
+
+        self.history = HistoryRecorder(len(self.watching), int(optionalParam(params, "history_capacity", 1024)),
+                                       int(optionalParam(params, "history_downsample", 1)), spill_path, self.agent_id)
+        self.history_format = str(optionalParam(params, "history_format", "npz"))
         self.buy_trades = {}
         self.sell_trades = {}
 
+        ## fills of every agent go to one fixed-width binary log, see tradelog.py
+        self.agent_number = int(self.agent_id)
+        self.trade_log = openTradeLog(str(optionalParam(params, "trade_log", "SimulationData/Trades.bin")))
+
         self.processed_this_ts = -1
 
+        ## MARKETSIM_PROFILE=1 samples the interpreter's stacks for the run, see profiler.py.
+        ## last in configure, once the agent is fully set up
+        if profilingEnabled():
+            profileAgent(self)
+
     def getWatchingIndices(self):
         """ returns the indices of the assets in "watching", in the larger asset dictionary """
 
-        indicies = []
-        with open(self.asset_file) as f:
-            asset_dict = json.load(f)
-        
+        return self.asset_indices
+
+
+    def resetRunningState(self):
+        """ recomputes the running holdings value and excess returns from scratch """
+
+        prices = np.asarray(self.prices, dtype=float)
+
+        self.position_values = prices * np.asarray(self.shares, dtype=float)
+        self.holdings_value = float(np.sum(self.position_values))
+        self.excess_returns = self.model.expectedReturns(prices) - self.risk_free_rate
+        self.evaluated_prices = prices
+
+    def setPrice(self, asset_index, new_price):
+        """ sets the price of one asset, updating running state in O(1) """
+
+        self.prices[asset_index] = new_price
+
+        value = new_price * self.shares[asset_index]
+        self.holdings_value += value - self.position_values[asset_index]
+        self.position_values[asset_index] = value
+
+        self.excess_returns[asset_index] = self.model.exp_prices[asset_index] / new_price - self.risk_free_rate
+
+    def addShares(self, asset_index, delta):
+        """ changes the share count of one asset, updating running state in O(1) """
+
+        self.shares[asset_index] += delta
 
-        for asset in self.watching:
-            indicies.append(asset_dict["assets"].index(asset))
+        value = self.prices[asset_index] * self.shares[asset_index]
+        self.holdings_value += value - self.position_values[asset_index]
+        self.position_values[asset_index] = value
 
-        return indicies
+    def currentWeights(self):
+        """ returns current portfolio weights from running state, same convention as calculate_current_weights """
 
+        if not self.incremental:
+            return calculate_current_weights(self.prices, self.shares)
 
-    def updateData(self):
+        held = np.asarray(self.shares) > 0
+
+        ## only divides for held assets, an agent that sold everything gets zeros without a warning
+        return np.divide(self.position_values, self.holdings_value, out=np.zeros(len(self.shares)), where=held)
+
+    def priceMoved(self, asset_index):
+        """ returns whether an asset's price moved past eval_tolerance since the last evaluation """
+
+        last_price = self.evaluated_prices[asset_index]
+
+        return abs(self.prices[asset_index] - last_price) > self.eval_tolerance * last_price
+
+    def incrementalOptimalPortfolio(self):
+        """ returns the tangency weights and their risk, re-solving only when
+            excess returns have drifted past eval_tolerance since the last solve """
+
+        if self.solved_excess is not None:
+
+            drift = np.max(np.abs(self.excess_returns - self.solved_excess))
+            if drift <= self.eval_tolerance * np.max(np.abs(self.solved_excess)):
+                self.skipped_solves += 1
+                return self.optimal_weights, self.optimal_risk
+
+        self.optimal_weights = self.model.tangencyFromExcess(self.excess_returns)
+        self.optimal_risk = self.model.portfolioRisk(self.optimal_weights)
+        self.solved_excess = self.excess_returns.copy()
+
+        return self.optimal_weights, self.optimal_risk
+
+    def updateData(self, current_timestamp, side=FILL_NONE, price=np.nan):
         """updates relevant data in data file"""
-        current_weights = calculate_current_weights(self.prices, self.shares)
+        current_weights = self.currentWeights()
 
         ## if a trade involving us, update the portfolio weights, otherwise just update new prices etc. 
 
-        self.share_data.append(copy(self.shares))
-
-        self.return_data.append(calculate_expected_return(self.getWatchingIndices(), current_weights, self.prices, self.asset_file))
-        self.variance_data.append(calcPortfolioRisk(self.getWatchingIndices(), current_weights, self.asset_file))
+        self.history.record(current_timestamp, self.shares, self.model.expectedReturn(current_weights, self.prices),
+                            self.model.portfolioRisk(current_weights), side, price)
 
             
 
 
+    def saveHistory(self):
+        """ writes recorded history to SimulationData/, flushing the shared trade log """
+
+        self.trade_log.flush()
+
+        if self.history_format == "json":
+
+            with open("SimulationData/Data" + self.agent_id + ".json", "w") as f:
+
+                data_dict = {"holdings_data" : self.history.column("shares").tolist(), "return data" : self.history.column("exp_return").tolist(),
+                             "risk data" : self.history.column("risk").tolist(), "sell trades" : self.sell_trades, "buy trades" : self.buy_trades,
+                             "skipped evaluations" : self.skipped_evaluations, "skipped solves" : self.skipped_solves,
+                             "messages sent" : self.messages_sent, "message timesteps" : self.message_timesteps,
+                             "kept orders" : self.kept_orders, "events received" : self.events_received,
+                             "evaluations" : self.evaluations, "filtered events" : self.filtered_events}
+                json.dump(data_dict, f)
+
+            return
+
+        ## fills live in the shared trade log
+        self.history.save("SimulationData/Data" + self.agent_id + ".npz", skipped_evaluations=self.skipped_evaluations,
+                          skipped_solves=self.skipped_solves, message_types=np.array(list(self.messages_sent), dtype=str),
+                          message_counts=np.array(list(self.messages_sent.values()), dtype=np.int64),
+                          message_timesteps=self.message_timesteps, kept_orders=self.kept_orders,
+                          events_received=self.events_received, evaluations=self.evaluations,
+                          filtered_events=self.filtered_events)
+
+    def dispatch(self, simulation, current_timestamp, target, type, payload, generic=False):
+        """ dispatches a message from this agent, counting it by type """
+
+        self.messages_sent[type] = self.messages_sent.get(type, 0) + 1
+
+        if current_timestamp != self.last_message_ts:
+            self.message_timesteps += 1
+            self.last_message_ts = current_timestamp
+
+        if generic:
+            simulation.dispatchGenericMessage(current_timestamp, 0, "AGENT" + self.agent_id, target, type, payload)
+        else:
+            simulation.dispatchMessage(current_timestamp, 0, "AGENT" + self.agent_id, target, type, payload)
+
+    def subscribe(self, simulation, current_timestamp):
+        """ subscribes to the trades (or price snapshots) of every asset in "watching" """
+
+        if self.subscription == "trades":
+            for ticker in self.watching:
+                self.dispatch(simulation, current_timestamp, ticker, "SUBSCRIBE_EVENT_TRADE", EmptyPayload())
+            return
+
+        if self.subscription not in ("filtered", "snapshots"):
+            raise ValueError("unknown subscription %s, expected trades, filtered or snapshots" % self.subscription)
+
+        ## with snapshots, the exchanges only need to tell us about our own fills
+        threshold = self.price_threshold if self.subscription == "filtered" else float("inf")
+
+        for ticker in self.watching:
+            self.dispatch(simulation, current_timestamp, ticker, "SUBSCRIBE_EVENT_TRADE_FILTERED", {"threshold" : threshold}, True)
+
+        if self.subscription == "snapshots":
+            self.dispatch(simulation, current_timestamp, self.price_data_agent, "SUBSCRIBE_PRICE_SNAPSHOTS",
+                          {"exchanges" : list(self.watching)}, True)
+
+    def priceNotified(self, asset_index, new_price):
+        """ returns whether a price moved past price_threshold since the last one we acted on,
+            recording it as acted on if so """
+
+        last_price = self.notified_prices[asset_index]
+
+        if abs(new_price - last_price) <= self.price_threshold * last_price:
+            self.filtered_events += 1
+            return False
+
+        self.notified_prices[asset_index] = new_price
+
+        return True
+
     def submitMarketBuy(self, simulation, current_timestamp, exchange, price):
         """ Sends a Message to Exchange to Purchase a Single Share 
         
@@ -93,7 +303,7 @@ class SimpleCaseAgent:
         """
 
         marketOrderPayload = PlaceOrderLimitPayload(OrderDirection.Buy, 1, Money(price))
-        simulation.dispatchMessage(current_timestamp, 0, "AGENT" + self.agent_id, exchange, "PLACE_ORDER_LIMIT", marketOrderPayload)
+        self.dispatch(simulation, current_timestamp, exchange, "PLACE_ORDER_LIMIT", marketOrderPayload)
         
 
     def submitMarketSell(self, simulation, current_timestamp, exchange, price):
@@ -114,40 +324,27 @@ class SimpleCaseAgent:
         """
 
         marketOrderPayload = PlaceOrderLimitPayload(OrderDirection.Sell, 1, Money(float(price)))
-        simulation.dispatchMessage(current_timestamp, 0, "AGENT" + self.agent_id, exchange, "PLACE_ORDER_LIMIT", marketOrderPayload)
+        self.dispatch(simulation, current_timestamp, exchange, "PLACE_ORDER_LIMIT", marketOrderPayload)
 
     
 
 
-    def zeroOutOrders(self, simulation, current_timestamp):
-        """ method that cancels outstanding orders when reeval.
-        
-            This method cancels all outstanding orders, updates the prices ONLY in the case that 
-           the orders have passed their timeout ref.rate time, if not, price will be updated elsewehere, 
-            no need to update it here.
-
-        Parameters
-        ----------
-        simulation : simulation object
-            The simulation object
+    def releaseOrders(self):
+        """ takes every outstanding order off the books, updating prices as if they had been cancelled.
 
-        current_timestamp : timestamp
-            the timestamp of execution
+            Cash reserved by bids goes back to the allocation, and the price of each asset with an
+            unfilled order is stepped towards the other side of the book.
 
         Returns
         -------
-        None
-        
+        released : dict
+            the released outstanding orders, still to be cancelled with cancelOrders
         """
 
         for order in self.outstanding_orders:
 
-            ## set exchange and message payload
             exchange = order[1]
-            msg_payload = CancelOrdersPayload([CancelOrdersCancellation(order[0], 1)])
-
-            ## cancel the order
-            simulation.dispatchMessage(current_timestamp, 0, "AGENT" + self.agent_id, exchange, "CANCEL_ORDERS", msg_payload)
+            asset_index = self.watching_slots[exchange]
 
             ##if order is a bid and has passed ref.rate, want to add cash we would have been bidding, increase price
             if self.outstanding_orders[order][2] == OrderDirection.Buy:
@@ -157,23 +354,94 @@ class SimpleCaseAgent:
 
                 ## set new price that we would bid
                 new_price = self.step_rate * float(self.outstanding_orders[order][0].requestPayload.price.toCentString())
-                asset_index = self.watching.index(exchange)
-                self.prices[asset_index] = new_price
+                self.setPrice(asset_index, new_price)
                     
             ## otherwise if order is an ask and has passed, then need to decrease new price
             else:
 
                 ## set new price that we would ask
                 new_price = (2-self.step_rate) * float(self.outstanding_orders[order][0].requestPayload.price.toCentString())
-                asset_index = self.watching.index(exchange)
                 if new_price > 0:
-                    self.prices[asset_index] = new_price
-
-        ## if hasn't passed ref_rate time, no need to update price here
+                    self.setPrice(asset_index, new_price)
 
-        ## remove orders from outstanding orders
+        released = self.outstanding_orders
         self.outstanding_orders = {}
 
+        return released
+
+    def cancelOrders(self, simulation, current_timestamp, orders):
+        """ cancels orders with one CANCEL_ORDERS message per exchange
+
+        Parameters
+        ----------
+        simulation : simulation object
+            The simulation object
+
+        current_timestamp : timestamp
+            the timestamp of execution
+
+        orders : iterable
+            (order id, exchange) keys of the orders to cancel
+        """
+
+        cancellations = {}
+
+        for order_id, exchange in orders:
+            cancellations.setdefault(exchange, []).append(CancelOrdersCancellation(order_id, 1))
+
+        for exchange, exchange_cancellations in cancellations.items():
+            self.dispatch(simulation, current_timestamp, exchange, "CANCEL_ORDERS", CancelOrdersPayload(exchange_cancellations))
+
+    def submitOrders(self, simulation, current_timestamp, orders, released):
+        """ cancels released orders and places new ones, cancellations first.
+
+            With order_diffing, a released order matching a new order's exchange, side and
+            price is kept resting instead of being cancelled and placed again.
+
+        Parameters
+        ----------
+        simulation : simulation object
+            The simulation object
+
+        current_timestamp : timestamp
+            the timestamp of execution
+
+        orders : list
+            (exchange, direction, price) of each new order
+
+        released : dict
+            orders returned by releaseOrders
+        """
+
+        if self.order_diffing:
+
+            ## resting orders by what they quote, the earliest of duplicates is kept
+            resting = {}
+            for order_key, order in released.items():
+                quote = (order_key[1], order[2], priceToCents(order[0].requestPayload.price))
+                resting.setdefault(quote, order_key)
+
+            new_orders = []
+            for exchange, direction, price in orders:
+
+                order_key = resting.pop((exchange, direction, priceToCents(Money(float(price)))), None)
+
+                if order_key is None:
+                    new_orders.append((exchange, direction, price))
+                else:
+                    self.outstanding_orders[order_key] = released.pop(order_key)
+                    self.kept_orders += 1
+
+            orders = new_orders
+
+        self.cancelOrders(simulation, current_timestamp, released)
+
+        for exchange, direction, price in orders:
+            if direction == OrderDirection.Buy:
+                self.submitMarketBuy(simulation, current_timestamp, exchange, price)
+            else:
+                self.submitMarketSell(simulation, current_timestamp, exchange, price)
+
 
 
     def processOrderResponse(self, current_timestamp, payload, source):
@@ -200,14 +468,13 @@ class SimpleCaseAgent:
         
     
 
-    def optimalFraction(self, weights):
+    def optimalFraction(self, weights, mkt_risk=None):
         """ calculates the fraction of wealth we should have invested in the market portfolio"""
 
         ## need to calculate the optimal portfolio return
-        ticker_indices = self.getWatchingIndices()
-        
-        mkt_exp_return = calculate_expected_return(ticker_indices, weights, self.prices, self.asset_file)
-        mkt_risk = calcPortfolioRisk(ticker_indices, weights, self.asset_file)
+        mkt_exp_return = self.model.expectedReturn(weights, self.prices)
+        if mkt_risk is None:
+            mkt_risk = self.model.portfolioRisk(weights)
 
 
         weight = (mkt_exp_return - self.risk_free_rate) / (mkt_risk * self.risk_coeff)
@@ -217,6 +484,9 @@ class SimpleCaseAgent:
     def calcHoldingsValue(self):
         """calculates the total value of the agent's current holdings, including unallocated cash """
 
+        if self.incremental:
+            return self.holdings_value + self.cash + self.allocated_cash
+
         portfolio_value = 0
 
         for asset_index in range(len(self.watching)):
@@ -263,20 +533,24 @@ class SimpleCaseAgent:
         if self.processed_this_ts == current_timestamp:
             return
         else:
-            self.processed_this_ts += 1
+            self.processed_this_ts = current_timestamp
+
+        self.evaluations += 1
 
         ## calculating whole new portfolio, need to cancel existing orders to make room
         ## and update order prices if nobody went for the submitted orders
 
-        self.zeroOutOrders(simulation, current_timestamp)
+        released = self.releaseOrders()
 
-        ## check what value of current portfolio is 
-        current_weights = calculate_current_weights(self.prices, self.shares)
-
-        optimal_weights = calculate_optimal_portfolio(self.getWatchingIndices(), self.risk_free_rate, self.prices, self.asset_file)
+        if self.incremental:
+            optimal_weights, mkt_risk = self.incrementalOptimalPortfolio()
+            self.evaluated_prices = np.asarray(self.prices, dtype=float)
+        else:
+            optimal_weights = self.model.tangencyWeights(self.prices, self.risk_free_rate)
+            mkt_risk = None
 
         ## calculate how much of total assets should be market portfolio
-        optimal_frac = self.optimalFraction(optimal_weights)
+        optimal_frac = self.optimalFraction(optimal_weights, mkt_risk)
 
         ##calculate value of total holdings
         total_value = self.calcHoldingsValue()
@@ -284,9 +558,13 @@ class SimpleCaseAgent:
         ## balance cash holdings if we can/need to
         self.balanceCashAllocation(optimal_frac, total_value)
 
+        ## new orders are collected first, so unchanged ones can be matched against released orders
+        orders = []
+
         ## iterate over each asset
-        for asset_index in range(len(current_weights)):
+        for asset_index in range(len(self.watching)):
 
+            ## recomputed per asset as buy orders reserve cash, O(1) from running state in incremental mode
             ideal_value = optimal_weights[asset_index] * optimal_frac * self.calcHoldingsValue()
 
             
@@ -297,24 +575,80 @@ class SimpleCaseAgent:
 
             if current_value - ideal_value > self.prices[asset_index] and self.shares[asset_index] > 0:
                
-                self.submitMarketSell(simulation, current_timestamp, self.watching[asset_index], self.prices[asset_index])
+                orders.append((self.watching[asset_index], OrderDirection.Sell, self.prices[asset_index]))
             
             elif ideal_value - current_value > self.prices[asset_index] and self.allocated_cash > self.prices[asset_index]:
                 
                 self.allocated_cash -= self.prices[asset_index]
-                self.submitMarketBuy(simulation, current_timestamp, self.watching[asset_index], self.prices[asset_index])
+                orders.append((self.watching[asset_index], OrderDirection.Buy, self.prices[asset_index]))
+
+        self.submitOrders(simulation, current_timestamp, orders, released)
+
 
 
 
+    def requestEvaluation(self, simulation, current_timestamp):
+        """ evaluates right away, or with coalesce set, schedules one deferred evaluation for
+            every event until it runs """
+
+        if not self.coalesce:
+            self.evaluationLoop(simulation)
+            return
+
+        if self.evaluation_pending:
+            return
+
+        ## delay 0 queues behind the rest of this timestamp's messages, once we have evaluated
+        ## at this timestamp anything further waits for the next one
+        if self.eval_quantum > 0:
+            delay = self.eval_quantum - current_timestamp % self.eval_quantum
+        else:
+            delay = 1 if self.processed_this_ts == current_timestamp else 0
+
+        simulation.dispatchGenericMessage(current_timestamp, delay, "AGENT" + self.agent_id, "AGENT" + self.agent_id, "EVALUATE", {})
+        self.evaluation_pending = 1
+
+    def processFill(self, simulation, order_key, source):
+        """ applies a fill of one of our outstanding orders to holdings and logs it """
+
+        asset_index = self.watching_slots[source]
+        exchange_id = self.exchange_ids[source]
+
+        ## order has executed, no longer outstanding
+        order_payload, _, direction = self.outstanding_orders.pop(order_key)
+        fill_price = float(order_payload.requestPayload.price.toCentString())
+
+        ## if a buy for this agent, increment shares, if a sale, decrement and add cash
+        if direction == OrderDirection.Buy:
+            fill_side = FILL_BUY
+            self.addShares(asset_index, 1)
+
+        else:
+            fill_side = FILL_SELL
+            self.addShares(asset_index, -1)
+            self.allocated_cash += fill_price
+
+        self.trade_log.record(simulation.currentTimestamp(), self.agent_number, exchange_id, fill_side,
+                              priceToCents(order_payload.requestPayload.price), order_key[0])
+
+        ## legacy per-agent order id lists, only kept for the json data format
+        if self.history_format == "json":
+            trades = self.buy_trades if fill_side == FILL_BUY else self.sell_trades
+            trades[exchange_id].append(order_key[0])
+
+        self.updateData(simulation.currentTimestamp(), fill_side, fill_price)
 
     def processOrderEvent(self, simulation, payload, source):
         """ updates information based on trade event """
 
-        if int(source[5:]) not in self.sell_trades:
-            self.sell_trades[int(source[5:])] = []
+        if self.history_format == "json":
+            exchange_id = self.exchange_ids[source]
 
-        if int(source[5:]) not in self.buy_trades:
-            self.buy_trades[int(source[5:])] = []
+            if exchange_id not in self.sell_trades:
+                self.sell_trades[exchange_id] = []
+
+            if exchange_id not in self.buy_trades:
+                self.buy_trades[exchange_id] = []
 
         ## two cases, either is one of our orders, or it isn't, need to check case that we are either resting or agressing order
 
@@ -326,62 +660,50 @@ class SimpleCaseAgent:
         ## B: this is the one the order was submitted with because it isn't updated by anything in the interim. 
         if (order_id_A, source) in self.outstanding_orders:
 
-            asset_index = self.watching.index(source)
-
-            ## if a buy for this agent, increment shares, if a sale, decrement and add cash
-            if self.outstanding_orders[(order_id_A, source)][2] == OrderDirection.Buy:
-                #add to self.sell
-                self.buy_trades[int(source[5:])].append(order_id_A)
-                self.shares[asset_index] += 1
-
-            else:
-                #add to self.sell
-                self.sell_trades[int(source[5:])].append(order_id_A)
-                self.shares[asset_index] -= 1
-                self.allocated_cash += float(self.outstanding_orders[(order_id_A, source)][0].requestPayload.price.toCentString())
-
-            ## order has executed, no longer outstanding 
-            self.outstanding_orders.pop((order_id_A, source))
-            self.updateData()
+            self.processFill(simulation, (order_id_A, source), source)
 
         elif (order_id_B, source) in self.outstanding_orders:
 
-            #add to self.buy trades
+            self.processFill(simulation, (order_id_B, source), source)
 
-            asset_index = self.watching.index(source)
+        ## alternative case: not this agent's order, need to update price and evaluate
+        else:
+            new_price = float(payload.trade.price().toCentString())
+            asset_index = self.watching_slots[source]
 
-            ## if a buy for this agent, increment shares, if a sale, decrement and add cash
-            if self.outstanding_orders[(order_id_B, source)][2] == OrderDirection.Buy:
-                #add to self.buy_trades
-                self.buy_trades[int(source[5:])].append(order_id_B)
-                self.shares[asset_index] += 1
+            if self.price_threshold > 0 and not self.priceNotified(asset_index, new_price):
+                return
 
-            else:
-                #add to self.sell_trades
-                self.sell_trades[int(source[5:])].append(order_id_B)
-                self.shares[asset_index] -= 1
+            self.setPrice(asset_index, new_price)
 
-                self.allocated_cash += float(self.outstanding_orders[(order_id_B, source)][0].requestPayload.price.toCentString())
+            ## trade barely moved the price we last evaluated at, target portfolio is unchanged
+            if self.incremental and not self.priceMoved(asset_index):
+                self.skipped_evaluations += 1
+                return
 
-            ## order has executed, no longer outstanding 
-            self.outstanding_orders.pop((order_id_B, source))
-            self.updateData()
 
 
+        ## now that share counts or prices are updated, reevaluate 
 
-        ## alternative case: not this agent's order, need to update price and evaluate
-        else:
-            new_price = float(payload.trade.price().toCentString())
-            asset_index = self.watching.index(source)
+        self.requestEvaluation(simulation, simulation.currentTimestamp())
 
-            self.prices[asset_index] = new_price
 
+    def processSnapshot(self, simulation, payload):
+        """ updates prices from a PriceDataAgent snapshot, evaluating once if any moved enough """
 
+        moved = False
 
-        ## now that share counts or prices are updated, reevaluate 
+        for exchange, new_price in payload["prices"].items():
+
+            asset_index = self.watching_slots.get(exchange)
+            if asset_index is None or not self.priceNotified(asset_index, new_price):
+                continue
 
-        self.evaluationLoop(simulation)
+            self.setPrice(asset_index, new_price)
+            moved = True
 
+        if moved:
+            self.requestEvaluation(simulation, simulation.currentTimestamp())
 
     def receiveMessage(self, simulation, type, payload, source):
         """Agent Behavior Logic """
@@ -395,9 +717,7 @@ class SimpleCaseAgent:
         ## subscribe to trades that occur in "watching"
         if type == "EVENT_SIMULATION_START":
 
-            for ticker in self.watching:
-                #print("AGENT %s submitting a request to subscribe to asset %s" % (self.agent_id, ticker) )
-                simulation.dispatchMessage(current_timestamp, 0, "AGENT" + self.agent_id, ticker, "SUBSCRIBE_EVENT_TRADE", EmptyPayload())
+            self.subscribe(simulation, current_timestamp)
 
             self.evaluationLoop(simulation)
 
@@ -409,13 +729,25 @@ class SimpleCaseAgent:
         ## if receiving a wakeup message, should eval outstanding orders
         if type == "WAKE_UP":
             self.wakeup_set = 0
+            self.requestEvaluation(simulation, current_timestamp)
+
+        ## deferred evaluation covering every event since it was requested
+        if type == "EVALUATE":
+            self.evaluation_pending = 0
             self.evaluationLoop(simulation)
 
         ## if there is an event trade, update our given price, run evaluative loop
         if type == "EVENT_TRADE":
 
+            self.events_received += 1
             self.processOrderEvent(simulation, payload, source)
 
+        ## batched last traded prices, in place of other agents' trades
+        if type == "EVENT_PRICE_SNAPSHOT":
+
+            self.events_received += 1
+            self.processSnapshot(simulation, payload)
+
         if type == "EVENT_SIMULATION_STOP":
             ## if simulation is ending, save agent to file
             with open("Agents/Agent" + self.agent_id + "end" + ".json", "w") as f:
@@ -424,10 +756,10 @@ class SimpleCaseAgent:
 
                 json.dump(agent_dict, f)
 
-            with open("SimulationData/Data" + self.agent_id + ".json", "w") as f:
+            self.saveHistory()
 
-                data_dict = {"holdings_data" : self.share_data, "return data" : self.return_data, "risk data" : self.variance_data, "sell trades" : self.sell_trades, "buy trades" : self.buy_trades}
-                json.dump(data_dict, f)
+            if self.profile is not None:
+                self.profile.save(self.messages_sent)
 
         if not self.wakeup_set:
                 simulation.dispatchGenericMessage(current_timestamp, self.ref_rate, "AGENT" + self.agent_id, "AGENT" + self.agent_id, "WAKE_UP", {})
@@ -0,0 +1,415 @@
+"""
+Summary: SimpleCasePopulation, many SimpleCaseAgent traders run as a single
+         simulator agent, their state held in numpy arrays
+
+         Notes:
+
+         - the traders are rows first_agent .. first_agent + num_agents - 1
+         of the packed endowment store, trading as AGENT<row> in the trade
+         log. every trader uses the population's asset_file
+
+         - each trader follows SimpleCaseAgent with coalesce set: trades and
+         fills only update its prices and shares, and traders with new
+         information are evaluated at the end of the timestamp, in the order
+         they were woken. every trader is also woken each refresh_rate
+
+         - an evaluation runs releaseOrders, balanceCashAllocation and the
+         order loop of SimpleCaseAgent for every woken trader at once, with
+         traders sharing a watching mask solved as one batch. orders go out
+         trader by trader in the sequence separate agents would send them
+
+         - no per-trader history, fills go to the shared trade log and final
+         holdings plus counters to SimulationData/<name>.npz
+
+"""
+
+from thesimulator import *
+from portfolio import *
+from tradelog import *
+from history import FILL_BUY, FILL_SELL
+from agentparams import optionalParam
+from profiler import profileAgent, profilingEnabled
+import numpy as np
+
+
+NOT_DUE = np.iinfo(np.int64).max
+
+
+class SimpleCasePopulation:
+
+    def __init__(self):
+        """Constructor for SimpleCasePopulation"""
+        pass
+
+    def configure(self, params):
+
+        print("running configure")
+
+        self.ref_rate = int(params['refresh_rate'])
+        self.step_rate = float(params["step_rate"])
+        self.risk_free_rate = float(params["rfr"])
+        self.eval_quantum = int(optionalParam(params, "eval_quantum", 0))
+        self.asset_file = str(params["asset_file"])
+
+        first_agent = int(params["first_agent"])
+        num_agents = int(params["num_agents"])
+        self.trader_ids = np.arange(first_agent, first_agent + num_agents)
+
+        rows = np.load(str(params["endowment_file"]), mmap_mode="r")[first_agent:first_agent + num_agents]
+
+        ## one row per trader, one column per asset of the asset dictionary
+        self.cash = np.array(rows["capital"], dtype=float)
+        self.allocated_cash = np.zeros(num_agents)
+        self.prices = np.array(rows["prices"], dtype=float)
+        self.shares = np.array(rows["shares"], dtype=np.int64)
+        self.watching = np.array(rows["watching"], dtype=bool)
+
+        ## older stores have no risk coefficients, everyone then shares the risk_coeff param
+        if "risk_coeff" in rows.dtype.names:
+            self.risk_coeffs = np.array(rows["risk_coeff"], dtype=float)
+        else:
+            self.risk_coeffs = np.full(num_agents, float(params["risk_coeff"]))
+
+        self.exchanges = loadAssetData(self.asset_file).assets
+        self.exchange_slots = {exchange : slot for slot, exchange in enumerate(self.exchanges)}
+        self.exchange_ids = [int(exchange[5:]) for exchange in self.exchanges]
+
+        ## traders watching each asset, and traders grouped by watching mask, one model per group
+        self.watchers = [np.flatnonzero(self.watching[:, slot]) for slot in range(len(self.exchanges))]
+
+        masks, self.group_of = np.unique(self.watching, axis=0, return_inverse=True)
+        self.group_of = self.group_of.reshape(-1)
+        self.group_assets = [np.flatnonzero(mask) for mask in masks]
+        self.group_models = [getMeanVarianceModel(assets.tolist(), self.asset_file) for assets in self.group_assets]
+
+        ## outstanding orders of each trader, (order id, exchange) -> (slot, direction, price, cents),
+        ## and the owner of every outstanding order
+        self.outstanding_orders = [{} for _ in range(num_agents)]
+        self.order_owners = {}
+
+        ## traders whose orders await confirmation, per exchange, in sending order
+        self.unconfirmed = {exchange : [] for exchange in self.exchanges}
+        self.unconfirmed_next = {exchange : 0 for exchange in self.exchanges}
+
+        ## evaluation timestamp -> the order each trader due then was woken in, NOT_DUE for the others
+        self.due = {}
+        self.woken = 0
+        self.processed_this_ts = np.full(num_agents, -1, dtype=np.int64)
+        self.wakeup_set = 0
+
+        self.events_received = 0
+        self.evaluations = 0
+        self.messages_sent = {}
+
+        self.trade_log = openTradeLog(str(optionalParam(params, "trade_log", "SimulationData/Trades.bin")))
+
+        ## last in configure, see SimpleCaseAgent.configure
+        if profilingEnabled():
+            profileAgent(self)
+
+    def dispatch(self, simulation, current_timestamp, target, type, payload):
+        """ dispatches a message from the population, counting it by type """
+
+        self.messages_sent[type] = self.messages_sent.get(type, 0) + 1
+
+        simulation.dispatchMessage(current_timestamp, 0, self.name(), target, type, payload)
+
+    def requestEvaluation(self, simulation, current_timestamp, traders):
+        """ schedules an evaluation of traders, each evaluated at most once per timestamp,
+            or per eval_quantum if set """
+
+        if self.eval_quantum > 0:
+            schedule = [(current_timestamp + self.eval_quantum - current_timestamp % self.eval_quantum, traders)]
+        else:
+            ## traders already evaluated at this timestamp wait for the next one
+            evaluated = self.processed_this_ts[traders] == current_timestamp
+            schedule = [(current_timestamp, traders[~evaluated]), (current_timestamp + 1, traders[evaluated])]
+
+        for due, members in schedule:
+
+            if len(members) == 0:
+                continue
+
+            if due not in self.due:
+                self.due[due] = np.full(len(self.trader_ids), NOT_DUE, dtype=np.int64)
+                simulation.dispatchGenericMessage(current_timestamp, due - current_timestamp, self.name(), self.name(),
+                                                  "EVALUATE", {})
+
+            ## traders already due keep their place
+            order = self.due[due]
+            members = members[order[members] == NOT_DUE]
+            order[members] = self.woken + np.arange(len(members))
+            self.woken += len(members)
+
+    def releaseOrders(self, traders):
+        """ takes the outstanding orders of traders off the books as SimpleCaseAgent.releaseOrders
+            does, returning the (order id, exchange) keys to cancel for each trader """
+
+        released = []
+        order_traders, slots, buys, prices = [], [], [], []
+
+        for trader in traders.tolist():
+
+            orders = self.outstanding_orders[trader]
+            released.append(list(orders))
+
+            for order_key, (slot, direction, price, _) in orders.items():
+                del self.order_owners[order_key]
+                order_traders.append(trader)
+                slots.append(slot)
+                buys.append(direction == OrderDirection.Buy)
+                prices.append(price)
+
+            self.outstanding_orders[trader] = {}
+
+        if not order_traders:
+            return released
+
+        order_traders = np.array(order_traders)
+        slots = np.array(slots)
+        buys = np.array(buys)
+        prices = np.array(prices)
+
+        ## bids hand their reserved cash back, in order
+        np.add.at(self.allocated_cash, order_traders[buys], prices[buys])
+
+        ## step unfilled bids up and asks down, a later order on the same asset decides its price
+        new_prices = np.where(buys, self.step_rate * prices, (2 - self.step_rate) * prices)
+        update = buys | (new_prices > 0)
+
+        cells = order_traders[update] * len(self.exchanges) + slots[update]
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+
+        self.prices[order_traders[update][last], slots[update][last]] = new_prices[update][last]
+
+        return released
+
+    def optimalPortfolios(self, traders):
+        """ returns the tangency weights (zero for unwatched assets) and optimal market fraction
+            of each trader, solved in one batch per watching mask """
+
+        weights = np.zeros((len(traders), len(self.exchanges)))
+        fractions = np.zeros(len(traders))
+        groups = self.group_of[traders]
+
+        for group in np.unique(groups):
+
+            rows = np.flatnonzero(groups == group)
+            members = traders[rows]
+            assets = self.group_assets[group]
+
+            batch = batchOptimalPortfolios(self.group_models[group], self.prices[np.ix_(members, assets)],
+                                           self.risk_free_rate, self.risk_coeffs[members])
+
+            weights[np.ix_(rows, assets)] = batch.weights
+            fractions[rows] = batch.fractions
+
+        return weights, fractions
+
+    def holdingsValue(self, traders):
+        """ total value of each trader's watched holdings plus all its cash """
+
+        positions = np.where(self.watching[traders], self.prices[traders] * self.shares[traders], 0)
+
+        return np.sum(positions, axis=1) + self.cash[traders] + self.allocated_cash[traders]
+
+    def balanceCashAllocation(self, traders, optimal_fracs, total_values):
+        """ SimpleCaseAgent.balanceCashAllocation for every trader at once """
+
+        cash = self.cash[traders]
+        allocated = self.allocated_cash[traders]
+        target = (1 - optimal_fracs) * total_values
+
+        ## more cash than the risk free share needs, move the excess to the allocation
+        excess = cash > target
+
+        ## too little, take it from the allocation if it holds enough, otherwise take all of it
+        covered = ~excess & (cash < target) & (allocated > target - cash)
+        drained = ~excess & ~covered & (cash < target)
+
+        new_allocated = np.where(excess, allocated + (cash - target), allocated)
+        new_allocated = np.where(covered, allocated - (target - cash), new_allocated)
+        new_allocated = np.where(drained, 0, new_allocated)
+
+        new_cash = np.where(excess | covered, target, cash)
+        new_cash = np.where(drained, cash + allocated, new_cash)
+
+        self.cash[traders] = new_cash
+        self.allocated_cash[traders] = new_allocated
+
+    def evaluate(self, simulation, traders):
+        """ runs SimpleCaseAgent.evaluationLoop for every trader in traders, in order """
+
+        current_timestamp = simulation.currentTimestamp()
+
+        traders = traders[self.processed_this_ts[traders] != current_timestamp]
+        if len(traders) == 0:
+            return
+
+        self.processed_this_ts[traders] = current_timestamp
+        self.evaluations += len(traders)
+
+        released = self.releaseOrders(traders)
+
+        optimal_weights, optimal_fracs = self.optimalPortfolios(traders)
+
+        self.balanceCashAllocation(traders, optimal_fracs, self.holdingsValue(traders))
+
+        total_values = self.holdingsValue(traders)
+        allocated = self.allocated_cash[traders]
+
+        ## +1 buy, -1 sell, 0 nothing, per trader and asset. assets are visited in order as
+        ## every buy reserves cash and lowers the total for the assets after it
+        directions = np.zeros((len(traders), len(self.exchanges)), dtype=np.int8)
+
+        for slot in range(len(self.exchanges)):
+
+            watched = self.watching[traders, slot]
+            prices = self.prices[traders, slot]
+            shares = self.shares[traders, slot]
+
+            ideal_values = optimal_weights[:, slot] * optimal_fracs * total_values
+            current_values = shares * prices
+
+            sells = watched & (current_values - ideal_values > prices) & (shares > 0)
+            buys = watched & ~sells & (ideal_values - current_values > prices) & (allocated > prices)
+
+            allocated = np.where(buys, allocated - prices, allocated)
+            total_values = np.where(buys, total_values - prices, total_values)
+
+            directions[sells, slot] = -1
+            directions[buys, slot] = 1
+
+        self.allocated_cash[traders] = allocated
+
+        self.submitOrders(simulation, current_timestamp, traders, released, directions)
+
+    def submitOrders(self, simulation, current_timestamp, traders, released, directions):
+        """ sends each trader's cancellations, one message per exchange, then its new orders """
+
+        for row, trader in enumerate(traders.tolist()):
+
+            cancellations = {}
+            for order_id, exchange in released[row]:
+                cancellations.setdefault(exchange, []).append(CancelOrdersCancellation(order_id, 1))
+
+            for exchange, exchange_cancellations in cancellations.items():
+                self.dispatch(simulation, current_timestamp, exchange, "CANCEL_ORDERS", CancelOrdersPayload(exchange_cancellations))
+
+            for slot in np.flatnonzero(directions[row]).tolist():
+
+                direction = OrderDirection.Buy if directions[row, slot] > 0 else OrderDirection.Sell
+                exchange = self.exchanges[slot]
+
+                payload = PlaceOrderLimitPayload(direction, 1, Money(float(self.prices[trader, slot])))
+                self.dispatch(simulation, current_timestamp, exchange, "PLACE_ORDER_LIMIT", payload)
+                self.unconfirmed[exchange].append(trader)
+
+    def processOrderResponse(self, payload, source):
+        """ records a confirmed order as outstanding for the trader that sent it """
+
+        ## exchanges confirm orders in the order they were sent
+        trader = self.unconfirmed[source][self.unconfirmed_next[source]]
+        self.unconfirmed_next[source] += 1
+
+        if self.unconfirmed_next[source] == len(self.unconfirmed[source]):
+            self.unconfirmed[source] = []
+            self.unconfirmed_next[source] = 0
+
+        price = payload.requestPayload.price
+        order_key = (payload.id, source)
+
+        self.outstanding_orders[trader][order_key] = (self.exchange_slots[source], payload.requestPayload.direction,
+                                                      float(price.toCentString()), priceToCents(price))
+        self.order_owners[order_key] = trader
+
+    def processFill(self, simulation, order_key, source):
+        """ applies a fill of an outstanding order to its trader's holdings and logs it """
+
+        trader = self.order_owners.pop(order_key)
+        slot, direction, price, cents = self.outstanding_orders[trader].pop(order_key)
+
+        if direction == OrderDirection.Buy:
+            fill_side = FILL_BUY
+            self.shares[trader, slot] += 1
+
+        else:
+            fill_side = FILL_SELL
+            self.shares[trader, slot] -= 1
+            self.allocated_cash[trader] += price
+
+        self.trade_log.record(simulation.currentTimestamp(), self.trader_ids[trader], self.exchange_ids[slot], fill_side,
+                              cents, order_key[0])
+
+        return trader
+
+    def processOrderEvent(self, simulation, payload, source):
+        """ applies a trade to every trader watching its asset: fills to their owners,
+            the new price to everyone else, then wakes them all """
+
+        slot = self.exchange_slots[source]
+        filled = []
+
+        for order_id in (payload.trade.aggressingOrderID(), payload.trade.restingOrderID()):
+            if (order_id, source) in self.order_owners:
+                filled.append(self.processFill(simulation, (order_id, source), source))
+
+        watchers = self.watchers[slot]
+        others = watchers[~np.isin(watchers, filled)] if filled else watchers
+
+        self.prices[others, slot] = float(payload.trade.price().toCentString())
+
+        self.requestEvaluation(simulation, simulation.currentTimestamp(), watchers)
+
+    def saveState(self):
+        """ writes final holdings and counters to SimulationData/<name>.npz """
+
+        self.trade_log.flush()
+
+        np.savez("SimulationData/" + self.name() + ".npz", trader_ids=self.trader_ids, cash=self.cash,
+                 allocated_cash=self.allocated_cash, prices=self.prices, shares=self.shares, watching=self.watching,
+                 events_received=self.events_received, evaluations=self.evaluations,
+                 message_types=np.array(list(self.messages_sent), dtype=str),
+                 message_counts=np.array(list(self.messages_sent.values()), dtype=np.int64))
+
+    def receiveMessage(self, simulation, type, payload, source):
+        """Population Behavior Logic """
+
+        current_timestamp = simulation.currentTimestamp()
+
+        ## one subscription per asset anyone watches, then everyone evaluates
+        if type == "EVENT_SIMULATION_START":
+
+            for slot, exchange in enumerate(self.exchanges):
+                if len(self.watchers[slot]):
+                    self.dispatch(simulation, current_timestamp, exchange, "SUBSCRIBE_EVENT_TRADE", EmptyPayload())
+
+            self.evaluate(simulation, np.arange(len(self.trader_ids)))
+
+        if type == "RESPONSE_PLACE_ORDER_LIMIT":
+            self.processOrderResponse(payload, source)
+
+        if type == "WAKE_UP":
+            self.wakeup_set = 0
+            self.requestEvaluation(simulation, current_timestamp, np.arange(len(self.trader_ids)))
+
+        if type == "EVALUATE":
+            order = self.due.pop(current_timestamp)
+            traders = np.flatnonzero(order != NOT_DUE)
+            self.evaluate(simulation, traders[np.argsort(order[traders], kind="stable")])
+
+        if type == "EVENT_TRADE":
+            self.events_received += 1
+            self.processOrderEvent(simulation, payload, source)
+
+        if type == "EVENT_SIMULATION_STOP":
+            self.saveState()
+
+        if not self.wakeup_set:
+                simulation.dispatchGenericMessage(current_timestamp, self.ref_rate, self.name(), self.name(), "WAKE_UP", {})
+                self.wakeup_set = 1
+
+
+
+obj = SimpleCasePopulation()
@@ -0,0 +1,20 @@
+"""
+Summary: helpers for reading the parameters the simulator passes to an
+         agent's configure, shared by SimpleCaseAgent and
+         SimpleCasePopulation
+
+         Notes:
+
+         - params maps the attributes of the agent's XML element to their
+         values, as strings
+
+"""
+
+
+def optionalParam(params, key, default):
+    """ returns params[key] if the XML element sets it, otherwise default """
+
+    try:
+        return params[key]
+    except KeyError:
+        return default
@@ -0,0 +1,745 @@
+"""
+Summary: post-run analysis. A whole run is loaded into columnar numpy
+         arrays in one pass, then price paths, wealth, weight drift,
+         turnover and convergence to the CAPM tangency portfolio are
+         computed for every agent at once
+
+         Notes:
+
+         - a run is the working directory the simulation ran in: the
+         scenario XML, the agents' endowments and Agents/AgentNend.json,
+         SimulationData/DataN.npz (or legacy DataN.json, or history spill
+         files), SimulationData/Trades.bin, the TradeLogAgents'
+         <exchange>_LOGGER.csv files and the final state of any
+         SimpleCasePopulation, SimulationData/POPULATIONn.npz
+
+         - agents are rows in agent id order, assets are columns in asset
+         dictionary order. unwatched assets hold 0 shares and nan prices.
+         history rows of all agents are concatenated, those of the i-th
+         agent are history_offsets[i]:history_offsets[i + 1]
+
+         - the per-agent files are read on a thread pool, most of the time
+         goes to file I/O
+
+         - the parsed arrays are cached in SimulationData/Analysis.npz along
+         with the size and modification time of every input, loading an
+         unchanged run again only reads the cache
+
+         - usage: python analysis.py <run dir> [--scenario scenario.xml]
+         [--no-cache] [--output summary.json]
+
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import warnings
+
+import numpy as np
+
+from history import HistoryReader
+from localsim.engine import readScenario
+from portfolio import batchOptimalPortfolios, getMeanVarianceModel, loadAssetData
+from tradelog import TRADE_DTYPE, loadTradeLog
+
+
+CACHE_FILE = "SimulationData/Analysis.npz"
+
+## bump when the cached arrays change, older caches are then rebuilt
+CACHE_VERSION = 1
+
+AGENT_TAG = "SimpleCaseAgent"
+POPULATION_TAG = "SimpleCasePopulation"
+
+HISTORY_COLUMNS = ("timestamp", "shares", "exp_return", "risk", "side", "price")
+
+
+class RunData:
+    """ columnar contents of one finished run
+
+    Attributes
+    ----------
+    run_dir : string
+        working directory of the run
+
+    assets : nparray
+        asset names, in asset dictionary order
+
+    asset_files : nparray
+        asset dictionaries the agents used, relative to run_dir
+
+    agent_ids : nparray
+        (num_agents) agent ids, sorted
+
+    asset_file : nparray
+        (num_agents) index into asset_files of each agent's dictionary
+
+    capital, rfr, risk_coeff : nparray
+        (num_agents) starting cash, risk free rate and risk aversion
+
+    watching : nparray
+        (num_agents x num_assets) boolean mask of watched assets
+
+    initial_prices, initial_shares : nparray
+        (num_agents x num_assets) endowment
+
+    final_prices, final_shares : nparray
+        (num_agents x num_assets) believed prices and holdings at the end
+
+    fills : nparray
+        TRADE_DTYPE records of every fill in SimulationData/Trades.bin
+
+    trade_asset, trade_timestamp, trade_price, trade_volume : nparray
+        every trade on the exchanges, prices in dollars
+
+    history_offsets : nparray
+        (num_agents + 1) start of each agent's rows in the history columns
+
+    history_timestamp, history_shares, history_exp_return, history_risk,
+    history_side, history_price : nparray
+        concatenated history of every agent
+    """
+
+    def __init__(self, run_dir, arrays):
+
+        self.run_dir = run_dir
+        self.arrays = arrays
+
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        self.asset_index = {str(name) : num for num, name in enumerate(self.assets)}
+
+    def __len__(self):
+
+        return len(self.agent_ids)
+
+    def agentRows(self, agent_ids):
+        """ returns the rows of the given agent ids """
+
+        return np.searchsorted(self.agent_ids, agent_ids)
+
+    def agentHistory(self, agent_id):
+        """ returns one agent's history columns, keyed by column name """
+
+        row = int(self.agentRows(agent_id))
+        start, end = self.history_offsets[row], self.history_offsets[row + 1]
+
+        return {name : getattr(self, "history_" + name)[start:end] for name in HISTORY_COLUMNS}
+
+    def save(self, path, stamp):
+        """ writes the arrays to path along with the stamp of the inputs they were read from """
+
+        np.savez(path, cache_version=CACHE_VERSION, source_stamp=stamp, **self.arrays)
+
+
+def _sourceStamp(run_dir, scenario):
+    """ returns a string identifying the current state of every input of a run """
+
+    entries = [(scenario, os.stat(scenario).st_size, os.stat(scenario).st_mtime_ns)]
+
+    for directory in ("Agents", "SimulationData"):
+
+        path = os.path.join(run_dir, directory)
+        if not os.path.isdir(path):
+            continue
+
+        for entry in os.scandir(path):
+            if entry.is_file() and entry.name != os.path.basename(CACHE_FILE):
+                stat = entry.stat()
+                entries.append((directory + "/" + entry.name, stat.st_size, stat.st_mtime_ns))
+
+    return json.dumps(sorted(entries))
+
+def _readScenarioAgents(scenario):
+    """ returns the parameters of the SimpleCaseAgent and SimpleCasePopulation elements of a scenario """
+
+    agents, populations = [], []
+    elements = readScenario(scenario)
+    next(elements)
+
+    for tag, params in elements:
+        if tag == AGENT_TAG:
+            agents.append(params)
+        elif tag == POPULATION_TAG:
+            populations.append(params)
+
+    return agents, populations
+
+def _placeColumns(names, values, asset_index, num_assets, fill):
+    """ returns a num_assets row with values placed at the columns of the named assets """
+
+    row = np.full(num_assets, fill, dtype=np.asarray(fill).dtype)
+    row[[asset_index[name] for name in names]] = values
+
+    return row
+
+def _readAgentEnd(run_dir, agent_id, asset_index, num_assets):
+    """ returns (watching, final prices, final shares) of one agent from its AgentNend.json """
+
+    with open(os.path.join(run_dir, "Agents", "Agent%dend.json" % agent_id)) as f:
+        data = json.load(f)
+
+    return (_placeColumns(data["watching"], True, asset_index, num_assets, False),
+            _placeColumns(data["watching"], data["prices"], asset_index, num_assets, np.nan),
+            _placeColumns(data["watching"], data["shares"], asset_index, num_assets, np.int64(0)))
+
+def _readAgentStart(run_dir, agent_id, asset_index, num_assets):
+    """ returns (initial prices, initial shares) of one agent from its AgentN.json endowment """
+
+    with open(os.path.join(run_dir, "Agents", "Agent%d.json" % agent_id)) as f:
+        data = json.load(f)
+
+    return (_placeColumns(data["watching"], data["prices"], asset_index, num_assets, np.nan),
+            _placeColumns(data["watching"], data["shares"], asset_index, num_assets, np.int64(0)))
+
+def _readAgentHistory(run_dir, agent_id, num_watched):
+    """ returns one agent's history columns from DataN.npz or DataN.json, None if they were spilled """
+
+    data_dir = os.path.join(run_dir, "SimulationData")
+    npz_path = os.path.join(data_dir, "Data%d.npz" % agent_id)
+
+    ## only the columns are read, not the counters saved alongside them
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as data:
+            if "timestamp" not in data.files:
+                return None
+            return {name : data[name] for name in HISTORY_COLUMNS}
+
+    json_path = os.path.join(data_dir, "Data%d.json" % agent_id)
+    if not os.path.exists(json_path):
+        return {name : np.zeros((0, num_watched) if name == "shares" else 0) for name in HISTORY_COLUMNS}
+
+    ## legacy json history has no timestamps or fill details
+    with open(json_path) as f:
+        data = json.load(f)
+
+    size = len(data["holdings_data"])
+
+    return {"timestamp" : np.full(size, -1, dtype=np.int64),
+            "shares" : np.asarray(data["holdings_data"], dtype=np.int64).reshape(size, num_watched),
+            "exp_return" : np.asarray(data["return data"], dtype=float), "risk" : np.asarray(data["risk data"], dtype=float),
+            "side" : np.zeros(size, dtype=np.int8), "price" : np.full(size, np.nan)}
+
+def _readSpilledHistory(run_dir, agent_ids):
+    """ returns {agent id : history columns} of agents whose history was spilled, per-agent or shared files """
+
+    data_dir = os.path.join(run_dir, "SimulationData")
+    histories = {}
+
+    shared_path = os.path.join(data_dir, "History.bin")
+    if os.path.exists(shared_path):
+
+        records = HistoryReader(shared_path).records
+
+        ## one stable sort groups every agent's rows, in the order they were written
+        order = np.argsort(records["agent"], kind="stable")
+        agents = records["agent"][order]
+        starts = np.searchsorted(agents, agent_ids, side="left")
+        ends = np.searchsorted(agents, agent_ids, side="right")
+
+        for agent_id, start, end in zip(agent_ids, starts, ends):
+            if end > start:
+                rows = records[order[start:end]]
+                histories[int(agent_id)] = {name : np.array(rows[name]) for name in HISTORY_COLUMNS}
+
+    for agent_id in agent_ids:
+        path = os.path.join(data_dir, "History%d.bin" % agent_id)
+        if os.path.exists(path):
+            reader = HistoryReader(path)
+            histories[int(agent_id)] = {name : np.array(reader.column(name)) for name in HISTORY_COLUMNS}
+
+    return histories
+
+def _readExchangeTrades(run_dir, asset_index):
+    """ returns (asset, timestamp, price, volume) of every trade in the <exchange>_LOGGER.csv files """
+
+    data_dir = os.path.join(run_dir, "SimulationData")
+    columns = ([], [], [], [])
+
+    for name in sorted(os.listdir(data_dir)):
+
+        exchange = name[:-len("_LOGGER.csv")]
+        if not name.endswith("_LOGGER.csv") or exchange not in asset_index:
+            continue
+
+        ## exchanges that never traded leave a header only
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            table = np.loadtxt(os.path.join(data_dir, name), delimiter=",", skiprows=1, usecols=(0, 4, 5), ndmin=2)
+
+        columns[0].append(np.full(len(table), asset_index[exchange], dtype=np.int64))
+        columns[1].append(table[:, 0].astype(np.int64))
+        columns[2].append(table[:, 2])
+        columns[3].append(table[:, 1].astype(np.int64))
+
+    if not columns[0]:
+        return None
+
+    return tuple(np.concatenate(column) for column in columns)
+
+def _parseRun(run_dir, scenario, workers):
+    """ reads every input of a run, returning the arrays of a RunData """
+
+    agent_params, population_params = _readScenarioAgents(scenario)
+
+    asset_files = sorted({params["asset_file"] for params in agent_params + population_params})
+    assets = loadAssetData(os.path.join(run_dir, asset_files[0])).assets
+    asset_index = {name : num for num, name in enumerate(assets)}
+    num_assets = len(assets)
+
+    ## one row per trader, SimpleCaseAgents first, then the members of each population
+    ids, capital, rfr, risk_coeff, asset_file = [], [], [], [], []
+
+    for params in agent_params:
+        ids.append(int(params["name"][5:]))
+        capital.append(float(params["capital"]))
+        rfr.append(float(params["rfr"]))
+        risk_coeff.append(float(params["risk_coeff"]))
+        asset_file.append(asset_files.index(params["asset_file"]))
+
+    num_single = len(ids)
+    endowment_files = {params["endowment_file"] for params in agent_params if "endowment_file" in params}
+    endowment_files |= {params["endowment_file"] for params in population_params}
+    endowments = {path : np.load(os.path.join(run_dir, path), mmap_mode="r") for path in endowment_files}
+
+    population_ends = []
+    for params in population_params:
+        first, count = int(params["first_agent"]), int(params["num_agents"])
+        rows = endowments[params["endowment_file"]][first:first + count]
+        ids.extend(range(first, first + count))
+        capital.extend(rows["capital"])
+        rfr.extend([float(params["rfr"])] * count)
+        risk_coeff.extend(rows["risk_coeff"] if "risk_coeff" in rows.dtype.names else [float(params["risk_coeff"])] * count)
+        asset_file.extend([asset_files.index(params["asset_file"])] * count)
+        population_ends.append(np.load(os.path.join(run_dir, "SimulationData", params["name"] + ".npz")))
+
+    ids = np.asarray(ids, dtype=np.int64)
+    num_agents = len(ids)
+
+    initial_prices = np.full((num_agents, num_assets), np.nan)
+    initial_shares = np.zeros((num_agents, num_assets), dtype=np.int64)
+    final_prices = np.full((num_agents, num_assets), np.nan)
+    final_shares = np.zeros((num_agents, num_assets), dtype=np.int64)
+    watching = np.zeros((num_agents, num_assets), dtype=bool)
+
+    ## packed endowments are read in one gather per store
+    single_params = np.asarray([params.get("endowment_file", "") for params in agent_params], dtype=str)
+    for path, records in endowments.items():
+        rows = np.flatnonzero(single_params == path)
+        initial_prices[rows] = records["prices"][ids[rows]]
+        initial_shares[rows] = records["shares"][ids[rows]]
+
+    offset = num_single
+    for params, end in zip(population_params, population_ends):
+        rows = np.arange(offset, offset + len(end["trader_ids"]))
+        records = endowments[params["endowment_file"]][ids[rows]]
+        initial_prices[rows], initial_shares[rows] = records["prices"], records["shares"]
+        final_prices[rows], final_shares[rows], watching[rows] = end["prices"], end["shares"], end["watching"]
+        offset += len(rows)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+
+        json_rows = np.flatnonzero(single_params[:num_single] == "")
+        for row, start in zip(json_rows, pool.map(lambda row: _readAgentStart(run_dir, ids[row], asset_index, num_assets),
+                                                   json_rows)):
+            initial_prices[row], initial_shares[row] = start
+
+        for row, end in enumerate(pool.map(lambda agent_id: _readAgentEnd(run_dir, agent_id, asset_index, num_assets),
+                                           ids[:num_single])):
+            watching[row], final_prices[row], final_shares[row] = end
+
+        histories = list(pool.map(lambda row: _readAgentHistory(run_dir, ids[row], int(watching[row].sum())),
+                                  range(num_single)))
+
+    ## populations keep no history
+    spilled = _readSpilledHistory(run_dir, ids[[row for row, history in enumerate(histories) if history is None]])
+    histories = [history if history is not None else spilled.get(int(ids[row]))
+                 for row, history in enumerate(histories)]
+    histories += [None] * (num_agents - num_single)
+
+    lengths = np.array([0 if history is None else len(history["timestamp"]) for history in histories], dtype=np.int64)
+    history_offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    ## history shares only cover watched assets, spread them over the asset columns
+    history_shares = np.zeros((history_offsets[-1], num_assets), dtype=np.int64)
+    history = {name : [] for name in HISTORY_COLUMNS if name != "shares"}
+
+    for row, agent_history in enumerate(histories):
+        if agent_history is None:
+            continue
+        history_shares[history_offsets[row]:history_offsets[row + 1], watching[row]] = agent_history["shares"]
+        for name in history:
+            history[name].append(agent_history[name])
+
+    dtypes = {"timestamp" : np.int64, "exp_return" : float, "risk" : float, "side" : np.int8, "price" : float}
+    history = {"history_" + name : np.concatenate(columns).astype(dtypes[name]) if columns else np.zeros(0, dtypes[name])
+               for name, columns in history.items()}
+
+    trades_path = os.path.join(run_dir, "SimulationData", "Trades.bin")
+    fills = np.array(loadTradeLog(trades_path)) if os.path.exists(trades_path) else np.zeros(0, dtype=TRADE_DTYPE)
+
+    ## without exchange logs, the fills themselves are the trades
+    trades = _readExchangeTrades(run_dir, asset_index)
+    if trades is None:
+        trades = (fills["asset"].astype(np.int64), fills["timestamp"], fills["price_cents"] / 100,
+                  np.ones(len(fills), dtype=np.int64))
+
+    ## rows in agent id order
+    order = np.argsort(ids, kind="stable")
+    row_of = np.empty(num_agents, dtype=np.int64)
+    row_of[order] = np.arange(num_agents)
+    history_offsets, history = _reorderHistory(history_offsets, history, history_shares, order)
+
+    return dict(assets=np.asarray(assets, dtype=str), asset_files=np.asarray(asset_files, dtype=str), agent_ids=ids[order],
+                asset_file=np.asarray(asset_file, dtype=np.int64)[order], capital=np.asarray(capital, dtype=float)[order],
+                rfr=np.asarray(rfr, dtype=float)[order], risk_coeff=np.asarray(risk_coeff, dtype=float)[order],
+                watching=watching[order], initial_prices=initial_prices[order], initial_shares=initial_shares[order],
+                final_prices=final_prices[order], final_shares=final_shares[order], fills=fills,
+                trade_asset=trades[0], trade_timestamp=trades[1], trade_price=trades[2], trade_volume=trades[3],
+                history_offsets=history_offsets, **history)
+
+def _reorderHistory(offsets, history, history_shares, order):
+    """ returns history offsets and columns with agents' row blocks in the given order """
+
+    lengths = np.diff(offsets)[order]
+    starts = offsets[:-1][order]
+
+    ## index of every history row in its new position
+    new_offsets = np.concatenate(([0], np.cumsum(lengths)))
+    rows = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+
+    history = {name : column[rows] for name, column in history.items()}
+    history["history_shares"] = history_shares[rows]
+
+    return new_offsets, history
+
+def loadRun(run_dir, scenario="scenario.xml", cache=True, workers=None):
+    """
+    Loads a finished run into columnar arrays
+
+    Parameters
+    ----------
+    run_dir : string
+        working directory the simulation ran in
+
+    scenario : string
+        scenario XML file, relative to run_dir
+
+    cache : bool
+        use SimulationData/Analysis.npz if it is up to date, and write it
+        otherwise
+
+    workers : int, optional
+        threads reading the per-agent files
+
+    Returns
+    -------
+    run : RunData
+        every agent's endowment, final state and history and every trade
+    """
+
+    scenario = os.path.join(run_dir, scenario)
+    cache_path = os.path.join(run_dir, CACHE_FILE)
+    stamp = _sourceStamp(run_dir, scenario)
+
+    if cache and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            if int(data["cache_version"]) == CACHE_VERSION and str(data["source_stamp"]) == stamp:
+                return RunData(run_dir, {name : data[name] for name in data.files
+                                         if name not in ("cache_version", "source_stamp")})
+
+    run = RunData(run_dir, _parseRun(run_dir, scenario, workers))
+
+    if cache:
+        run.save(cache_path, stamp)
+
+    return run
+
+
+def pricePaths(run, timestamps=None):
+    """
+    Returns the last traded price of every asset at each timestamp
+
+    Parameters
+    ----------
+    run : RunData
+        the run
+
+    timestamps : nparray, optional
+        sorted timestamps, defaults to every timestamp with a trade
+
+    Returns
+    -------
+    timestamps : nparray
+        (num_timestamps) the timestamps
+
+    prices : nparray
+        (num_timestamps x num_assets) prices, nan before an asset's first trade
+    """
+
+    if timestamps is None:
+        timestamps = np.unique(run.trade_timestamp)
+
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    num_assets = len(run.assets)
+
+    if len(run.trade_timestamp) == 0:
+        return timestamps, np.full((len(timestamps), num_assets), np.nan)
+
+    ## trades sorted by (asset, timestamp), keeping log order within a timestamp, searched all at once
+    span = int(max(run.trade_timestamp.max(), timestamps.max(initial=0))) + 1
+    keys = run.trade_asset * span + run.trade_timestamp
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+
+    queries = np.arange(num_assets)[np.newaxis, :] * span + timestamps[:, np.newaxis]
+    found = np.searchsorted(keys, queries, side="right") - 1
+
+    valid = (found >= 0) & (keys[np.maximum(found, 0)] // span == np.arange(num_assets))
+
+    return timestamps, np.where(valid, run.trade_price[order][np.maximum(found, 0)], np.nan)
+
+def marketPrices(run):
+    """ returns the last traded price of each asset, the agents' mean final belief for assets never traded """
+
+    prices = np.full(len(run.assets), np.nan)
+    if len(run.trade_timestamp):
+        prices = pricePaths(run, [run.trade_timestamp.max()])[1][0]
+
+    believed = np.nanmean(np.where(run.watching, run.final_prices, np.nan), axis=0)
+
+    return np.where(np.isnan(prices), believed, prices)
+
+def currentWeights(shares, prices):
+    """ returns portfolio weights row-wise, same convention as portfolio.calculate_current_weights """
+
+    values = shares * np.nan_to_num(prices)
+    totals = values.sum(axis=-1, keepdims=True)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(shares > 0, values / totals, 0)
+
+def finalCash(run):
+    """ returns every agent's cash at the end of the run, starting capital plus sales less purchases """
+
+    rows = run.agentRows(run.fills["agent"])
+    flows = np.where(run.fills["side"] < 0, 1, -1) * run.fills["price_cents"] / 100
+
+    return run.capital + np.bincount(rows, weights=flows, minlength=len(run))
+
+def wealth(run, prices=None):
+    """
+    Returns every agent's wealth at the start and at the end of the run
+
+    Parameters
+    ----------
+    run : RunData
+        the run
+
+    prices : nparray, optional
+        (num_assets) prices the final holdings are valued at, marketPrices by default
+
+    Returns
+    -------
+    initial : nparray
+        (num_agents) capital plus endowment at the agents' initial prices
+
+    final : nparray
+        (num_agents) final cash plus holdings at prices
+    """
+
+    if prices is None:
+        prices = marketPrices(run)
+
+    initial = run.capital + np.einsum("ij,ij->i", run.initial_shares, np.nan_to_num(run.initial_prices))
+    final = finalCash(run) + np.matmul(run.final_shares, np.nan_to_num(prices))
+
+    return initial, final
+
+def targetWeights(run, prices=None):
+    """
+    Returns the tangency weights and market fraction each agent aims for
+
+    Agents sharing an asset dictionary and a set of watched assets are
+    solved together with one batchOptimalPortfolios call
+
+    Parameters
+    ----------
+    run : RunData
+        the run
+
+    prices : nparray, optional
+        (num_agents x num_assets) or (num_assets) prices, each agent's final
+        believed prices by default
+
+    Returns
+    -------
+    weights : nparray
+        (num_agents x num_assets) tangency weights, 0 for unwatched assets
+
+    fractions : nparray
+        (num_agents) optimal fraction of wealth in the tangency portfolio
+    """
+
+    if prices is None:
+        prices = run.final_prices
+
+    prices = np.broadcast_to(prices, run.final_prices.shape)
+
+    weights = np.zeros(run.final_prices.shape)
+    fractions = np.zeros(len(run))
+
+    groups, group_of = np.unique(np.column_stack((run.asset_file, run.watching)), axis=0, return_inverse=True)
+    group_of = group_of.reshape(-1)
+
+    for group, key in enumerate(groups):
+
+        rows = np.flatnonzero(group_of == group)
+        assets = np.flatnonzero(key[1:])
+
+        model = getMeanVarianceModel(assets.tolist(), os.path.join(run.run_dir, run.asset_files[key[0]]))
+        batch = batchOptimalPortfolios(model, prices[np.ix_(rows, assets)], run.rfr[rows], run.risk_coeff[rows])
+
+        weights[np.ix_(rows, assets)] = batch.weights
+        fractions[rows] = batch.fractions
+
+    return weights, fractions
+
+def weightDrift(run):
+    """
+    Returns how far each agent's final holdings are from the portfolio it aims for,
+    both valued at the agent's own final prices
+
+    Returns
+    -------
+    drift : nparray
+        (num_agents x num_assets) realised minus target weights
+
+    distance : nparray
+        (num_agents) half the L1 norm of drift, the fraction of the portfolio
+        that would have to be traded to reach the target
+    """
+
+    target, _ = targetWeights(run)
+    drift = currentWeights(run.final_shares, run.final_prices) - target
+
+    return drift, 0.5 * np.abs(drift).sum(axis=1)
+
+def turnover(run):
+    """
+    Returns every agent's trading activity over the run
+
+    Returns
+    -------
+    shares_traded : nparray
+        (num_agents) shares bought and sold
+
+    traded_value : nparray
+        (num_agents) value of the fills, as a fraction of initial wealth
+    """
+
+    rows = run.agentRows(run.fills["agent"])
+    shares_traded = np.bincount(rows, minlength=len(run))
+    traded_value = np.bincount(rows, weights=run.fills["price_cents"] / 100, minlength=len(run))
+
+    initial, _ = wealth(run)
+
+    return shares_traded, traded_value / initial
+
+def tangencyConvergence(run, asset_file=0, timestamps=None):
+    """
+    Returns the distance between the market portfolio and the CAPM tangency
+    portfolio of one asset dictionary along the run's price path
+
+    Parameters
+    ----------
+    run : RunData
+        the run
+
+    asset_file : int
+        index in run.asset_files of the dictionary taken as the true model
+
+    timestamps : nparray, optional
+        timestamps to evaluate at, defaults to every timestamp with a trade
+
+    Returns
+    -------
+    timestamps : nparray
+        (num_timestamps) the timestamps
+
+    distance : nparray
+        (num_timestamps) half the L1 distance between market and tangency weights
+
+    agent_distance : nparray
+        (num_agents) the same distance for each agent's final holdings at final market prices
+    """
+
+    timestamps, prices = pricePaths(run, timestamps)
+
+    ## before an asset first trades, the agents' mean initial belief stands in for its price
+    initial = np.nanmean(np.where(run.watching, run.initial_prices, np.nan), axis=0)
+    prices = np.where(np.isnan(prices), initial, prices)
+
+    ## trades only move shares between agents, the market holds the same shares throughout
+    market_shares = run.initial_shares.sum(axis=0)
+    market_weights = currentWeights(market_shares, prices)
+
+    model = getMeanVarianceModel(list(range(len(run.assets))), os.path.join(run.run_dir, run.asset_files[asset_file]))
+    rfr = float(np.mean(run.rfr))
+
+    distance = np.zeros(len(timestamps))
+    if len(timestamps):
+        tangency = batchOptimalPortfolios(model, prices, rfr, np.ones(len(timestamps))).weights
+        distance = 0.5 * np.abs(market_weights - tangency).sum(axis=1)
+
+    final_tangency = model.tangencyWeights(marketPrices(run), rfr)
+    agent_weights = currentWeights(run.final_shares, marketPrices(run))
+    agent_distance = 0.5 * np.abs(agent_weights - final_tangency).sum(axis=1)
+
+    return timestamps, distance, agent_distance
+
+def summarise(run):
+    """ returns the headline numbers of a run as a json-serialisable dict """
+
+    initial, final = wealth(run)
+    _, drift = weightDrift(run)
+    shares_traded, traded_value = turnover(run)
+    timestamps, distance, agent_distance = tangencyConvergence(run)
+
+    def stats(values):
+        return {"mean" : float(np.mean(values)), "p50" : float(np.median(values)), "min" : float(np.min(values)),
+                "max" : float(np.max(values))}
+
+    return {"agents" : len(run), "assets" : len(run.assets), "fills" : len(run.fills), "trades" : len(run.trade_price),
+            "history_rows" : int(run.history_offsets[-1]), "market_prices" : marketPrices(run).tolist(),
+            "wealth_change" : stats(final / initial - 1), "weight_drift" : stats(drift),
+            "shares_traded" : stats(shares_traded), "turnover" : stats(traded_value),
+            "tangency_distance" : {"start" : float(distance[0]) if len(distance) else None,
+                                   "end" : float(distance[-1]) if len(distance) else None,
+                                   "agents" : stats(agent_distance)}}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="summarises a finished run")
+    parser.add_argument("run_dir", help="working directory the simulation ran in")
+    parser.add_argument("--scenario", default="scenario.xml", help="scenario XML file, relative to run_dir")
+    parser.add_argument("--no-cache", action="store_true", help="re-reads every file, neither using nor writing the cache")
+    parser.add_argument("--workers", type=int, default=None, help="threads reading the per-agent files")
+    parser.add_argument("--output", default=None, help="json file the summary is written to")
+    args = parser.parse_args()
+
+    run = loadRun(args.run_dir, args.scenario, not args.no_cache, args.workers)
+    summary = summarise(run)
+
+    print(json.dumps(summary, indent=4))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+"""
+Summary: benchmark suite for the agent decision path and the portfolio
+         math, runnable without TheSimulator, reporting throughput, latency
+         percentiles and peak memory over a sweep of asset and agent counts
+
+         Notes:
+
+         - agents are generated with AgentGen.generateScenario into a
+         temporary directory and created through localsim, then driven by
+         FakeSimulation, which only records what they dispatch. every round
+         moves one watched price of each agent and times its evaluationLoop.
+         placed orders are confirmed between rounds (untimed) so later rounds
+         also go through cancelling and diffing
+
+         - peak memory is traced with tracemalloc, which slows everything it
+         traces, so it is only on for the untimed part of each case: setup and
+         a warm-up round for evaluationLoop, the first (cold) call otherwise
+
+         - cases whose agents x assets exceed --max-cells are skipped, the
+         defaults leave out 100000 agents on the largest universes
+
+         - results are written as json with --output. --baseline compares
+         against an earlier file and exits with status 1 if any case lost more
+         than --threshold (relative) of its throughput, or grew its median
+         latency or peak memory by more than that
+
+         - usage: python benchmarks/bench_agents.py [--assets 5 50 ...]
+         [--agents 10 1000 ...] [--benchmarks evaluationLoop ...]
+         [--output results.json] [--baseline old.json] [--threshold 0.2]
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import AgentGen
+from localsim.engine import createAgent, readScenario
+from localsim.thesimulator import PlaceOrderLimitResponsePayload
+import portfolio
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = [5, 50, 500, 2000]
+AGENTS = [10, 1000, 100000]
+BENCHMARKS = ["evaluationLoop", "calculate_optimal_portfolio", "calcPortfolioRisk", "generateSimulation"]
+MAX_CELLS = 10 ** 7
+THROUGHPUT_KEYS = ("evaluations_per_sec", "calls_per_sec")
+
+
+class FakeSimulation:
+    """ stands in for the simulator, recording every message dispatched instead of delivering it """
+
+    def __init__(self):
+
+        self.now = 0
+        self.outbox = []
+        self.message_counts = {}
+
+    def currentTimestamp(self):
+
+        return self.now
+
+    def dispatchMessage(self, timestamp, delay, source, target, type, payload):
+
+        self.outbox.append((source, target, type, payload))
+        self.message_counts[type] = self.message_counts.get(type, 0) + 1
+
+    def dispatchGenericMessage(self, timestamp, delay, source, target, type, payload):
+
+        self.dispatchMessage(timestamp, delay, source, target, type, payload)
+
+
+def latencyPercentiles(latencies):
+    """ returns the p50 / p90 / p99 / max of latencies given in seconds, in microseconds """
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e6
+
+    return {"p50" : p50, "p90" : p90, "p99" : p99, "max" : max(latencies) * 1e6}
+
+def tracedPeak(function, *args):
+    """ calls function under tracemalloc, returning its result and the peak traced memory in MB """
+
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return result, peak / 2 ** 20
+
+@contextlib.contextmanager
+def scenarioDirectory(num_agents, num_assets, seed):
+    """ generates a scenario into a temporary directory and runs the body inside it """
+
+    previous_dir = os.getcwd()
+    settings = AgentGen.SEED, AgentGen.AGENT_FP
+
+    with tempfile.TemporaryDirectory(prefix="bench_agents") as directory:
+        try:
+            AgentGen.SEED = seed
+            AgentGen.AGENT_FP = os.path.join(REPO_DIR, "SimpleCaseAgent.py")
+            AgentGen.generateScenario(directory, num_agents, num_assets)
+
+            os.chdir(directory)
+            yield directory
+        finally:
+            AgentGen.SEED, AgentGen.AGENT_FP = settings
+            os.chdir(previous_dir)
+
+def createAgents(directory):
+    """ creates the python agents of directory's scenario, in scenario order """
+
+    agents = []
+    elements = readScenario(directory + "/scenario.xml")
+    next(elements)
+
+    ## configure prints a line per agent
+    with contextlib.redirect_stdout(io.StringIO()):
+        for tag, params in elements:
+            if "fp" in params:
+                agents.append(createAgent(tag, params, directory))
+
+    return agents
+
+def evaluationRound(simulation, agents, rng, latencies=None):
+    """ moves one price of every agent and runs its evaluation, then confirms the orders it placed """
+
+    simulation.now += 1
+
+    for agent in agents:
+
+        asset_index = int(rng.integers(len(agent.watching)))
+        agent.setPrice(asset_index, agent.prices[asset_index] * rng.uniform(0.97, 1.03))
+
+        simulation.outbox = []
+
+        start = time.perf_counter()
+        agent.evaluationLoop(simulation)
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+
+        for _, target, type, payload in simulation.outbox:
+            if type == "PLACE_ORDER_LIMIT":
+                simulation.order_id += 1
+                agent.processOrderResponse(simulation.now, PlaceOrderLimitResponsePayload(simulation.order_id, payload), target)
+
+def benchEvaluationLoop(num_assets, num_agents, rounds, seed=0):
+    """
+    Times SimpleCaseAgent.evaluationLoop over a population of agents
+
+    Parameters
+    ----------
+    num_assets : int
+        assets in the scenario, watched by every agent
+
+    num_agents : int
+        agents evaluated each round
+
+    rounds : int
+        timed rounds, each evaluating every agent once
+
+    Returns
+    -------
+    result : dict
+        evaluations per second, latency percentiles, messages per evaluation and
+        peak memory of setting the agents up
+    """
+
+    rng = np.random.default_rng(seed)
+
+    with scenarioDirectory(num_agents, num_assets, seed) as directory:
+
+        simulation = FakeSimulation()
+        simulation.order_id = 0
+
+        def setUp():
+            agents = createAgents(directory)
+            evaluationRound(simulation, agents, rng)
+            return agents
+
+        agents, peak_memory = tracedPeak(setUp)
+
+        simulation.message_counts = {}
+        latencies = []
+
+        for _ in range(rounds):
+            evaluationRound(simulation, agents, rng, latencies)
+
+    return {
+        "evaluations_per_sec" : len(latencies) / sum(latencies),
+        "latency_us" : latencyPercentiles(latencies),
+        "messages_per_evaluation" : sum(simulation.message_counts.values()) / len(latencies),
+        "peak_memory_mb" : peak_memory,
+    }
+
+def benchFunction(function, make_args, calls):
+    """ times calls of function, with fresh arguments from make_args each time, the first (cold) call traced """
+
+    _, peak_memory = tracedPeak(function, *make_args())
+
+    arguments = [make_args() for _ in range(calls)]
+    latencies = []
+
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "calls_per_sec" : len(latencies) / sum(latencies),
+        "latency_us" : latencyPercentiles(latencies),
+        "peak_memory_mb" : peak_memory,
+    }
+
+def benchPortfolio(name, num_assets, calls, seed=0):
+    """
+    Times calculate_optimal_portfolio or calcPortfolioRisk over every asset of a universe
+
+    Parameters
+    ----------
+    name : string
+        function of portfolio to time
+
+    num_assets : int
+        assets in the universe
+
+    calls : int
+        calls timed, each with freshly drawn prices or weights
+
+    Returns
+    -------
+    result : dict
+        calls per second, latency percentiles and peak memory of the first call,
+        which loads the asset dictionary
+    """
+
+    rng = np.random.default_rng(seed)
+
+    with scenarioDirectory(1, num_assets, seed):
+
+        asset_file = "Asset Dictionaries/Asset Dictionary 0.json"
+        tickers = list(range(num_assets))
+        with open(asset_file) as f:
+            exp_prices = np.asarray(json.load(f)["exp_prices"])
+
+        if name == "calculate_optimal_portfolio":
+            function = portfolio.calculate_optimal_portfolio
+            make_args = lambda: (tickers, float(AgentGen.RFR), (exp_prices * rng.uniform(0.9, 1.0, num_assets)).tolist(),
+                                 asset_file)
+        else:
+            function = portfolio.calcPortfolioRisk
+            make_args = lambda: (tickers, rng.dirichlet(np.ones(num_assets)), asset_file)
+
+        return benchFunction(function, make_args, calls)
+
+def benchGenerateSimulation(num_assets, num_agents, repeats, seed=0):
+    """
+    Times AgentGen.generateSimulation, writing into a temporary directory
+
+    Parameters
+    ----------
+    num_assets : int
+        assets generated
+
+    num_agents : int
+        agents generated
+
+    repeats : int
+        timed runs, each into a fresh simulation folder
+
+    Returns
+    -------
+    result : dict
+        calls per second, latency percentiles and peak memory of the first run
+    """
+
+    previous_dir = os.getcwd()
+    settings = AgentGen.SEED, AgentGen.SIMULATOR_DIR
+    runs = iter(range(repeats + 1))
+
+    with tempfile.TemporaryDirectory(prefix="bench_agents") as directory:
+        try:
+            os.chdir(directory)
+            AgentGen.SEED = seed
+            AgentGen.SIMULATOR_DIR = directory + "/"
+
+            def makeArgs():
+                name = "Bench" + str(next(runs))
+                os.mkdir(name)
+                return name, num_agents, num_assets
+
+            return benchFunction(AgentGen.generateSimulation, makeArgs, repeats)
+        finally:
+            AgentGen.SEED, AgentGen.SIMULATOR_DIR = settings
+            os.chdir(previous_dir)
+
+def runSuite(benchmarks, assets, agents, rounds, calls, max_cells):
+    """ runs every requested case, returning {case name : result}, skipped cases marked as such """
+
+    results = {}
+
+    for num_assets in assets:
+
+        for name in benchmarks:
+
+            if name in ("calculate_optimal_portfolio", "calcPortfolioRisk"):
+                case = "%s/assets=%d" % (name, num_assets)
+                print("running %s" % case, file=sys.stderr)
+                results[case] = benchPortfolio(name, num_assets, calls)
+                continue
+
+            for num_agents in agents:
+
+                case = "%s/assets=%d/agents=%d" % (name, num_assets, num_agents)
+
+                if num_assets * num_agents > max_cells:
+                    results[case] = {"skipped" : "agents x assets over %d" % max_cells}
+                    continue
+
+                print("running %s" % case, file=sys.stderr)
+
+                if name == "evaluationLoop":
+                    results[case] = benchEvaluationLoop(num_assets, num_agents, rounds)
+                else:
+                    results[case] = benchGenerateSimulation(num_assets, num_agents, calls if num_agents <= 1000 else 1)
+
+    return results
+
+def compareResults(results, baseline, threshold):
+    """ returns a line describing each case that regressed past threshold against baseline """
+
+    regressions = []
+
+    for case, result in results.items():
+
+        base = baseline.get(case)
+        if base is None or "skipped" in result or "skipped" in base:
+            continue
+
+        for key in THROUGHPUT_KEYS:
+            if key in result and key in base and result[key] < base[key] * (1 - threshold):
+                regressions.append("%s: %s %.1f -> %.1f" % (case, key, base[key], result[key]))
+
+        if result["latency_us"]["p50"] > base["latency_us"]["p50"] * (1 + threshold):
+            regressions.append("%s: p50 latency %.1fus -> %.1fus" % (case, base["latency_us"]["p50"],
+                                                                       result["latency_us"]["p50"]))
+
+        if result["peak_memory_mb"] > base["peak_memory_mb"] * (1 + threshold):
+            regressions.append("%s: peak memory %.1fMB -> %.1fMB" % (case, base["peak_memory_mb"], result["peak_memory_mb"]))
+
+    return regressions
+
+def printResults(results):
+
+    print("%-52s %14s %10s %10s %10s %10s" % ("case", "evals|calls/s", "p50 us", "p90 us", "p99 us", "peak MB"))
+
+    for case, result in results.items():
+
+        if "skipped" in result:
+            print("%-52s skipped, %s" % (case, result["skipped"]))
+            continue
+
+        rate = result.get("evaluations_per_sec", result.get("calls_per_sec"))
+        latency = result["latency_us"]
+        print("%-52s %14.1f %10.1f %10.1f %10.1f %10.1f" % (case, rate, latency["p50"], latency["p90"], latency["p99"],
+                                                           result["peak_memory_mb"]))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="benchmarks the agent decision path and the portfolio math")
+    parser.add_argument("--assets", type=int, nargs="+", default=ASSETS, help="asset counts swept")
+    parser.add_argument("--agents", type=int, nargs="+", default=AGENTS, help="agent counts swept")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--rounds", type=int, default=3, help="timed evaluation rounds over every agent")
+    parser.add_argument("--calls", type=int, default=50, help="timed calls of each portfolio function")
+    parser.add_argument("--max-cells", type=int, default=MAX_CELLS, help="skips cases with more agents x assets")
+    parser.add_argument("--asset-format", choices=("json", "npy"), default=AgentGen.ASSET_FORMAT,
+                        help="asset dictionary format generated")
+    parser.add_argument("--output", default=None, help="json file results are written to")
+    parser.add_argument("--baseline", default=None, help="json results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    AgentGen.ASSET_FORMAT = args.asset_format
+
+    results = runSuite(args.benchmarks, args.assets, args.agents, args.rounds, args.calls, args.max_cells)
+    printResults(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python" : platform.python_version(), "numpy" : np.__version__, "machine" : platform.platform(),
+                       "time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "asset_format" : args.asset_format,
+                       "results" : results}, f, indent=4)
+
+    if args.baseline is not None:
+
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+        regressions = compareResults(results, baseline, args.threshold)
+
+        for line in regressions:
+            print("REGRESSION " + line)
+
+        if regressions:
+            sys.exit(1)
+
+        print("no regressions past %.0f%% against %s" % (args.threshold * 100, args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Summary: micro-benchmark of the localsim order book, reporting inserts,
+         cancels and matches per second at a range of book depths
+
+         Notes:
+
+         - the book is first filled with depth resting orders on each side,
+         spread over up to 1000 price levels. the timed operations then keep
+         the depth constant: a non-crossing insert followed by cancelling
+         it, or a crossing one-share order followed by replenishing the
+         level it took from
+
+         - usage: python benchmarks/bench_orderbook.py [--depths 10 100 ...]
+         [--ops N] [--algorithm PriceTime|PureProRata]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from localsim.orderbook import ALGORITHMS, Order, OrderBook
+from localsim.thesimulator import OrderDirection
+
+
+MID_PRICE = 100000
+DEPTHS = [10, 100, 1000, 10000, 100000]
+
+
+def buildBook(depth, algorithm, rng):
+    """ returns a book with depth one-share orders resting on each side, and the next free order id """
+
+    book = OrderBook(algorithm)
+    levels = min(depth, 1000)
+    order_id = 0
+
+    for direction, sign in ((OrderDirection.Buy, -1), (OrderDirection.Sell, 1)):
+        for offset in rng.integers(1, levels + 1, size=depth):
+            book.place(Order(order_id, "bench", direction, MID_PRICE + sign * int(offset), 1))
+            order_id += 1
+
+    return book, order_id
+
+def benchDepth(depth, ops, algorithm, seed=0):
+    """
+    Times inserts, cancels and matches against a book of the given depth
+
+    Parameters
+    ----------
+    depth : int
+        resting orders per side
+
+    ops : int
+        operations timed of each kind
+
+    algorithm : string
+        allocation rule of the book
+
+    Returns
+    -------
+    result : dict
+        operations per second of each kind
+    """
+
+    rng = np.random.default_rng(seed)
+    book, order_id = buildBook(depth, algorithm, rng)
+    levels = min(depth, 1000)
+
+    ## non-crossing orders at random existing or new levels
+    offsets = rng.integers(1, levels + 2, size=ops).tolist()
+    orders = [Order(order_id + n, "bench", OrderDirection.Buy, MID_PRICE - offsets[n], 1) for n in range(ops)]
+    order_id += ops
+
+    start = time.perf_counter()
+    for order in orders:
+        book.place(order)
+    insert_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for order in orders:
+        book.cancel(order.id, 1)
+    cancel_time = time.perf_counter() - start
+
+    ## one-share market sells, each followed by a bid replacing the one it took
+    start = time.perf_counter()
+    for n in range(ops):
+        fills = book.place(Order(order_id, "bench", OrderDirection.Sell, None, 1))
+        book.place(Order(order_id + 1, "bench", OrderDirection.Buy, fills[0][2], 1))
+        order_id += 2
+    match_time = time.perf_counter() - start
+
+    assert len(book) == 2 * depth
+
+    return {
+        "depth" : depth,
+        "algorithm" : algorithm,
+        "inserts_per_sec" : ops / insert_time,
+        "cancels_per_sec" : ops / cancel_time,
+        "matches_per_sec" : ops / match_time,
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="benchmarks the localsim order book")
+    parser.add_argument("--depths", type=int, nargs="+", default=DEPTHS, help="resting orders per side")
+    parser.add_argument("--ops", type=int, default=20000, help="operations timed of each kind")
+    parser.add_argument("--algorithm", choices=ALGORITHMS, default="PriceTime")
+    args = parser.parse_args()
+
+    print("%8s %14s %14s %14s" % ("depth", "inserts/s", "cancels/s", "matches/s"))
+
+    for depth in args.depths:
+        result = benchDepth(depth, args.ops, args.algorithm)
+        print("%8d %14.0f %14.0f %14.0f" % (depth, result["inserts_per_sec"], result["cancels_per_sec"],
+                                           result["matches_per_sec"]))
+
+
+if __name__ == "__main__":
+    main()
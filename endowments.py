@@ -0,0 +1,99 @@
+"""
+Summary: packed store of agent endowments, a single .npy file holding
+         one fixed-width record per agent instead of one AgentN.json each
+
+         Notes:
+
+         - row n belongs to AGENTn, fields are capital, risk coefficient,
+         and per asset of the asset dictionary the initial price, share count
+         and whether the agent watches it
+
+         - the file is memory-mapped on read, so an agent only touches the
+         pages of its own row
+
+"""
+
+import numpy as np
+
+
+def endowmentDtype(num_assets):
+    """ returns the record layout of one agent's endowment """
+
+    return np.dtype([
+        ("capital", np.float64),
+        ("risk_coeff", np.float64),
+        ("prices", np.float64, (num_assets,)),
+        ("shares", np.int64, (num_assets,)),
+        ("watching", np.bool_, (num_assets,)),
+    ])
+
+def writeEndowments(path, capitals, prices, shares, watching, risk_coeffs=np.nan):
+    """
+    Writes every agent's endowment to a packed .npy file
+
+    Parameters
+    ----------
+    path : string
+        destination .npy file
+
+    capitals : nparray
+        (num_agents) starting capital of each agent
+
+    prices : nparray
+        (num_agents x num_assets) initial price beliefs, or a single
+        (num_assets) row shared by every agent
+
+    shares : nparray
+        (num_agents x num_assets) share endowments
+
+    watching : nparray
+        (num_agents x num_assets) boolean mask of watched assets
+
+    risk_coeffs : nparray, optional
+        (num_agents) risk aversion coefficients, nan if not stored
+    """
+
+    shares = np.asarray(shares)
+    num_agents, num_assets = shares.shape
+
+    records = np.lib.format.open_memmap(path, mode="w+", dtype=endowmentDtype(num_assets), shape=(num_agents,))
+    records["capital"] = capitals
+    records["risk_coeff"] = risk_coeffs
+    records["prices"] = prices
+    records["shares"] = shares
+    records["watching"] = watching
+    records.flush()
+
+    del records
+
+def readEndowment(path, agent_id, assets):
+    """
+    Reads a single agent's endowment from a packed store
+
+    Parameters
+    ----------
+    path : string
+        .npy file written by writeEndowments
+
+    agent_id : int
+        row to read
+
+    assets : list
+        asset names of the asset dictionary, in dictionary order
+
+    Returns
+    -------
+    endowment : dict
+        capital, and watching, prices and shares lists in the same form as
+        the per-agent json files
+    """
+
+    row = np.load(path, mmap_mode="r")[int(agent_id)]
+    watched = np.flatnonzero(row["watching"])
+
+    return {
+        "capital" : float(row["capital"]),
+        "watching" : [assets[num] for num in watched],
+        "prices" : row["prices"][watched].tolist(),
+        "shares" : row["shares"][watched].tolist(),
+    }
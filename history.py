@@ -0,0 +1,310 @@
+"""
+Summary: compact per-agent history recording, to replace the python lists
+         of holdings, returns and risk that agents used to accumulate
+
+         Notes:
+
+         - history is stored column by column in preallocated typed numpy
+         arrays that double in size when full, so a fill costs one row
+         write instead of several small python objects
+
+         - records can be downsampled, keeping every k-th one
+
+         - saved as a single binary .npz, one array per column
+
+         - for long runs the recorder can instead spill fixed-size chunks
+         to an append-only binary file, per agent or shared, so memory
+         stays constant. HistoryReader memory-maps the file back
+
+"""
+
+import json
+import os
+import numpy as np
+
+
+## values of the "side" column
+FILL_NONE = 0
+FILL_BUY = 1
+FILL_SELL = -1
+
+## spill files already opened by this process, truncated on first open only
+_SPILL_FILES = set()
+
+
+def recordDtype(num_assets):
+    """ returns the fixed-width record layout of spilled history rows """
+
+    return np.dtype([
+        ("agent", np.int64),
+        ("timestamp", np.int64),
+        ("shares", np.int64, (num_assets,)),
+        ("exp_return", np.float64),
+        ("risk", np.float64),
+        ("side", np.int8),
+        ("price", np.float64),
+    ])
+
+
+class HistoryRecorder:
+    """ growable columnar record of one agent's portfolio over a run
+
+    Columns are timestamp, shares (one column per watched asset), expected
+    return, risk, fill side and fill price.
+
+    Attributes
+    ----------
+    num_assets : int
+        width of the shares column
+
+    capacity : int
+        number of rows currently allocated
+
+    downsample : int
+        only every downsample-th record offered is kept
+
+    size : int
+        number of rows held in memory
+
+    spill_path : string or None
+        if set, rows are appended to this file in chunks of capacity rows
+        instead of growing the in-memory columns
+
+    spilled : int
+        number of rows written to spill_path so far
+    """
+
+    def __init__(self, num_assets, capacity=1024, downsample=1, spill_path=None, agent_id=0):
+
+        self.num_assets = num_assets
+        self.capacity = max(1, int(capacity))
+        self.downsample = max(1, int(downsample))
+        self.size = 0
+        self.offered = 0
+
+        self.columns = self._allocate(self.capacity)
+
+        self.agent_id = int(agent_id)
+        self.spill_path = spill_path
+        self.spilled = 0
+
+        if spill_path is not None:
+            self._openSpill()
+
+    def _openSpill(self):
+        """ truncates the spill file on first use in this process and writes its header """
+
+        path = os.path.abspath(self.spill_path)
+        header = {"num_assets" : self.num_assets}
+
+        if path not in _SPILL_FILES:
+            _SPILL_FILES.add(path)
+            open(path, "wb").close()
+            with open(path + ".json", "w") as f:
+                json.dump(header, f)
+
+        else:
+            with open(path + ".json") as f:
+                if json.load(f) != header:
+                    raise ValueError("agents sharing history file %s must watch the same number of assets" % path)
+
+    def flush(self):
+        """ appends the in-memory rows to the spill file and empties the buffer """
+
+        if self.spill_path is None or self.size == 0:
+            return
+
+        records = np.zeros(self.size, dtype=recordDtype(self.num_assets))
+        records["agent"] = self.agent_id
+        for name, column in self.columns.items():
+            records[name] = column[:self.size]
+
+        ## one unbuffered write per chunk, so agents sharing a file never interleave rows
+        with open(self.spill_path, "ab", buffering=0) as f:
+            f.write(records.tobytes())
+
+        self.spilled += self.size
+        self.size = 0
+
+    def _allocate(self, capacity):
+        """ returns a fresh set of empty column arrays with the given capacity """
+
+        return {
+            "timestamp" : np.zeros(capacity, dtype=np.int64),
+            "shares" : np.zeros((capacity, self.num_assets), dtype=np.int64),
+            "exp_return" : np.zeros(capacity, dtype=np.float64),
+            "risk" : np.zeros(capacity, dtype=np.float64),
+            "side" : np.zeros(capacity, dtype=np.int8),
+            "price" : np.zeros(capacity, dtype=np.float64),
+        }
+
+    def _grow(self):
+        """ doubles the capacity of every column, keeping recorded rows """
+
+        columns = self._allocate(2 * self.capacity)
+
+        for name, column in self.columns.items():
+            columns[name][:self.size] = column[:self.size]
+
+        self.columns = columns
+        self.capacity *= 2
+
+    def record(self, timestamp, shares, exp_return, risk, side=FILL_NONE, price=np.nan):
+        """
+        Appends one row, unless it is dropped by downsampling
+
+        Parameters
+        ----------
+        timestamp : int
+            simulation timestamp of the record
+
+        shares : list
+            share count of each watched asset
+
+        exp_return : float
+            expected return of the current portfolio
+
+        risk : float
+            variance of the current portfolio
+
+        side : int
+            FILL_BUY, FILL_SELL or FILL_NONE
+
+        price : float
+            price of the fill that triggered the record
+        """
+
+        self.offered += 1
+        if (self.offered - 1) % self.downsample:
+            return
+
+        if self.size == self.capacity:
+            if self.spill_path is None:
+                self._grow()
+            else:
+                self.flush()
+
+        row = self.size
+        self.columns["timestamp"][row] = timestamp
+        self.columns["shares"][row] = shares
+        self.columns["exp_return"][row] = exp_return
+        self.columns["risk"][row] = risk
+        self.columns["side"][row] = side
+        self.columns["price"][row] = price
+
+        self.size += 1
+
+    def column(self, name):
+        """ returns the recorded rows of one column, read back from the
+            spill file if the recorder is spilling """
+
+        if self.spill_path is not None:
+            self.flush()
+            return np.array(HistoryReader(self.spill_path).column(name, self.agent_id))
+
+        return self.columns[name][:self.size]
+
+    def asDict(self):
+        """ returns views of every recorded column, keyed by column name """
+
+        return {name : self.column(name) for name in self.columns}
+
+    def save(self, path, **extra):
+        """
+        Writes the recorded columns to a binary .npz file
+
+        Parameters
+        ----------
+        path : string
+            destination file, numpy appends .npz if it is missing
+
+        extra : nparray
+            additional arrays stored alongside the columns
+        """
+
+        ## spilled columns already live in the spill file, only store the extras
+        if self.spill_path is not None:
+            self.flush()
+            np.savez(path, **extra)
+            return
+
+        np.savez(path, **self.asDict(), **extra)
+
+
+def loadHistory(path):
+    """
+    Returns the columns of a history written by HistoryRecorder.save
+
+    Parameters
+    ----------
+    path : string
+        the .npz file to read
+
+    Returns
+    -------
+    history : dict
+        column name -> nparray
+    """
+
+    with np.load(path) as data:
+        return {name : data[name] for name in data.files}
+
+
+class HistoryReader:
+    """ lazy, memory-mapped view of a history spill file
+
+    Nothing is read until a column is accessed, and then only the pages
+    backing that column.
+    """
+
+    def __init__(self, path):
+
+        with open(path + ".json") as f:
+            header = json.load(f)
+
+        self.path = path
+        self.num_assets = header["num_assets"]
+        self.dtype = recordDtype(self.num_assets)
+
+        ## np.memmap refuses empty files
+        if os.path.getsize(path) == 0:
+            self.records = np.zeros(0, dtype=self.dtype)
+        else:
+            self.records = np.memmap(path, dtype=self.dtype, mode="r")
+
+    def __len__(self):
+
+        return len(self.records)
+
+    def agentIds(self):
+        """ returns the ids of agents with rows in the file """
+
+        return np.unique(self.records["agent"])
+
+    def column(self, name, agent_id=None):
+        """
+        Returns one column of the spilled history
+
+        Parameters
+        ----------
+        name : string
+            column name, one of the HistoryRecorder columns
+
+        agent_id : int, optional
+            only return rows of this agent, needed for shared files
+
+        Returns
+        -------
+        column : nparray
+            a memory-mapped view if agent_id is None, otherwise a copy
+        """
+
+        if agent_id is None:
+            return self.records[name]
+
+        return self.records[name][self.records["agent"] == agent_id]
+
+    def asDict(self, agent_id=None):
+        """ returns every column, keyed by column name """
+
+        return {name : self.column(name, agent_id) for name in self.dtype.names if name != "agent"}
@@ -0,0 +1,215 @@
+"""
+Summary: opt-in timers and counters on the agent hot path, to find out
+         where a slow run spends its time
+
+         Notes:
+
+         - enabled per agent with instrument="1" on its XML element, or for
+         every agent by setting the MARKETSIM_INSTRUMENT environment
+         variable to 1. an XML attribute wins over the environment. when
+         off nothing is wrapped, agents run their plain methods
+
+         - an instrumented agent has evaluationLoop, processOrderEvent,
+         releaseOrders, cancelOrders, submitOrders and updateData replaced
+         on the instance by timed wrappers. the portfolio.py functions and
+         MeanVarianceModel methods are wrapped process-wide the first time
+         an agent turns instrumentation on, so their counters are shared by
+         every agent in the interpreter
+
+         - every timer keeps calls, total ns and max ns, measured with
+         time.perf_counter_ns. times are inclusive: evaluationLoop's total
+         contains the portfolio calls it makes
+
+         - at EVENT_SIMULATION_STOP each agent writes its timers and the
+         messages it dispatched by type to SimulationData/Profile<id>.json.
+         once the last instrumented agent of the interpreter has stopped,
+         the sums over all of them, the portfolio timers and the asset cache
+         counters are written to AGGREGATE_PATH
+
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+
+import portfolio
+
+
+ENV_VAR = "MARKETSIM_INSTRUMENT"
+
+AGENT_METHODS = ("evaluationLoop", "processOrderEvent", "releaseOrders", "cancelOrders", "submitOrders",
+                 "updateData")
+
+PORTFOLIO_FUNCTIONS = ("loadAssetData", "getMeanVarianceModel", "batchOptimalPortfolios", "getExpPriceData",
+                       "getRiskMatrix", "getExpRetData", "calculate_expected_return", "calculate_optimal_portfolio",
+                       "calcPortfolioRisk", "calculate_current_weights")
+
+MODEL_METHODS = ("__init__", "solve", "expectedReturns", "expectedReturn", "portfolioRisk", "tangencyWeights",
+                 "tangencyFromExcess")
+
+## where the per-interpreter summary goes, localsim shard workers each get their own
+AGGREGATE_PATH = "SimulationData/Profile.json"
+
+## process-wide portfolio timers, name -> Timer, and the unwrapped functions they replaced
+_PORTFOLIO_TIMERS = {}
+_PORTFOLIO_ORIGINALS = {}
+
+## instrumented agents of this interpreter, and what the stopped ones added up to
+_AGGREGATE = {"agents" : 0, "stopped" : 0, "methods" : {}, "messages" : {}}
+
+
+class Timer:
+    """ call count, total and longest duration of one wrapped function """
+
+    __slots__ = ("calls", "total_ns", "max_ns")
+
+    def __init__(self):
+
+        self.calls = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def summary(self):
+
+        return {"calls" : self.calls, "total_ns" : self.total_ns, "max_ns" : self.max_ns,
+                "mean_ns" : self.total_ns / self.calls if self.calls else 0}
+
+
+def timed(function, timer):
+    """ returns function wrapped so every call is counted and timed into timer """
+
+    clock = time.perf_counter_ns
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = clock() - start
+            timer.calls += 1
+            timer.total_ns += elapsed
+            if elapsed > timer.max_ns:
+                timer.max_ns = elapsed
+
+    return wrapper
+
+def defaultInstrumentation():
+    """ returns the instrument setting for agents whose XML element does not set one """
+
+    return int(os.environ.get(ENV_VAR) or 0)
+
+def instrumentPortfolio(namespace=None):
+    """
+    Wraps the portfolio.py functions and MeanVarianceModel methods in timers,
+    once per process
+
+    Parameters
+    ----------
+    namespace : dict, optional
+        globals of a module that imported the functions with
+        `from portfolio import *`, its references are replaced too
+    """
+
+    if not _PORTFOLIO_TIMERS:
+
+        for name in PORTFOLIO_FUNCTIONS:
+            _PORTFOLIO_TIMERS[name] = Timer()
+            _PORTFOLIO_ORIGINALS[name] = getattr(portfolio, name)
+            setattr(portfolio, name, timed(_PORTFOLIO_ORIGINALS[name], _PORTFOLIO_TIMERS[name]))
+
+        for name in MODEL_METHODS:
+            key = "MeanVarianceModel." + name
+            _PORTFOLIO_TIMERS[key] = Timer()
+            setattr(portfolio.MeanVarianceModel, name, timed(getattr(portfolio.MeanVarianceModel, name),
+                                                             _PORTFOLIO_TIMERS[key]))
+
+    if namespace is None:
+        return
+
+    for name, original in _PORTFOLIO_ORIGINALS.items():
+        if namespace.get(name) is original:
+            namespace[name] = getattr(portfolio, name)
+
+
+class AgentProfile:
+    """ timers of one instrumented agent
+
+    Attributes
+    ----------
+    agent_id : string
+        id of the agent, used to name its summary file
+
+    timers : dict
+        method name -> Timer
+    """
+
+    def __init__(self, agent, agent_id, methods=AGENT_METHODS):
+
+        self.agent_id = agent_id
+        self.timers = {}
+
+        ## instance attributes shadow the class methods, so the agent's own self.x() calls are timed too
+        for name in methods:
+            self.timers[name] = Timer()
+            setattr(agent, name, timed(getattr(agent, name), self.timers[name]))
+
+        instrumentPortfolio(vars(sys.modules[type(agent).__module__]))
+
+        _AGGREGATE["agents"] += 1
+
+    def summary(self, messages_sent):
+        """ returns the agent's timers and dispatched message counts as a dict """
+
+        return {"agent" : self.agent_id, "methods" : {name : timer.summary() for name, timer in self.timers.items()},
+                "messages" : dict(messages_sent)}
+
+    def save(self, messages_sent, directory="SimulationData"):
+        """ writes the agent's summary to directory/Profile<id>.json and adds it to the
+            interpreter's aggregate, written once every instrumented agent has saved """
+
+        summary = self.summary(messages_sent)
+
+        with open(directory + "/Profile" + self.agent_id + ".json", "w") as f:
+            json.dump(summary, f)
+
+        for name, timer in self.timers.items():
+            total = _AGGREGATE["methods"].setdefault(name, Timer())
+            total.calls += timer.calls
+            total.total_ns += timer.total_ns
+            total.max_ns = max(total.max_ns, timer.max_ns)
+
+        for type, count in summary["messages"].items():
+            _AGGREGATE["messages"][type] = _AGGREGATE["messages"].get(type, 0) + count
+
+        _AGGREGATE["stopped"] += 1
+
+        if _AGGREGATE["stopped"] == _AGGREGATE["agents"]:
+            saveAggregate()
+
+
+def getAggregate():
+    """
+    Returns the summed timers of the stopped instrumented agents of this
+    interpreter, along with the portfolio timers and asset cache counters
+
+    Returns
+    -------
+    aggregate : dict
+        agents, methods, messages, portfolio and asset_cache
+    """
+
+    return {"agents" : _AGGREGATE["stopped"],
+            "methods" : {name : timer.summary() for name, timer in _AGGREGATE["methods"].items()},
+            "messages" : dict(_AGGREGATE["messages"]),
+            "portfolio" : {name : timer.summary() for name, timer in _PORTFOLIO_TIMERS.items() if timer.calls},
+            "asset_cache" : portfolio.getAssetCacheStats()}
+
+def saveAggregate(path=None):
+    """ writes getAggregate() to path, AGGREGATE_PATH by default """
+
+    with open(path or AGGREGATE_PATH, "w") as f:
+        json.dump(getAggregate(), f, indent=4)
@@ -0,0 +1,10 @@
+"""
+Summary: pure python stand-in for the maxe simulator, see engine.py
+
+         run a scenario from its directory with
+
+             python -m localsim scenario.xml
+
+"""
+
+from localsim.engine import Simulation, loadScenario
@@ -0,0 +1,61 @@
+import argparse
+import os
+
+from localsim.engine import loadScenario
+import profiler
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="runs a scenario XML file on the local python engine")
+    parser.add_argument("scenario")
+    parser.add_argument("--workdir", default=None, help="directory agents run in, defaults to the current one")
+    parser.add_argument("--duration", type=int, default=None, help="overrides the scenario's duration")
+    parser.add_argument("--shards", type=int, default=1, help="worker processes running the python agents, 1 runs everything in process")
+    parser.add_argument("--profile", action="store_true", help="samples the run's stacks into SimulationData/Samples.collapsed")
+    parser.add_argument("--profile-window", default=None, help="START:STOP, only samples timestamps in the window")
+    parser.add_argument("--profile-interval", type=float, default=profiler.DEFAULT_INTERVAL, help="seconds between samples")
+    args = parser.parse_args()
+
+    scenario = os.path.abspath(args.scenario)
+    if args.workdir is not None:
+        os.chdir(args.workdir)
+
+    ## shard workers run the agents, they profile themselves from the environment they inherit
+    if args.profile and args.shards > 1:
+        os.environ[profiler.ENV_VAR] = "1"
+        os.environ[profiler.INTERVAL_ENV_VAR] = str(args.profile_interval)
+        os.environ[profiler.WINDOW_ENV_VAR] = args.profile_window or ""
+
+    if args.shards > 1:
+        from localsim.shard import loadShardedScenario
+        simulation = loadShardedScenario(scenario, args.shards, args.duration)
+    else:
+        simulation = loadScenario(scenario, args.duration)
+
+    sampler = None
+    if args.profile:
+        sampler = profiler.StackSampler(args.profile_interval, lambda: simulation.now, profiler.parseWindow(args.profile_window))
+        sampler.start()
+
+    try:
+        stats = simulation.run()
+    finally:
+        if sampler is not None:
+            sampler.stop()
+            if not os.path.isdir("SimulationData"):
+                os.mkdir("SimulationData")
+            sampler.save()
+
+    if sampler is not None:
+        print("localsim: %d samples, written to %s.collapsed" % (sampler.summary()["samples"], profiler.OUTPUT_PATH))
+
+    print("localsim: delivered %d messages in %d waves, %.2fs" % (stats["delivered"], stats["waves"], stats["wall_time"]))
+    print("localsim: %.1f messages per timestep over %d timesteps" % (stats["messages_per_timestep"], stats["timesteps"]))
+
+    for type, count in sorted(stats["message_counts"].items()):
+        print("    %-30s %d" % (type, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+"""
+Summary: local discrete-event engine standing in for the compiled maxe
+         simulator, so agent scripts can be run, tested and profiled
+         without the C++ build
+
+         Notes:
+
+         - loads the same scenario XML AgentGen writes. elements with an
+         "fp" attribute are python agents, the class named after the tag is
+         taken from the script. ExchangeAgent, PriceDataAgent, TradeLogAgent
+         and ShockAgent have local implementations
+
+         - messages sit in a heap ordered by (timestamp, dispatch order).
+         all messages due at the current timestamp are delivered as one
+         wave, and whatever they dispatch is queued once the wave is done,
+         in delivery order. a message dispatched with delay 0 therefore
+         lands in the next wave at the same timestamp, and a run is fully
+         determined by the scenario
+
+         - besides SUBSCRIBE_EVENT_TRADE, exchanges accept
+         SUBSCRIBE_EVENT_TRADE_FILTERED, a generic message with payload
+         {"threshold" : x}: the subscriber gets fills of its own orders, and
+         other trades only once the price moved more than x (relative) from
+         the last one it was sent. the PriceDataAgent sends
+         EVENT_PRICE_SNAPSHOT, {"prices" : {exchange : price}}, every
+         snapshot_interval timestamps to agents that sent
+         SUBSCRIBE_PRICE_SNAPSHOTS, {"exchanges" : [...]}. neither is part
+         of the compiled simulator
+
+         - agents run with the working directory the engine was started in,
+         the scenario directory for AgentGen.generateScenario layouts
+
+"""
+
+import heapq
+import importlib.util
+import os
+import sys
+import time
+
+import lxml.etree as ET
+
+from localsim import thesimulator as api
+from localsim.orderbook import Order, OrderBook
+
+
+## name of the pseudo agent that sends simulation start / stop events
+SIMULATION_SOURCE = "SIMULATION"
+
+## agent scripts loaded so far, absolute path -> module
+_AGENT_MODULES = {}
+
+
+class Message:
+
+    __slots__ = ("timestamp", "source", "target", "type", "payload")
+
+    def __init__(self, timestamp, source, target, type, payload):
+
+        self.timestamp = timestamp
+        self.source = source
+        self.target = target
+        self.type = type
+        self.payload = payload
+
+
+class Simulation:
+    """ the simulation object handed to agents, and the event loop driving them
+
+    Attributes
+    ----------
+    start : int
+        first timestamp of the run
+
+    duration : int
+        length of the run, events after start + duration are not delivered
+
+    agents : dict
+        agent name -> agent object
+
+    delivered : int
+        number of messages delivered so far
+
+    message_counts : dict
+        message type -> number delivered so far
+
+    timesteps : int
+        number of distinct timestamps messages were delivered at
+    """
+
+    def __init__(self, start=0, duration=10000):
+
+        self.start = start
+        self.duration = duration
+        self.now = start
+
+        self.agents = {}
+        self.agent_order = []
+
+        self.queue = []
+        self.dispatched = 0
+        self.delivered = 0
+        self.message_counts = {}
+        self.timesteps = 0
+        self.waves = 0
+        self.outbox = []
+        self.unknown_targets = set()
+
+    ## --- interface used by agents ---
+
+    def currentTimestamp(self):
+
+        return self.now
+
+    def dispatchMessage(self, timestamp, delay, source, target, type, payload):
+        """ queues a message for delivery at timestamp + delay, after the current wave """
+
+        self.outbox.append(Message(max(timestamp + delay, self.now), source, target, type, payload))
+
+    def dispatchGenericMessage(self, timestamp, delay, source, target, type, payload):
+
+        self.dispatchMessage(timestamp, delay, source, target, type, payload)
+
+    ## --- engine ---
+
+    def addAgent(self, name, agent):
+        """ registers an agent under name, start / stop events go out in registration order """
+
+        if name in self.agents:
+            raise ValueError("duplicate agent name %s" % name)
+
+        self.agents[name] = agent
+        self.agent_order.append(name)
+
+    def post(self, message):
+        """ puts a message on the event queue """
+
+        heapq.heappush(self.queue, (message.timestamp, self.dispatched, message))
+        self.dispatched += 1
+
+    def deliver(self, message):
+        """ hands a single message to its target agent """
+
+        agent = self.agents.get(message.target)
+
+        if agent is None:
+            if message.target not in self.unknown_targets:
+                self.unknown_targets.add(message.target)
+                print("localsim: dropping messages to unknown agent %s" % message.target)
+            return
+
+        agent.receiveMessage(self, message.type, message.payload, message.source)
+        self.delivered += 1
+        self.message_counts[message.type] = self.message_counts.get(message.type, 0) + 1
+
+    def deliverWave(self, wave):
+        """ delivers every message of a wave in order, then queues what they dispatched """
+
+        for message in wave:
+            self.deliver(message)
+
+        outbox, self.outbox = self.outbox, []
+        for message in outbox:
+            self.post(message)
+
+        self.waves += 1
+
+    def popWave(self):
+        """ removes and returns every queued message due at the earliest timestamp """
+
+        if self.queue[0][0] != self.now:
+            self.timesteps += 1
+
+        self.now = self.queue[0][0]
+        wave = []
+
+        while self.queue and self.queue[0][0] == self.now:
+            wave.append(heapq.heappop(self.queue)[2])
+
+        return wave
+
+    def broadcast(self, type):
+        """ returns a wave with one message of the given type for every agent """
+
+        return [Message(self.now, SIMULATION_SOURCE, name, type, api.EmptyPayload()) for name in self.agent_order]
+
+    def run(self):
+        """
+        Runs the simulation to completion
+
+        Returns
+        -------
+        stats : dict
+            messages delivered (in total, per type and per timestep), waves and
+            wall time of the run
+        """
+
+        wall_start = time.perf_counter()
+        end = self.start + self.duration
+
+        self.now = self.start
+        self.timesteps = 1
+        self.deliverWave(self.broadcast("EVENT_SIMULATION_START"))
+
+        while self.queue and self.queue[0][0] <= end:
+            self.deliverWave(self.popWave())
+
+        ## anything dispatched while stopping is never delivered
+        self.now = end
+        self.deliverWave(self.broadcast("EVENT_SIMULATION_STOP"))
+        self.queue = []
+
+        return {"delivered" : self.delivered, "message_counts" : dict(self.message_counts), "timesteps" : self.timesteps,
+                "messages_per_timestep" : self.delivered / self.timesteps, "waves" : self.waves,
+                "wall_time" : time.perf_counter() - wall_start}
+
+
+class ExchangeAgent:
+    """ single asset exchange: matches limit and market orders, confirms them to
+        their sender and publishes fills to trade subscribers """
+
+    def __init__(self, name, params):
+
+        self.name = name
+        self.algorithm = params.get("algorithm", "PriceTime")
+        self.book = OrderBook(self.algorithm)
+        ## subscriber -> relative price move threshold, None for every trade
+        self.subscribers = {}
+        ## filtered subscriber -> last price in cents it was sent
+        self.sent_prices = {}
+        self.next_order_id = 0
+        self.next_trade_id = 0
+
+    def publishTrades(self, simulation, order, fills):
+        """ sends EVENT_TRADE for each fill of an incoming order to every subscriber """
+
+        timestamp = simulation.currentTimestamp()
+
+        for resting, volume, price in fills:
+
+            trade = api.Trade(self.next_trade_id, order.id, resting.id, order.direction, volume,
+                              api.Money.fromCents(price), timestamp)
+            self.next_trade_id += 1
+
+            payload = api.EventTradePayload(trade)
+            owners = (order.owner, resting.owner)
+
+            for subscriber, threshold in self.subscribers.items():
+
+                if threshold is not None and subscriber not in owners:
+                    last_price = self.sent_prices.get(subscriber)
+                    if last_price is not None and abs(price - last_price) <= threshold * last_price:
+                        continue
+
+                if threshold is not None:
+                    self.sent_prices[subscriber] = price
+
+                simulation.dispatchMessage(timestamp, 0, self.name, subscriber, "EVENT_TRADE", payload)
+
+    def placeOrder(self, simulation, payload, source, limit):
+        """ assigns an id to an incoming order, confirms it and matches it """
+
+        order = Order(self.next_order_id, source, payload.direction, payload.price.cents if limit else None, payload.volume)
+        self.next_order_id += 1
+
+        if limit:
+            response_type, response = "RESPONSE_PLACE_ORDER_LIMIT", api.PlaceOrderLimitResponsePayload(order.id, payload)
+        else:
+            response_type, response = "RESPONSE_PLACE_ORDER_MARKET", api.PlaceOrderMarketResponsePayload(order.id, payload)
+
+        simulation.dispatchMessage(simulation.currentTimestamp(), 0, self.name, source, response_type, response)
+
+        self.publishTrades(simulation, order, self.book.place(order))
+
+    def receiveMessage(self, simulation, type, payload, source):
+
+        if type == "PLACE_ORDER_LIMIT":
+            self.placeOrder(simulation, payload, source, True)
+
+        elif type == "PLACE_ORDER_MARKET":
+            self.placeOrder(simulation, payload, source, False)
+
+        elif type == "CANCEL_ORDERS":
+            for cancellation in payload.cancellations:
+                self.book.cancel(cancellation.id, cancellation.volume, source)
+
+            simulation.dispatchMessage(simulation.currentTimestamp(), 0, self.name, source, "RESPONSE_CANCEL_ORDERS",
+                                       api.CancelOrdersResponsePayload(payload))
+
+        elif type == "SUBSCRIBE_EVENT_TRADE":
+            self.subscribers[source] = None
+
+        elif type == "SUBSCRIBE_EVENT_TRADE_FILTERED":
+            self.subscribers[source] = float(payload["threshold"])
+
+
+class TradeLogAgent:
+    """ logs every trade of one exchange to SimulationData/<name>.csv """
+
+    def __init__(self, name, params):
+
+        self.name = name
+        self.exchange = params["exchange"]
+        self.lines = []
+
+    def receiveMessage(self, simulation, type, payload, source):
+
+        if type == "EVENT_SIMULATION_START":
+            simulation.dispatchMessage(simulation.currentTimestamp(), 0, self.name, self.exchange, "SUBSCRIBE_EVENT_TRADE",
+                                       api.EmptyPayload())
+
+        elif type == "EVENT_TRADE":
+            trade = payload.trade
+            self.lines.append("%d,%d,%d,%s,%d,%s\n" % (trade.timestamp(), trade.aggressingOrderID(), trade.restingOrderID(),
+                                                      trade.direction().name, trade.volume(), trade.price().toCentString()))
+
+        elif type == "EVENT_SIMULATION_STOP":
+            if not os.path.isdir("SimulationData"):
+                os.mkdir("SimulationData")
+
+            with open("SimulationData/" + self.name + ".csv", "w") as f:
+                f.write("timestamp,aggressing_id,resting_id,direction,volume,price\n")
+                f.writelines(self.lines)
+
+
+class PriceDataAgent:
+    """ follows the trades of every exchange and sends subscribers batched snapshots of
+        the last traded prices that changed since the previous snapshot """
+
+    def __init__(self, name, params):
+
+        self.name = name
+        ## exchanges are only followed once someone wants their prices
+        self.exchanges = set()
+        self.interval = int(params.get("snapshot_interval", 10))
+        ## subscriber -> exchanges it wants prices of
+        self.subscribers = {}
+        ## exchange -> last traded price in cents, since the previous snapshot
+        self.changed = {}
+        self.timer_set = False
+
+    def sendSnapshots(self, simulation):
+
+        timestamp = simulation.currentTimestamp()
+
+        for subscriber, exchanges in self.subscribers.items():
+
+            prices = {exchange : self.changed[exchange] / 100 for exchange in exchanges if exchange in self.changed}
+            if prices:
+                simulation.dispatchGenericMessage(timestamp, 0, self.name, subscriber, "EVENT_PRICE_SNAPSHOT", {"prices" : prices})
+
+        self.changed = {}
+
+    def receiveMessage(self, simulation, type, payload, source):
+
+        if type == "EVENT_TRADE":
+            self.changed[source] = payload.trade.price().cents
+
+        elif type == "SUBSCRIBE_PRICE_SNAPSHOTS":
+            self.subscribers[source] = list(payload["exchanges"])
+
+            for exchange in self.subscribers[source]:
+                if exchange not in self.exchanges:
+                    self.exchanges.add(exchange)
+                    simulation.dispatchMessage(simulation.currentTimestamp(), 0, self.name, exchange, "SUBSCRIBE_EVENT_TRADE",
+                                               api.EmptyPayload())
+
+        elif type == "SNAPSHOT":
+            self.timer_set = False
+            self.sendSnapshots(simulation)
+
+        if self.subscribers and not self.timer_set:
+            simulation.dispatchGenericMessage(simulation.currentTimestamp(), self.interval, self.name, self.name, "SNAPSHOT", {})
+            self.timer_set = True
+
+
+class InertAgent:
+    """ placeholder for simulator agents with no local behaviour """
+
+    def __init__(self, name, params):
+
+        self.name = name
+
+    def receiveMessage(self, simulation, type, payload, source):
+
+        pass
+
+
+BUILTIN_AGENTS = {
+    "ExchangeAgent" : ExchangeAgent,
+    "TradeLogAgent" : TradeLogAgent,
+    "PriceDataAgent" : PriceDataAgent,
+    "ShockAgent" : InertAgent,
+}
+
+
+class AgentName:
+    """ bound as agent.name, returns the agent's name like the simulator's agents do """
+
+    def __init__(self, name):
+
+        self.agent_name = name
+
+    def __call__(self):
+
+        return self.agent_name
+
+
+def installSimulatorModule():
+    """ makes `from thesimulator import *` in agent scripts resolve to the stand-in """
+
+    sys.modules["thesimulator"] = api
+
+def loadAgentModule(fp):
+    """ imports an agent script once, its directory is put on sys.path so its own imports resolve """
+
+    path = os.path.abspath(fp)
+
+    if path not in _AGENT_MODULES:
+
+        installSimulatorModule()
+
+        directory = os.path.dirname(path)
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+
+        module_name = "localsim_agent_" + str(len(_AGENT_MODULES))
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+
+        _AGENT_MODULES[path] = module
+
+    return _AGENT_MODULES[path]
+
+def resolveAgentPath(fp, scenario_dir):
+    """ resolves fp against the working directory like the simulator does, falling back to the scenario's directory """
+
+    if os.path.isabs(fp) or os.path.exists(fp):
+        return fp
+
+    return os.path.join(scenario_dir, fp)
+
+def createAgent(tag, params, scenario_dir):
+    """ creates and configures the agent of one scenario element, None if it has no local implementation """
+
+    name = params["name"]
+
+    if "fp" in params:
+        module = loadAgentModule(resolveAgentPath(params["fp"], scenario_dir))
+        agent = getattr(module, tag)()
+        agent.name = AgentName(name)
+        agent.configure(params)
+        return agent
+
+    if tag in BUILTIN_AGENTS:
+        return BUILTIN_AGENTS[tag](name, params)
+
+    print("localsim: no local implementation of %s, skipping %s" % (tag, name))
+
+    return None
+
+def readScenario(path):
+    """ yields (tag, attributes) of the Simulation element, then of every agent element,
+        parsed incrementally so large scenarios are never held as a tree """
+
+    for event, element in ET.iterparse(path, events=("start", "end")):
+
+        if event == "start":
+            if element.getparent() is None:
+                yield element.tag, dict(element.attrib)
+            continue
+
+        if element.getparent() is None or not isinstance(element.tag, str):
+            continue
+
+        yield element.tag, dict(element.attrib)
+
+        ## drop parsed elements so memory stays flat
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+def loadScenario(path, duration=None):
+    """
+    Builds a simulation from a scenario XML file, parsed incrementally so
+    large scenarios are never held as a tree
+
+    Parameters
+    ----------
+    path : string
+        scenario XML file
+
+    duration : int, optional
+        overrides the duration in the file
+
+    Returns
+    -------
+    simulation : Simulation
+        simulation with every agent created and configured
+    """
+
+    scenario_dir = os.path.dirname(os.path.abspath(path))
+    elements = readScenario(path)
+
+    _, attributes = next(elements)
+    simulation = Simulation(int(attributes.get("start", 0)), int(attributes.get("duration", 10000)))
+
+    for tag, params in elements:
+
+        agent = createAgent(tag, params, scenario_dir)
+        if agent is not None:
+            simulation.addAgent(params["name"], agent)
+
+    if duration is not None:
+        simulation.duration = duration
+
+    return simulation
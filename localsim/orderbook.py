@@ -0,0 +1,245 @@
+"""
+Summary: limit order book used by the local exchange
+
+         Notes:
+
+         - prices are integer cents. each side keeps a sorted array of the
+         prices that have resting orders and a dict from price to its level,
+         a level being a FIFO of orders
+
+         - an order id -> order index makes cancel lookups O(1), finding or
+         adding a price level is a binary search over the price array
+
+         - two allocation rules within a level: "PriceTime", plain FIFO, and
+         "PureProRata", where an incoming order is split across the level in
+         proportion to resting volume and rounding leftovers go out in
+         arrival order
+
+"""
+
+import bisect
+
+from localsim.thesimulator import OrderDirection
+
+
+ALGORITHMS = ("PriceTime", "PureProRata")
+
+
+class Order:
+    """ an order resting in (or arriving at) the book """
+
+    __slots__ = ("id", "owner", "direction", "price", "volume")
+
+    def __init__(self, order_id, owner, direction, price, volume):
+
+        self.id = order_id
+        self.owner = owner
+        self.direction = direction
+        self.price = price
+        self.volume = volume
+
+
+class PriceLevel:
+    """ the orders resting at one price, in arrival order """
+
+    __slots__ = ("orders", "volume")
+
+    def __init__(self):
+
+        ## dicts keep insertion order and drop any key in O(1)
+        self.orders = {}
+        self.volume = 0
+
+    def append(self, order):
+
+        self.orders[order.id] = order
+        self.volume += order.volume
+
+
+class BookSide:
+    """ the price levels of one side of the book """
+
+    def __init__(self, direction):
+
+        self.direction = direction
+        ## ascending sort keys, bid prices are negated so the best level is always keys[0]
+        self.keys = []
+        self.levels = {}
+
+    def key(self, price):
+
+        return -price if self.direction == OrderDirection.Buy else price
+
+    def level(self, price):
+        """ returns the level at price, creating it if needed """
+
+        level = self.levels.get(price)
+
+        if level is None:
+            level = PriceLevel()
+            self.levels[price] = level
+            bisect.insort(self.keys, self.key(price))
+
+        return level
+
+    def removeLevel(self, price):
+
+        del self.levels[price]
+        del self.keys[bisect.bisect_left(self.keys, self.key(price))]
+
+    def bestPrice(self):
+
+        return self.key(self.keys[0]) if self.keys else None
+
+
+class OrderBook:
+    """ limit order book of a single asset
+
+    Attributes
+    ----------
+    algorithm : string
+        allocation rule within a price level, one of ALGORITHMS
+
+    bids, asks : BookSide
+        the two sides of the book
+
+    index : dict
+        order id -> resting order
+    """
+
+    def __init__(self, algorithm="PriceTime"):
+
+        if algorithm not in ALGORITHMS:
+            raise ValueError("unknown matching algorithm %s, expected one of %s" % (algorithm, ", ".join(ALGORITHMS)))
+
+        self.algorithm = algorithm
+        self.bids = BookSide(OrderDirection.Buy)
+        self.asks = BookSide(OrderDirection.Sell)
+        self.index = {}
+
+    def _side(self, direction):
+
+        return self.bids if direction == OrderDirection.Buy else self.asks
+
+    def _crosses(self, order, price):
+
+        if order.price is None:
+            return True
+        if order.direction == OrderDirection.Buy:
+            return order.price >= price
+
+        return order.price <= price
+
+    def _allocate(self, level, volume):
+        """ returns [(resting order, volume)] filling volume against a single level """
+
+        if volume >= level.volume:
+            return [(resting, resting.volume) for resting in level.orders.values()]
+
+        allocations = []
+
+        if self.algorithm == "PriceTime":
+            for resting in level.orders.values():
+                fill = min(volume, resting.volume)
+                allocations.append((resting, fill))
+                volume -= fill
+                if volume == 0:
+                    break
+            return allocations
+
+        ## pro rata shares rounded down, leftover units handed out one at a time in arrival order
+        shares = [(resting, volume * resting.volume // level.volume) for resting in level.orders.values()]
+        leftover = volume - sum(share for _, share in shares)
+
+        for resting, share in shares:
+            if leftover > 0 and share < resting.volume:
+                share += 1
+                leftover -= 1
+            if share > 0:
+                allocations.append((resting, share))
+
+        return allocations
+
+    def place(self, order):
+        """
+        Matches an incoming order against the opposite side, resting any
+        remaining volume of a limit order
+
+        Parameters
+        ----------
+        order : Order
+            incoming order, price None for a market order
+
+        Returns
+        -------
+        fills : list
+            (resting order, volume, price) of every fill, in matching order
+        """
+
+        opposite = self.asks if order.direction == OrderDirection.Buy else self.bids
+        fills = []
+
+        while order.volume > 0 and opposite.keys:
+
+            price = opposite.bestPrice()
+            if not self._crosses(order, price):
+                break
+
+            level = opposite.levels[price]
+
+            for resting, volume in self._allocate(level, order.volume):
+
+                fills.append((resting, volume, price))
+                order.volume -= volume
+                resting.volume -= volume
+                level.volume -= volume
+
+                if resting.volume == 0:
+                    del level.orders[resting.id]
+                    del self.index[resting.id]
+
+            if not level.orders:
+                opposite.removeLevel(price)
+
+        if order.volume > 0 and order.price is not None:
+            self._side(order.direction).level(order.price).append(order)
+            self.index[order.id] = order
+
+        return fills
+
+    def cancel(self, order_id, volume, owner=None):
+        """ cancels up to volume of a resting order, returns the order or None if it is not
+            resting (or, if owner is given, not owned by owner) """
+
+        order = self.index.get(order_id)
+
+        if order is None or (owner is not None and order.owner != owner):
+            return None
+
+        side = self._side(order.direction)
+        level = side.levels[order.price]
+
+        cancelled = min(volume, order.volume)
+        order.volume -= cancelled
+        level.volume -= cancelled
+
+        if order.volume == 0:
+            del level.orders[order.id]
+            del self.index[order.id]
+            if not level.orders:
+                side.removeLevel(order.price)
+
+        return order
+
+    def bestBid(self):
+
+        return self.bids.bestPrice()
+
+    def bestAsk(self):
+
+        return self.asks.bestPrice()
+
+    def __len__(self):
+        """ number of resting orders """
+
+        return len(self.index)
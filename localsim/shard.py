@@ -0,0 +1,336 @@
+"""
+Summary: sharded execution of a scenario, python agents spread over worker
+         processes while the coordinator keeps the event queue and the
+         simulator's own agents
+
+         Notes:
+
+         - python agents are dealt round robin to the shards in scenario
+         order. every wave is split by target: each shard gets its part in
+         one message, the coordinator delivers its own part meanwhile, and
+         whatever each delivery dispatched is merged back by its position in
+         the wave. the queue is then exactly the one a single process
+         builds, so a sharded run is bit-identical to an unsharded one
+
+         - asset dictionaries are loaded once by the coordinator and placed
+         in shared memory, workers map them into their asset cache instead
+         of parsing the files
+
+         - fills agents log through tradelog are handed back with each
+         delivery and written by the coordinator, in delivery order. the
+         shared history spill (history_spill="shared") is not supported,
+         loadShardedScenario raises ValueError for it, per-agent spills are
+
+         - instrumented agents (see instrument.py) of shard n write their
+         aggregate to SimulationData/Profile.shard<n>.json, and profiled
+         ones (see profiler.py) their samples to SimulationData/Samples.shard<n>
+
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+
+from localsim.engine import Simulation, createAgent, readScenario
+from portfolio import AssetData, cacheAssetData, loadAssetData
+from tradelog import drainTradeLogs, flushTradeLogs, openTradeLog
+import instrument
+import profiler
+
+
+## shared memory blocks a worker has mapped, kept alive for the life of the process
+_SHARED_BLOCKS = []
+
+
+def shareAssetData(asset_file):
+    """
+    Copies an asset dictionary into shared memory
+
+    Parameters
+    ----------
+    asset_file : string
+        asset dictionary, as named by the agents
+
+    Returns
+    -------
+    blocks : list
+        the SharedMemory blocks, to be unlinked once the run is over
+
+    descriptor : tuple
+        (path, assets, {field : (block name, shape, dtype)}) for attachAssetData
+    """
+
+    asset_data = loadAssetData(asset_file)
+    blocks = []
+    fields = {}
+
+    for field in ("exp_prices", "variances", "cholesky"):
+
+        array = getattr(asset_data, field)
+        if array is None:
+            continue
+
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+
+        blocks.append(block)
+        fields[field] = (block.name, array.shape, array.dtype.str)
+
+    return blocks, (asset_data.file, asset_data.assets, fields)
+
+def attachAssetData(descriptor):
+    """ maps an asset dictionary shared by shareAssetData into this process's asset cache """
+
+    path, assets, fields = descriptor
+    arrays = {}
+
+    for field, (name, shape, dtype) in fields.items():
+
+        block = shared_memory.SharedMemory(name=name)
+        _SHARED_BLOCKS.append(block)
+        arrays[field] = np.ndarray(shape, dtype, buffer=block.buf)
+
+    cacheAssetData(AssetData(path, assets, arrays["exp_prices"], arrays["variances"], arrays.get("cholesky")))
+
+def deliverBatch(simulation, batch, drain=True):
+    """ delivers (position, message) pairs in order, returning (position, dispatched messages,
+        trade log records) of each. with drain off the trade logs are left alone and every
+        delivery returns no records """
+
+    results = []
+
+    for position, message in batch:
+
+        simulation.outbox = []
+        simulation.deliver(message)
+        results.append((position, simulation.outbox, drainTradeLogs() if drain else []))
+
+    simulation.outbox = []
+
+    return results
+
+def runShard(connection, shard, elements, scenario_dir, asset_descriptors):
+    """ worker process: creates its agents, then delivers the waves the coordinator sends
+        until told to stop """
+
+    instrument.AGGREGATE_PATH = "SimulationData/Profile.shard%d.json" % shard
+    profiler.OUTPUT_PATH = "SimulationData/Samples.shard%d" % shard
+
+    for descriptor in asset_descriptors:
+        attachAssetData(descriptor)
+
+    simulation = Simulation()
+
+    for tag, params in elements:
+        agent = createAgent(tag, params, scenario_dir)
+        if agent is not None:
+            simulation.addAgent(params["name"], agent)
+
+    connection.send(list(simulation.agents))
+
+    while True:
+
+        command = connection.recv()
+        if command is None:
+            break
+
+        simulation.now, batch = command
+        connection.send(deliverBatch(simulation, batch))
+
+    connection.close()
+
+
+class ShardedSimulation(Simulation):
+    """ Simulation whose python agents run in worker processes
+
+    Attributes
+    ----------
+    num_shards : int
+        number of worker processes
+
+    shard_of : dict
+        agent name -> shard running it
+    """
+
+    def __init__(self, start=0, duration=10000, num_shards=2):
+
+        super().__init__(start, duration)
+
+        self.num_shards = num_shards
+        self.shard_of = {}
+        self.shard_elements = [[] for _ in range(num_shards)]
+        self.connections = []
+        self.processes = []
+        self.shared_blocks = []
+
+    def addShardAgent(self, tag, params):
+        """ registers a python agent, to be created by the next shard in turn """
+
+        name = params["name"]
+
+        if name in self.agents or name in self.shard_of:
+            raise ValueError("duplicate agent name %s" % name)
+
+        shard = len(self.shard_of) % self.num_shards
+
+        self.shard_of[name] = shard
+        self.shard_elements[shard].append((tag, params))
+        self.agent_order.append(name)
+
+    def startShards(self, scenario_dir):
+        """ shares the agents' asset dictionaries and starts the worker processes """
+
+        asset_files = sorted({params["asset_file"] for elements in self.shard_elements for _, params in elements
+                              if "asset_file" in params})
+
+        asset_descriptors = []
+        for asset_file in asset_files:
+            blocks, descriptor = shareAssetData(asset_file)
+            self.shared_blocks.extend(blocks)
+            asset_descriptors.append(descriptor)
+
+        context = multiprocessing.get_context()
+
+        for shard, elements in enumerate(self.shard_elements):
+
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=runShard, args=(worker_connection, shard, elements, scenario_dir, asset_descriptors),
+                                      daemon=True)
+            process.start()
+            worker_connection.close()
+
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        ## wait for every agent to be configured
+        for shard, connection in enumerate(self.connections):
+            missing = {params["name"] for _, params in self.shard_elements[shard]} - set(connection.recv())
+            for name in missing:
+                del self.shard_of[name]
+                self.agent_order.remove(name)
+
+    def stopShards(self):
+        """ stops the workers and releases shared memory """
+
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+
+        for process in self.processes:
+            process.join()
+
+        for block in self.shared_blocks:
+            block.close()
+            block.unlink()
+
+        self.connections, self.processes, self.shared_blocks = [], [], []
+
+    def deliverWave(self, wave):
+        """ delivers a wave across the shards and the coordinator, queueing what each delivery
+            dispatched in wave order """
+
+        batches = [[] for _ in range(self.num_shards)]
+        local = []
+
+        for position, message in enumerate(wave):
+
+            shard = self.shard_of.get(message.target)
+            if shard is None:
+                local.append((position, message))
+            else:
+                batches[shard].append((position, message))
+
+        for shard, batch in enumerate(batches):
+            if batch:
+                self.connections[shard].send((self.now, batch))
+
+        results = [None] * len(wave)
+
+        ## the coordinator's logs hold the records of earlier waves, draining them here would
+        ## write those again at this wave's position
+        for position, outbox, records in deliverBatch(self, local, drain=False):
+            results[position] = (outbox, records)
+
+        for shard, batch in enumerate(batches):
+
+            if not batch:
+                continue
+
+            for position, outbox, records in self.connections[shard].recv():
+
+                message = wave[position]
+                self.delivered += 1
+                self.message_counts[message.type] = self.message_counts.get(message.type, 0) + 1
+
+                results[position] = (outbox, records)
+
+        for outbox, records in results:
+
+            for path, path_records in records:
+                openTradeLog(path).extend(path_records)
+
+            for message in outbox:
+                self.post(message)
+
+        self.waves += 1
+
+    def run(self):
+
+        try:
+            return super().run()
+        finally:
+            flushTradeLogs()
+            self.stopShards()
+
+
+def loadShardedScenario(path, num_shards, duration=None):
+    """
+    Builds a sharded simulation from a scenario XML file and starts its
+    worker processes
+
+    Parameters
+    ----------
+    path : string
+        scenario XML file
+
+    num_shards : int
+        number of worker processes running the python agents
+
+    duration : int, optional
+        overrides the duration in the file
+
+    Returns
+    -------
+    simulation : ShardedSimulation
+        simulation with every agent created and configured
+    """
+
+    scenario_dir = os.path.dirname(os.path.abspath(path))
+    elements = readScenario(path)
+
+    _, attributes = next(elements)
+    simulation = ShardedSimulation(int(attributes.get("start", 0)), int(attributes.get("duration", 10000)), num_shards)
+
+    for tag, params in elements:
+
+        if "fp" in params:
+            ## each worker would spill into its own copy of the shared history
+            if params.get("history_spill") == "shared":
+                raise ValueError("%s: history_spill=\"shared\" is not supported in a sharded run" % params["name"])
+            simulation.addShardAgent(tag, params)
+            continue
+
+        agent = createAgent(tag, params, scenario_dir)
+        if agent is not None:
+            simulation.addAgent(params["name"], agent)
+
+    if duration is not None:
+        simulation.duration = duration
+
+    simulation.startShards(scenario_dir)
+
+    return simulation
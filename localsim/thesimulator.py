@@ -0,0 +1,174 @@
+"""
+Summary: pure python stand-in for the parts of the compiled thesimulator
+         module that agent scripts use, so they can run on the local engine
+
+         Notes:
+
+         - only the surface used by the agents in this repository is
+         provided: Money, OrderDirection, the order placement / cancellation
+         payloads and the trade event payload
+
+         - Money keeps integer cents, as toCentString is what agents read
+
+"""
+
+import enum
+
+
+class Money:
+    """ an amount of money, stored as integer cents """
+
+    __slots__ = ("cents",)
+
+    def __init__(self, value=0):
+
+        self.cents = int(round(float(value) * 100))
+
+    @classmethod
+    def fromCents(cls, cents):
+        """ returns Money holding the given integer number of cents """
+
+        money = cls()
+        money.cents = int(cents)
+
+        return money
+
+    def toCentString(self):
+        """ returns the amount formatted with two decimals, e.g. 130.92 """
+
+        sign = "-" if self.cents < 0 else ""
+        whole, cents = divmod(abs(self.cents), 100)
+
+        return "%s%d.%02d" % (sign, whole, cents)
+
+    def __eq__(self, other):
+
+        return isinstance(other, Money) and self.cents == other.cents
+
+    def __hash__(self):
+
+        return hash(self.cents)
+
+    def __repr__(self):
+
+        return "Money(%s)" % self.toCentString()
+
+
+class OrderDirection(enum.Enum):
+
+    Buy = 0
+    Sell = 1
+
+
+class EmptyPayload:
+    """ payload of messages that carry no data """
+
+    pass
+
+
+class PlaceOrderLimitPayload:
+
+    def __init__(self, direction, volume, price):
+
+        self.direction = direction
+        self.volume = int(volume)
+        self.price = price
+
+
+class PlaceOrderMarketPayload:
+
+    def __init__(self, direction, volume):
+
+        self.direction = direction
+        self.volume = int(volume)
+
+
+class PlaceOrderLimitResponsePayload:
+    """ confirmation of a limit order, carrying the id the exchange assigned """
+
+    def __init__(self, order_id, request_payload):
+
+        self.id = order_id
+        self.requestPayload = request_payload
+
+
+class PlaceOrderMarketResponsePayload:
+
+    def __init__(self, order_id, request_payload):
+
+        self.id = order_id
+        self.requestPayload = request_payload
+
+
+class CancelOrdersCancellation:
+
+    def __init__(self, order_id, volume):
+
+        self.id = order_id
+        self.volume = int(volume)
+
+
+class CancelOrdersPayload:
+
+    def __init__(self, cancellations):
+
+        self.cancellations = list(cancellations)
+
+
+class CancelOrdersResponsePayload:
+
+    def __init__(self, request_payload):
+
+        self.requestPayload = request_payload
+
+
+class Trade:
+    """ a single fill between an aggressing and a resting order """
+
+    __slots__ = ("_id", "_aggressing", "_resting", "_direction", "_volume", "_price", "_timestamp")
+
+    def __init__(self, trade_id, aggressing_id, resting_id, direction, volume, price, timestamp):
+
+        self._id = trade_id
+        self._aggressing = aggressing_id
+        self._resting = resting_id
+        self._direction = direction
+        self._volume = volume
+        self._price = price
+        self._timestamp = timestamp
+
+    def id(self):
+
+        return self._id
+
+    def aggressingOrderID(self):
+
+        return self._aggressing
+
+    def restingOrderID(self):
+
+        return self._resting
+
+    def direction(self):
+        """ direction of the aggressing order """
+
+        return self._direction
+
+    def volume(self):
+
+        return self._volume
+
+    def price(self):
+
+        return self._price
+
+    def timestamp(self):
+
+        return self._timestamp
+
+
+class EventTradePayload:
+
+    def __init__(self, trade):
+
+        self.trade = trade
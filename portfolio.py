@@ -14,12 +14,407 @@ Summary: series of functions to aid with portfolio calculation, to isolate
          They will be mapped to floats on such a basis, very important to
          avoid confusion
 
+         - asset dictionaries are parsed once per interpreter and cached,
+         keyed by file path and modification stamp, so every agent shares
+         the same arrays. the stamp of a binary dictionary covers its .npy
+         files as well. see loadAssetData and invalidateAssetCache
+
+         - an asset dictionary is either plain json with a nested "variances"
+         list, or a json header naming "variances_file" (and optionally
+         "cholesky_file") .npy files next to it. the binary matrices are
+         memory-mapped read-only, so agent processes share the same pages
+         and only watched submatrices are ever copied
+
 
 """
 
 import json
-from maxe.simulation import numpy as np
-from numpy.linalg import inv
+import os
+import numpy as np
+from scipy.linalg import LinAlgError, cho_factor, cho_solve, lu_factor, lu_solve
+
+
+## process-wide cache of parsed asset dictionaries, shared by every agent
+## running in this interpreter. maps absolute path -> (stamp, AssetData, .npy files it references)
+_ASSET_CACHE = {}
+_ASSET_CACHE_STATS = {"hits" : 0, "misses" : 0, "invalidations" : 0}
+
+## mean-variance models built from cached asset data,
+## maps (absolute path, watched indices) -> MeanVarianceModel
+_MODEL_CACHE = {}
+
+
+class AssetData:
+    """ parsed contents of a single asset dictionary
+
+    Attributes
+    ----------
+    file : string
+        absolute path of the asset dictionary
+
+    assets : list
+        names of the assets, in dictionary order
+
+    asset_index : dict
+        maps asset name to its index in the dictionary
+
+    exp_prices : nparray
+        read-only vector of expected prices
+
+    variances : nparray
+        read-only covariance matrix of the assets
+
+    cholesky : nparray or None
+        read-only lower triangular factor of variances, if the dictionary
+        stores one
+    """
+
+    def __init__(self, file, assets, exp_prices, variances, cholesky=None):
+
+        self.file = file
+        self.assets = list(assets)
+        self.asset_index = {name : num for num, name in enumerate(self.assets)}
+
+        ## arrays are shared between agents, guard against accidental mutation
+        self.exp_prices = np.asarray(exp_prices, dtype=float)
+        self.exp_prices.setflags(write=False)
+
+        self.variances = np.asarray(variances, dtype=float)
+        self.variances.setflags(write=False)
+
+        self.cholesky = None
+        if cholesky is not None:
+            self.cholesky = np.asarray(cholesky, dtype=float)
+            self.cholesky.setflags(write=False)
+
+
+def _assetFileStamp(path, binary_files=()):
+    """ returns the value used to detect that an asset file, or the .npy files its header
+        references, changed on disk """
+
+    stamp = ()
+
+    for file in (path,) + tuple(binary_files):
+        stat = os.stat(file)
+        stamp += (stat.st_mtime_ns, stat.st_size)
+
+    return stamp
+
+def loadAssetData(file):
+    """
+    Returns the parsed asset dictionary stored in file, reading it from disk
+    only if it is not cached or has changed since it was cached. Binary
+    dictionaries are detected from their header and memory-mapped
+
+    Parameters
+    ----------
+    file : string
+        file containing mean-variance data about assets
+
+    Returns
+    -------
+    asset_data : AssetData
+        the cached asset dictionary
+    """
+
+    path = os.path.abspath(file)
+
+    entry = _ASSET_CACHE.get(path)
+    if entry is not None and entry[0] == _assetFileStamp(path, entry[2]):
+        _ASSET_CACHE_STATS["hits"] += 1
+        return entry[1]
+
+    _ASSET_CACHE_STATS["misses"] += 1
+
+    ## stamped before reading, so a file replaced meanwhile is picked up on the next call
+    stamp = _assetFileStamp(path)
+
+    with open(path) as f:
+        data = json.load(f)
+
+    ## binary format, the json is only a header and the matrices are memory-mapped .npy files
+    binary_files = ()
+    if "variances_file" in data:
+        directory = os.path.dirname(path)
+        binary_files = tuple(os.path.join(directory, data[key]) for key in ("variances_file", "cholesky_file")
+                             if data.get(key))
+
+    if binary_files:
+        stamp += _assetFileStamp(binary_files[0], binary_files[1:])
+        variances = np.load(binary_files[0], mmap_mode="r")
+        cholesky = np.load(binary_files[1], mmap_mode="r") if len(binary_files) > 1 else None
+    else:
+        variances = data["variances"]
+        cholesky = data.get("cholesky")
+
+    asset_data = AssetData(path, data["assets"], data["exp_prices"], variances, cholesky)
+    _ASSET_CACHE[path] = (stamp, asset_data, binary_files)
+
+    return asset_data
+
+def cacheAssetData(asset_data):
+    """ puts asset data built elsewhere in the cache for its file, e.g. arrays another process
+        placed in shared memory, so loadAssetData returns it instead of reading the file """
+
+    _ASSET_CACHE[asset_data.file] = (_assetFileStamp(asset_data.file), asset_data, ())
+
+def invalidateAssetCache(file=None):
+    """
+    Drops cached asset dictionaries so they are re-read on next use
+
+    Parameters
+    ----------
+    file : string, optional
+        asset dictionary to drop, if None the whole cache is cleared
+    """
+
+    if file is None:
+        _ASSET_CACHE_STATS["invalidations"] += len(_ASSET_CACHE)
+        _ASSET_CACHE.clear()
+        _MODEL_CACHE.clear()
+        return
+
+    path = os.path.abspath(file)
+
+    if _ASSET_CACHE.pop(path, None) is not None:
+        _ASSET_CACHE_STATS["invalidations"] += 1
+
+    for key in [key for key in _MODEL_CACHE if key[0] == path]:
+        del _MODEL_CACHE[key]
+
+def getAssetCacheStats():
+    """
+    Returns hit/miss counters of the asset dictionary cache
+
+    Returns
+    -------
+    stats : dict
+        hits, misses, invalidations and number of cached entries
+    """
+
+    stats = dict(_ASSET_CACHE_STATS)
+    stats["entries"] = len(_ASSET_CACHE)
+
+    return stats
+
+def resetAssetCacheStats():
+    """ zeroes the asset dictionary cache counters, leaves cached entries in place """
+
+    for key in _ASSET_CACHE_STATS:
+        _ASSET_CACHE_STATS[key] = 0
+
+
+
+class MeanVarianceModel:
+    """ mean-variance model of a fixed set of assets from one asset dictionary
+
+    The covariance submatrix is factorised once on construction, or taken
+    from the Cholesky factor stored in the asset dictionary when the model
+    covers a leading block of it, so tangency weights, portfolio risk and
+    expected return are all O(n^2) afterwards.
+    Cholesky is used when the submatrix is positive-definite, otherwise falls
+    back to an LU factorisation so that older asset dictionaries still load.
+
+    Attributes
+    ----------
+    tickers : nparray
+        indices of the modelled assets in the asset dictionary
+
+    exp_prices : nparray
+        expected prices of the modelled assets
+
+    risk_matrix : nparray
+        covariance submatrix of the modelled assets
+
+    cholesky : nparray or None
+        lower triangular factor of risk_matrix, None if it is not
+        positive-definite
+
+    inv_ones : nparray
+        precomputed inverse(risk_matrix) * 1
+    """
+
+    def __init__(self, tickers, file):
+
+        asset_data = loadAssetData(file)
+
+        self.asset_data = asset_data
+        self.tickers = np.asarray(tickers, dtype=int)
+        self.exp_prices = asset_data.exp_prices[self.tickers]
+        self.risk_matrix = asset_data.variances[np.ix_(self.tickers, self.tickers)]
+
+        num_tickers = len(self.tickers)
+
+        ## the leading block of a stored factor is the factor of the leading submatrix
+        if asset_data.cholesky is not None and np.array_equal(self.tickers, np.arange(num_tickers)):
+            self.cholesky = asset_data.cholesky[:num_tickers, :num_tickers]
+            self._factor = (self.cholesky, True)
+            self._solver = cho_solve
+            self.inv_ones = self.solve(np.ones(num_tickers))
+            return
+
+        try:
+            self._factor = cho_factor(self.risk_matrix, lower=True, check_finite=False)
+            self._solver = cho_solve
+            self.cholesky = np.tril(self._factor[0])
+        except LinAlgError:
+            self._factor = lu_factor(self.risk_matrix, check_finite=False)
+            self._solver = lu_solve
+            self.cholesky = None
+
+        self.inv_ones = self.solve(np.ones(len(self.tickers)))
+
+    def solve(self, b):
+        """ returns inverse(risk_matrix) * b using the stored factorisation,
+            b may be a vector or a matrix with one column per right hand side """
+
+        return self._solver(self._factor, b, check_finite=False)
+
+    def expectedReturns(self, current_prices):
+        """ returns the expected return of each asset at the given prices """
+
+        return self.exp_prices / np.asarray(current_prices, dtype=float)
+
+    def expectedReturn(self, weights, current_prices):
+        """ returns the expected return of a portfolio at the given prices """
+
+        return np.matmul(np.asarray(weights, dtype=float), self.expectedReturns(current_prices))
+
+    def portfolioRisk(self, weights):
+        """ returns the variance of a portfolio with the given weights """
+
+        weights = np.asarray(weights, dtype=float)
+
+        return np.matmul(np.matmul(weights, self.risk_matrix), weights)
+
+    def tangencyWeights(self, current_prices, rfr):
+        """ returns the weights of the tangency portfolio at the given prices """
+
+        excess_returns = self.expectedReturns(current_prices) - rfr
+
+        return self.tangencyFromExcess(excess_returns)
+
+    def tangencyFromExcess(self, excess_returns):
+        """ returns the tangency weights given a vector of excess returns,
+            inverse(risk_matrix) * 1 is symmetric so the denominator is a dot product """
+
+        numerator = self.solve(excess_returns)
+        denom = np.matmul(self.inv_ones, excess_returns)
+
+        return numerator / denom
+
+
+def getMeanVarianceModel(tickers, file):
+    """
+    Returns the mean-variance model for the given assets, building it only
+    once per (asset file, tickers) while the asset file is unchanged
+
+    Parameters
+    ----------
+    tickers : list
+        list of ints representing indices of modelled assets
+
+    file : string
+        file containing mean-variance data about assets
+
+    Returns
+    -------
+    model : MeanVarianceModel
+        shared model for the given assets
+    """
+
+    asset_data = loadAssetData(file)
+    key = (asset_data.file, tuple(int(t) for t in tickers))
+
+    model = _MODEL_CACHE.get(key)
+    if model is None or model.asset_data is not asset_data:
+        model = MeanVarianceModel(key[1], file)
+        _MODEL_CACHE[key] = model
+
+    return model
+
+
+class PortfolioBatch:
+    """ tangency portfolios and optimal market fractions of many agents that
+    share one mean-variance model, one row per agent
+
+    Attributes
+    ----------
+    weights : nparray
+        (num_agents x num_assets) tangency weights
+
+    fractions : nparray
+        fraction of wealth each agent should hold in its tangency portfolio
+
+    agent_rows : dict
+        maps agent id to its row in weights and fractions
+    """
+
+    def __init__(self, weights, fractions, agent_ids=None):
+
+        self.weights = weights
+        self.fractions = fractions
+
+        if agent_ids is None:
+            agent_ids = range(len(fractions))
+
+        self.agent_rows = {agent_id : row for row, agent_id in enumerate(agent_ids)}
+
+    def agentRow(self, agent_id):
+        """ returns (weights, fraction) precomputed for the given agent """
+
+        row = self.agent_rows[agent_id]
+
+        return self.weights[row], self.fractions[row]
+
+
+def batchOptimalPortfolios(model, price_matrix, rfr, risk_coeffs, agent_ids=None):
+    """
+    Solves the tangency portfolio and the optimal market fraction of every
+    agent at once against a single factorised covariance
+
+    Parameters
+    ----------
+    model : MeanVarianceModel
+        model shared by all agents in the batch
+
+    price_matrix : nparray
+        (num_agents x num_assets) current prices believed by each agent
+
+    rfr : float or nparray
+        the risk free rate, either shared or one per agent
+
+    risk_coeffs : nparray
+        risk aversion coefficient of each agent
+
+    agent_ids : list, optional
+        ids used to look agents up in the result, defaults to row numbers
+
+    Returns
+    -------
+    batch : PortfolioBatch
+        weights and fractions of every agent
+    """
+
+    prices = np.atleast_2d(np.asarray(price_matrix, dtype=float))
+    rfr = np.asarray(rfr, dtype=float)
+    if rfr.ndim == 1:
+        rfr = rfr[:, np.newaxis]
+
+    exp_returns = model.exp_prices / prices
+    excess_returns = exp_returns - rfr
+
+    ## one solve with a right hand side per agent
+    numerators = model.solve(excess_returns.T).T
+    denoms = np.matmul(excess_returns, model.inv_ones)
+    weights = numerators / denoms[:, np.newaxis]
+
+    ## same formula as SimpleCaseAgent.optimalFraction, row-wise
+    mkt_exp_return = np.einsum("ij,ij->i", weights, exp_returns)
+    mkt_risk = np.einsum("ij,ij->i", np.matmul(weights, model.risk_matrix), weights)
+    fractions = (mkt_exp_return - rfr.reshape(-1)) / (mkt_risk * np.asarray(risk_coeffs, dtype=float))
+
+    return PortfolioBatch(weights, fractions, agent_ids)
 
 
 def getExpPriceData(tickers, file):
@@ -41,18 +436,10 @@ def getExpPriceData(tickers, file):
         an array of the corresponding expected returns    
     """
 
-    with open(file) as f:
+    all_prices = loadAssetData(file).exp_prices
 
-        data = json.load(f)
-    
-    all_prices = data["exp_prices"]
-
-    # retrieve indices of tickers, append returns to list
-    exp_price = []
-    for t in tickers:
-        exp_price.append(all_prices[t])
-
-    return np.asarray(exp_price)
+    # retrieve indices of tickers, fancy indexing returns a private copy
+    return all_prices[np.asarray(tickers, dtype=int)]
     
 def getRiskMatrix(tickers, file):
     """
@@ -73,22 +460,11 @@ def getRiskMatrix(tickers, file):
         detailed in ticker
     """
 
-    # retrieving data
-    with open(file) as f:
-
-        data = json.load(f)
-
-    all_asset_risk = data["variances"]
-    matrix = []
+    all_asset_risk = loadAssetData(file).variances
 
     # subsetting overarching matrix
-    for i in tickers:
-        row = []
-        for j in tickers:
-            row.append(all_asset_risk[i][j])
-        matrix.append(row)
-    
-    risk_matrix = np.array(matrix)
+    indices = np.asarray(tickers, dtype=int)
+    risk_matrix = all_asset_risk[np.ix_(indices, indices)]
 
     return risk_matrix
 
@@ -116,13 +492,10 @@ def getExpRetData(tickers, current_price_data, file):
     
     exp_prices = getExpPriceData(tickers, file)
 
-    exp_returns = [0] * len(exp_prices)
-
     ## dividing exp price at end of period by current price 
-    for num in range(len(exp_prices)):
-        exp_returns[num] = exp_prices[num] / current_price_data[num]
+    exp_returns = exp_prices / np.asarray(current_price_data, dtype=float)
 
-    return np.array(exp_returns)
+    return exp_returns
 
 def calculate_expected_return(tickers, weights, current_prices, file):
     """
@@ -152,9 +525,7 @@ def calculate_expected_return(tickers, weights, current_prices, file):
     ## need to add a bit calculating the expected return here, should be just dividing elements in 
     ## the given current price by those in the expected price one, given by exp. price function
 
-    exp_return_data = getExpRetData(tickers, current_prices, file)
-
-    expected_return = np.matmul(np.array(weights).T, exp_return_data)
+    expected_return = getMeanVarianceModel(tickers, file).expectedReturn(weights, current_prices)
 
     return expected_return
 
@@ -185,17 +556,7 @@ def calculate_optimal_portfolio(tickers, rfr, current_price_data, file):
         corresponding weight in the portfolio
     """
 
-    risk_matrix = getRiskMatrix(tickers, file)
-
-    exp_return_data = getExpRetData(tickers, current_price_data, file)
-
-    risk_free_vec = np.ones(exp_return_data.shape) * rfr
-
-    numerator = np.matmul(inv(risk_matrix),(exp_return_data - risk_free_vec))
-
-    denom = np.matmul(np.ones(risk_matrix.shape[0]).T, np.matmul(inv(risk_matrix),(exp_return_data - risk_free_vec)))
-
-    t = numerator / denom
+    t = getMeanVarianceModel(tickers, file).tangencyWeights(current_price_data, rfr)
 
     return t
 
@@ -216,9 +577,7 @@ def calcPortfolioRisk(tickers, weights, file):
         the risk of the portfolio    
     """
 
-    risk_matrix = getRiskMatrix(tickers, file)
-
-    risk = np.matmul(np.matmul(np.array(weights).T, risk_matrix), np.array(weights))
+    risk = getMeanVarianceModel(tickers, file).portfolioRisk(weights)
 
     return risk
 
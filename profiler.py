@@ -0,0 +1,262 @@
+"""
+Summary: sampling profiler for the python side of a run, writing collapsed
+         stacks that flamegraph.pl, inferno or speedscope turn into a flame
+         graph
+
+         Notes:
+
+         - a background thread takes the stack of the thread running the
+         agents every interval seconds with sys._current_frames, so the cost
+         is per sample, not per call. stacks are rooted at the class of the
+         agent whose receiveMessage they are in, "[engine]" outside of any,
+         so each agent class gets its own tower in the flame graph and its
+         own sample count
+
+         - the sampler only runs once the sampled thread lets go of the
+         GIL. with the default 5ms switch interval that is nearly always in
+         a call that releases it (LAPACK, I/O), which would collect most
+         samples, so the switch interval is cut to SWITCH_INTERVAL while
+         sampling
+
+         - localsim starts a sampler around the whole run (python -m
+         localsim --profile). under TheSimulator the only python is the
+         agent scripts, so there agents start it from configure when the
+         MARKETSIM_PROFILE environment variable is 1 (simulate.py --profile
+         sets it), see profileAgent. samples are then only taken while the
+         simulator lets python run
+
+         - MARKETSIM_PROFILE_WINDOW="start:stop" (either end may be left
+         out) only keeps samples taken at simulation timestamps in
+         [start, stop], MARKETSIM_PROFILE_INTERVAL sets the interval in
+         seconds
+
+         - results go to OUTPUT_PATH + ".collapsed", one "frame;frame;...
+         count" line per distinct stack, and OUTPUT_PATH + ".json" holding
+         sample counts per agent class
+
+"""
+
+import collections
+import json
+import os
+import sys
+import threading
+
+
+ENV_VAR = "MARKETSIM_PROFILE"
+WINDOW_ENV_VAR = "MARKETSIM_PROFILE_WINDOW"
+INTERVAL_ENV_VAR = "MARKETSIM_PROFILE_INTERVAL"
+
+DEFAULT_INTERVAL = 0.001
+
+## samples are written next to the run's other results, localsim shard workers each get their own
+OUTPUT_PATH = "SimulationData/Samples"
+
+ENGINE_ROOT = "[engine]"
+
+## seconds the sampled thread may keep the GIL once the sampler asks for it
+SWITCH_INTERVAL = 0.00001
+
+## sampler started by agents under the simulator, shared by every agent in the interpreter
+_AGENT_SESSION = {"sampler" : None, "agents" : 0, "stopped" : 0, "now" : None}
+
+
+def parseWindow(window):
+    """
+    Parses a timestamp window given as "start:stop"
+
+    Parameters
+    ----------
+    window : string or None
+        "start:stop", either side may be empty for an open end
+
+    Returns
+    -------
+    window : tuple or None
+        (start, stop), None ends are unbounded, None if window is empty
+    """
+
+    if not window:
+        return None
+
+    start, _, stop = window.partition(":")
+
+    return (int(start) if start else None, int(stop) if stop else None)
+
+
+class StackSampler:
+    """ samples the stack of one thread at a fixed interval from a background thread
+
+    Attributes
+    ----------
+    interval : float
+        seconds between samples
+
+    window : tuple or None
+        (start, stop) simulation timestamps samples are kept in
+
+    stacks : Counter
+        (root, frame, ...) -> number of samples
+
+    classes : Counter
+        root (agent class) -> number of samples
+
+    skipped : int
+        samples taken outside the window
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, clock=None, window=None):
+
+        self.interval = interval
+        self.clock = clock
+        self.window = window
+
+        self.stacks = collections.Counter()
+        self.classes = collections.Counter()
+        self.skipped = 0
+
+        self.thread_id = None
+        self.thread = None
+        self.switch_interval = None
+        self.stop_event = threading.Event()
+
+    def inWindow(self):
+        """ returns whether the simulation is currently inside the window """
+
+        if self.window is None or self.clock is None:
+            return True
+
+        now = self.clock()
+        if now is None:
+            return False
+
+        start, stop = self.window
+
+        return (start is None or now >= start) and (stop is None or now <= stop)
+
+    def sample(self):
+        """ records the current stack of the sampled thread """
+
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        if not self.inWindow():
+            self.skipped += 1
+            return
+
+        frames = []
+        root = ENGINE_ROOT
+
+        while frame is not None:
+
+            code = frame.f_code
+            frames.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+
+            ## walking outwards, so the outermost receiveMessage names the agent
+            if code.co_name == "receiveMessage":
+                agent = frame.f_locals.get("self")
+                if agent is not None:
+                    root = type(agent).__name__
+
+            frame = frame.f_back
+
+        frames.append(root)
+        frames.reverse()
+
+        self.stacks[tuple(frames)] += 1
+        self.classes[root] += 1
+
+    def run(self):
+
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self, thread_id=None):
+        """ starts sampling thread_id, the calling thread by default """
+
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stop_event.clear()
+
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(SWITCH_INTERVAL)
+
+        self.thread = threading.Thread(target=self.run, name="StackSampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        sys.setswitchinterval(self.switch_interval)
+
+    def summary(self):
+        """ returns sample counts, in total and per agent class, as a dict """
+
+        return {"interval" : self.interval, "window" : self.window, "samples" : sum(self.classes.values()),
+                "skipped" : self.skipped, "classes" : dict(self.classes.most_common())}
+
+    def save(self, path=None):
+        """ writes path.collapsed and path.json, OUTPUT_PATH by default """
+
+        path = path or OUTPUT_PATH
+
+        with open(path + ".collapsed", "w") as f:
+            for frames, count in self.stacks.most_common():
+                f.write("%s %d\n" % (";".join(frames), count))
+
+        with open(path + ".json", "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+
+def profilingEnabled():
+    """ returns whether agents should start the profiler themselves, see MARKETSIM_PROFILE """
+
+    return int(os.environ.get(ENV_VAR) or 0)
+
+def samplerFromEnvironment(clock=None):
+    """ returns a sampler set up from MARKETSIM_PROFILE_INTERVAL and MARKETSIM_PROFILE_WINDOW """
+
+    interval = float(os.environ.get(INTERVAL_ENV_VAR) or DEFAULT_INTERVAL)
+
+    return StackSampler(interval, clock, parseWindow(os.environ.get(WINDOW_ENV_VAR)))
+
+def profileAgent(agent):
+    """
+    Starts the interpreter's sampler on the first call and hooks agent's
+    receiveMessage to keep its clock, saving the samples once every
+    profiled agent has received EVENT_SIMULATION_STOP
+
+    Parameters
+    ----------
+    agent : object
+        a configured agent, its receiveMessage is replaced on the instance
+    """
+
+    session = _AGENT_SESSION
+
+    if session["sampler"] is None:
+        session["sampler"] = samplerFromEnvironment(lambda: session["now"])
+        session["sampler"].start()
+
+    session["agents"] += 1
+    receive = agent.receiveMessage
+
+    ## not named receiveMessage, so samples are attributed to the agent's own frame
+    def profiledReceive(simulation, type, payload, source):
+
+        session["now"] = simulation.currentTimestamp()
+        receive(simulation, type, payload, source)
+
+        if type == "EVENT_SIMULATION_STOP":
+            session["stopped"] += 1
+            if session["stopped"] == session["agents"]:
+                session["sampler"].stop()
+                session["sampler"].save()
+
+    agent.receiveMessage = profiledReceive
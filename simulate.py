@@ -1,10 +1,27 @@
+import argparse
 import subprocess
-import sys
 import os
 
+import profiler
+
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="runs a simulation XML file with TheSimulator")
+    parser.add_argument("simulation")
+    parser.add_argument("--profile", action="store_true",
+                        help="agents sample the python stacks into SimulationData/Samples.collapsed")
+    parser.add_argument("--profile-window", default=None, help="START:STOP, only samples timestamps in the window")
+    parser.add_argument("--profile-interval", type=float, default=profiler.DEFAULT_INTERVAL, help="seconds between samples")
+    args = parser.parse_args()
+
+    ## the agent scripts are the only python TheSimulator runs, they start the profiler from the environment
+    env = dict(os.environ)
+    if args.profile:
+        env[profiler.ENV_VAR] = "1"
+        env[profiler.INTERVAL_ENV_VAR] = str(args.profile_interval)
+        env[profiler.WINDOW_ENV_VAR] = args.profile_window or ""
+
     os.chdir("maxe/build/TheSimulator/TheSimulator/")
     cwd = os.getcwd()
     # List all files and directories in the CWD
@@ -12,10 +29,9 @@ if __name__ == "__main__":
 
     # Print the contents
     for item in contents:
-        print(item) 
+        print(item)
     simulator = "/TheSimulator"
-    
-    simulation = sys.argv[1]
 
-    subprocess.run([cwd + simulator, simulation])
+    simulation = args.simulation
 
+    subprocess.run([cwd + simulator, simulation], env=env)
@@ -0,0 +1,268 @@
+"""
+Summary: parallel parameter sweeps. Every parameter set is generated with
+         AgentGen into its own working directory and run with TheSimulator
+         on a bounded process pool
+
+         Notes:
+
+         - a parameter set maps AgentGen settings (RFR, STEP_RATE,
+         REFRESH_RATE, NUM_NOISY, SEED, ..., see AGENTGEN_SETTINGS) plus
+         num_agents and num_assets to values. unset settings keep their
+         AgentGen defaults, SEED defaults to the run number so sweeps are
+         reproducible
+
+         - sweeps are given as a json file holding either a grid,
+         {"RFR" : [1.005, 1.01], "num_agents" : [100, 1000]}, expanded to
+         every combination, or a list of parameter sets
+
+         - the manifest, <out_dir>/manifest.json, records each run's
+         parameters, directory, outputs, status, attempts and wall time
+
+         - with profile set, each run's agents sample their stacks (see
+         profiler.py) into the run's SimulationData/Samples.collapsed
+
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import subprocess
+import time
+
+import AgentGen
+import profiler
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SIMULATOR = os.path.join(REPO_DIR, AgentGen.SIMULATOR_DIR, "TheSimulator")
+
+## AgentGen module constants a sweep may set, paths and templates are not among them
+AGENTGEN_SETTINGS = ("RFR", "STEP_RATE", "REFRESH_RATE", "CAPITAL_MU", "CAPITAL_SD", "SHARE_MU", "SHARE_SD",
+                     "PAYOFF_MIN", "PAYOFF_MAX", "RISK_COEFF_MU", "RISK_COEFF_SD", "VARIANCE_MIN", "VARIANCE_MAX",
+                     "NUM_FACTORS", "FACTOR_SCALE", "NUM_NOISY", "PRINT_TRADE", "SEED", "VERBOSE", "POPULATION_SIZE",
+                     "ENDOWMENT_FORMAT", "ENDOWMENT_FILE", "ASSET_FORMAT")
+
+## their values as imported, restored before every run since pool workers are reused
+AGENTGEN_DEFAULTS = {key : getattr(AgentGen, key) for key in AGENTGEN_SETTINGS}
+
+
+def expandGrid(grid):
+    """
+    Returns every combination of the values in grid
+
+    Parameters
+    ----------
+    grid : dict
+        parameter name -> list of values
+
+    Returns
+    -------
+    param_sets : list
+        one dict per combination
+    """
+
+    keys = sorted(grid)
+
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+def loadParamSets(path):
+    """ reads a sweep file, either a grid or a list of parameter sets """
+
+    with open(path) as f:
+        sweep = json.load(f)
+
+    if isinstance(sweep, dict):
+        return expandGrid(sweep)
+
+    return sweep
+
+def applyAgentGenParams(params):
+    """ sets AgentGen's module settings for one run, keeping the type of each default """
+
+    for key, value in AGENTGEN_DEFAULTS.items():
+        setattr(AgentGen, key, value)
+
+    for key, value in params.items():
+        if key in ("num_agents", "num_assets"):
+            continue
+        if key not in AGENTGEN_DEFAULTS:
+            raise KeyError("unknown AgentGen setting %s" % key)
+
+        ## RFR etc. are written straight into the XML as strings
+        default = AGENTGEN_DEFAULTS[key]
+        setattr(AgentGen, key, str(value) if isinstance(default, str) else value)
+
+    ## agents run from the scenario directory, not the simulator build
+    AgentGen.AGENT_FP = os.path.join(REPO_DIR, "SimpleCaseAgent.py")
+    AgentGen.POPULATION_FP = os.path.join(REPO_DIR, "SimpleCasePopulation.py")
+
+def runScenario(run_dir, params, simulator=SIMULATOR, timeout=None, retries=0, profile=None):
+    """
+    Generates and runs a single scenario, retrying failed or timed out runs
+
+    Parameters
+    ----------
+    run_dir : string
+        working directory of the run, created if missing
+
+    params : dict
+        parameter set of the run
+
+    simulator : string
+        path to the TheSimulator executable
+
+    timeout : float, optional
+        seconds before a run is killed
+
+    retries : int
+        number of extra attempts after a failure
+
+    profile : string, optional
+        profiles the run, "" for all of it or a "start:stop" timestamp window
+
+    Returns
+    -------
+    result : dict
+        manifest entry of the run
+    """
+
+    result = {"params" : params, "run_dir" : run_dir, "status" : "failed", "attempts" : 0, "returncode" : None}
+    start = time.perf_counter()
+
+    try:
+        applyAgentGenParams(params)
+        AgentGen.generateScenario(run_dir, int(params["num_agents"]), int(params["num_assets"]))
+    except Exception as e:
+        result["error"] = "generation failed: %r" % e
+        result["wall_time"] = time.perf_counter() - start
+        return result
+
+    ## agents import portfolio.py etc. from the repository
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+
+    if profile is not None:
+        env[profiler.ENV_VAR] = "1"
+        env[profiler.WINDOW_ENV_VAR] = profile
+
+    for attempt in range(retries + 1):
+
+        result["attempts"] = attempt + 1
+        attempt_start = time.perf_counter()
+
+        with open(os.path.join(run_dir, "simulator.log"), "w") as log:
+            try:
+                completed = subprocess.run([simulator, "scenario.xml"], cwd=run_dir, env=env, stdout=log,
+                                           stderr=subprocess.STDOUT, timeout=timeout)
+                result["returncode"] = completed.returncode
+                result["status"] = "ok" if completed.returncode == 0 else "failed"
+            except subprocess.TimeoutExpired:
+                result["status"] = "timeout"
+            except OSError as e:
+                result["error"] = "could not start simulator: %r" % e
+                break
+
+        result["run_time"] = time.perf_counter() - attempt_start
+
+        if result["status"] == "ok":
+            break
+
+    data_dir = os.path.join(run_dir, "SimulationData")
+    result["outputs"] = sorted(os.path.join(data_dir, f) for f in os.listdir(data_dir))
+    result["wall_time"] = time.perf_counter() - start
+
+    return result
+
+def writeManifest(path, results):
+    """ atomically writes the manifest of the runs finished so far """
+
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump({"runs" : [result for result in results if result is not None]}, f, indent=1)
+
+    os.replace(tmp_path, path)
+
+def runSweep(param_sets, out_dir, simulator=SIMULATOR, workers=None, timeout=None, retries=0, profile=None):
+    """
+    Runs every parameter set concurrently, each in out_dir/run_<n>
+
+    Parameters
+    ----------
+    param_sets : list
+        parameter sets, each needs num_agents and num_assets
+
+    out_dir : string
+        directory holding the run directories and the manifest
+
+    simulator : string
+        path to the TheSimulator executable
+
+    workers : int, optional
+        size of the process pool, defaults to the number of cores
+
+    timeout : float, optional
+        seconds before a single run is killed
+
+    retries : int
+        number of extra attempts for failed runs
+
+    profile : string, optional
+        profiles every run, "" for all of it or a "start:stop" timestamp window
+
+    Returns
+    -------
+    results : list
+        manifest entries, in the order of param_sets
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    results = [None] * len(param_sets)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+
+        futures = {}
+        for run_num, params in enumerate(param_sets):
+            params = dict(params)
+            params.setdefault("SEED", run_num)
+            run_dir = os.path.abspath(os.path.join(out_dir, "run_" + str(run_num)))
+            futures[pool.submit(runScenario, run_dir, params, simulator, timeout, retries, profile)] = run_num
+
+        for future in concurrent.futures.as_completed(futures):
+
+            run_num = futures[future]
+            results[run_num] = future.result()
+            results[run_num]["run"] = run_num
+
+            print("run %d: %s in %.1fs" % (run_num, results[run_num]["status"], results[run_num]["wall_time"]))
+
+            ## rewritten as runs finish so a killed sweep still leaves a usable manifest
+            writeManifest(manifest_path, results)
+
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="runs a parameter sweep of SimpleCaseAgent scenarios in parallel")
+    parser.add_argument("sweep_file", help="json grid or list of parameter sets")
+    parser.add_argument("out_dir")
+    parser.add_argument("--workers", type=int, default=None, help="process pool size, defaults to the number of cores")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds before a run is killed")
+    parser.add_argument("--retries", type=int, default=0, help="extra attempts for failed runs")
+    parser.add_argument("--simulator", default=SIMULATOR, help="path to the TheSimulator executable")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="START:STOP",
+                        help="profiles every run, optionally only a window of timestamps")
+    args = parser.parse_args()
+
+    runSweep(loadParamSets(args.sweep_file), args.out_dir, args.simulator, args.workers, args.timeout, args.retries,
+             args.profile)
+
+
+if __name__ == "__main__":
+    main()
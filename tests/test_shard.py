@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import AgentGen
+from localsim.shard import loadShardedScenario
+
+
+def runLocalsim(directory, shards):
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+
+    subprocess.run([sys.executable, "-m", "localsim", "scenario.xml", "--duration", "600", "--shards", str(shards)],
+                   cwd=directory, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    with open(os.path.join(directory, "SimulationData", "Trades.bin"), "rb") as f:
+        return f.read()
+
+def test_sharded_trade_log_matches_unsharded(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(AgentGen, "SEED", 3)
+    monkeypatch.setattr(AgentGen, "AGENT_FP", os.path.join(ROOT, "SimpleCaseAgent.py"))
+
+    AgentGen.generateScenario(str(tmp_path), 20, 5)
+
+    unsharded = runLocalsim(tmp_path, 1)
+    sharded = runLocalsim(tmp_path, 3)
+
+    assert unsharded
+    assert sharded == unsharded
+
+def test_sharded_scenario_rejects_shared_spill(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(AgentGen, "SEED", 3)
+    monkeypatch.setattr(AgentGen, "AGENT_FP", os.path.join(ROOT, "SimpleCaseAgent.py"))
+
+    AgentGen.generateScenario(str(tmp_path), 2, 2)
+
+    path = os.path.join(tmp_path, "scenario.xml")
+    with open(path) as f:
+        scenario = f.read()
+    with open(path, "w") as f:
+        f.write(scenario.replace('name="AGENT0"', 'name="AGENT0" history_spill="shared"'))
+
+    with pytest.raises(ValueError):
+        loadShardedScenario(path, 2)
@@ -0,0 +1,186 @@
+"""
+Summary: shared, append-only binary log of agent fills
+
+         Notes:
+
+         - every agent in the interpreter writing to the same path shares
+         one TradeLog, so a whole run produces a single file instead of
+         one json file per agent
+
+         - records are fixed width (see TRADE_DTYPE), prices are stored in
+         integer cents, so the file can be opened with np.memmap directly
+
+         - the side column uses the FILL_BUY / FILL_SELL values of history.py
+
+"""
+
+import os
+import numpy as np
+
+
+TRADE_DTYPE = np.dtype([
+    ("timestamp", np.int64),
+    ("agent", np.int32),
+    ("asset", np.int32),
+    ("side", np.int8),
+    ("price_cents", np.int64),
+    ("order_id", np.int64),
+])
+
+## maps absolute path -> TradeLog shared by every agent in this process
+_TRADE_LOGS = {}
+
+
+class TradeLog:
+    """ buffered writer of TRADE_DTYPE records to an append-only file
+
+    Attributes
+    ----------
+    path : string
+        file the records are appended to
+
+    buffer_size : int
+        number of records held in memory before they are appended
+
+    written : int
+        number of records appended to the file so far
+    """
+
+    def __init__(self, path, buffer_size=4096):
+
+        self.path = path
+        self.buffer_size = max(1, int(buffer_size))
+        self.buffer = np.zeros(self.buffer_size, dtype=TRADE_DTYPE)
+        self.size = 0
+        self.written = 0
+
+        ## a new log starts empty, never append to a previous run
+        open(path, "wb").close()
+
+    def record(self, timestamp, agent, asset, side, price_cents, order_id):
+        """
+        Buffers one fill, appending the buffer to the file when it is full
+
+        Parameters
+        ----------
+        timestamp : int
+            simulation timestamp of the fill
+
+        agent : int
+            id of the agent whose order was filled
+
+        asset : int
+            id of the exchange the fill happened on
+
+        side : int
+            FILL_BUY or FILL_SELL
+
+        price_cents : int
+            fill price in cents
+
+        order_id : int
+            exchange order id of the filled order
+        """
+
+        if self.size == self.buffer_size:
+            self.flush()
+
+        self.buffer[self.size] = (timestamp, agent, asset, side, price_cents, order_id)
+        self.size += 1
+
+    def extend(self, records):
+        """ buffers an array of TRADE_DTYPE records, in order """
+
+        for start in range(0, len(records), self.buffer_size):
+
+            chunk = records[start:start + self.buffer_size]
+            if self.size + len(chunk) > self.buffer_size:
+                self.flush()
+
+            self.buffer[self.size:self.size + len(chunk)] = chunk
+            self.size += len(chunk)
+
+    def drain(self):
+        """ returns and clears the buffered records without writing them """
+
+        records = self.buffer[:self.size].copy()
+        self.size = 0
+
+        return records
+
+    def flush(self):
+        """ appends buffered records to the file """
+
+        if self.size == 0:
+            return
+
+        with open(self.path, "ab", buffering=0) as f:
+            f.write(self.buffer[:self.size].tobytes())
+
+        self.written += self.size
+        self.size = 0
+
+
+def openTradeLog(path, buffer_size=4096):
+    """
+    Returns the trade log for path shared by every agent in the process,
+    creating (and truncating) the file on first use
+
+    Parameters
+    ----------
+    path : string
+        file to log fills to
+
+    buffer_size : int
+        records buffered before each append, only used on first open
+
+    Returns
+    -------
+    trade_log : TradeLog
+        the shared log
+    """
+
+    key = os.path.abspath(path)
+
+    if key not in _TRADE_LOGS:
+        _TRADE_LOGS[key] = TradeLog(path, buffer_size)
+
+    return _TRADE_LOGS[key]
+
+def flushTradeLogs():
+    """ flushes every trade log opened by this process """
+
+    for trade_log in _TRADE_LOGS.values():
+        trade_log.flush()
+
+def drainTradeLogs():
+    """ returns [(path, records)] of every trade log of this process holding buffered
+        records, clearing them, for a process that hands its fills to another to write """
+
+    return [(trade_log.path, trade_log.drain()) for trade_log in _TRADE_LOGS.values() if trade_log.size]
+
+def priceToCents(price):
+    """ converts a thesimulator Money value to integer cents """
+
+    return int(round(float(price.toCentString()) * 100))
+
+def loadTradeLog(path):
+    """
+    Memory-maps a trade log for analysis
+
+    Parameters
+    ----------
+    path : string
+        file written by TradeLog
+
+    Returns
+    -------
+    trades : nparray
+        read-only structured array of TRADE_DTYPE records
+    """
+
+    ## np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=TRADE_DTYPE)
+
+    return np.memmap(path, dtype=TRADE_DTYPE, mode="r")